@@ -4,8 +4,10 @@ from django.contrib.auth.admin import UserAdmin
 from django.contrib.auth.models import Group as djangoGroup
 from django.contrib.sites.models import Site
 
-from user.forms import UserFormCreate, UserFormChange
-from .models import User, Group, Note, Diploma
+from user.custom_fields import custom_field_names
+from user.forms import UserFormCreate, UserFormChange, user_form_change_class
+from user.paginators import EstimatedCountPaginator
+from .models import User, Group, Note, Diploma, ArchivedUser, SiteShard, ReportJob, Mailing, ChangeEvent
 
 
 @admin.register(User)
@@ -28,9 +30,13 @@ class UserAdmin(UserAdmin):
     ]
     readonly_fields = ['last_login', 'registered_at']
     list_display = ['full_name', 'organization', 'email', 'phone', 'site', 'registered_at']
+    list_select_related = ['site__organization']
     list_filter = ['role', 'is_active', 'site__organization']
     search_fields = ['first_name', 'last_name', 'email', 'phone', 'site__domain', 'site__organization__title']
     ordering = ['-registered_at']
+    # Exact COUNT(*) over the joined search query is too slow on large tables
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
 
     def get_form(self, request, obj=None, **kwargs):
         # By passing 'fields', we prevent ModelAdmin.get_form from
@@ -39,13 +45,14 @@ class UserAdmin(UserAdmin):
         # modelform_factory complaining about non-existent fields.
         if obj:
             kwargs['fields'] = flatten_fieldsets(self.fieldsets)
+            kwargs['form'] = user_form_change_class(obj.organization)
         return super(UserAdmin, self).get_form(request, obj, **kwargs)
 
     def get_fieldsets(self, request, obj=None):
         fieldsets = super(UserAdmin, self).get_fieldsets(request, obj)
         newfieldsets = list(fieldsets)
         if obj:
-            fields = list(obj.site.organization.custom_fields.values_list('name', flat=True))
+            fields = custom_field_names(obj.organization)
             newfieldsets.append(['Дополнительные параметры', {'fields': fields}])
         return newfieldsets
 
@@ -65,5 +72,43 @@ class DiplomaAdmin(admin.ModelAdmin):
     pass
 
 
+@admin.register(ArchivedUser)
+class ArchivedUserAdmin(admin.ModelAdmin):
+    list_display = ['full_name', 'email', 'site', 'archived_at']
+    list_filter = ['site']
+    search_fields = ['email', 'full_name']
+    readonly_fields = ['site', 'original_id', 'email', 'full_name', 'data', 'archived_at']
+
+
+@admin.register(SiteShard)
+class SiteShardAdmin(admin.ModelAdmin):
+    list_display = ['site', 'alias']
+    # Sites are moved with move_site_shard command, which also copies the data
+    readonly_fields = ['site', 'alias']
+
+
+@admin.register(ReportJob)
+class ReportJobAdmin(admin.ModelAdmin):
+    list_display = ['kind', 'site', 'status', 'progress', 'created_at', 'finished_at']
+    list_filter = ['kind', 'status', 'site']
+    readonly_fields = ['site', 'created_by', 'kind', 'params', 'key', 'status', 'progress', 'file', 'error',
+                       'created_at', 'finished_at']
+
+
+@admin.register(Mailing)
+class MailingAdmin(admin.ModelAdmin):
+    list_display = ['subject', 'site', 'status', 'recipients', 'sent', 'created_at']
+    list_filter = ['status', 'site']
+    readonly_fields = ['site', 'created_by', 'subject', 'body', 'segment', 'status', 'recipients', 'sent',
+                       'last_user_id', 'error', 'created_at', 'updated_at', 'finished_at']
+
+
+@admin.register(ChangeEvent)
+class ChangeEventAdmin(admin.ModelAdmin):
+    list_display = ['id', 'site', 'object_type', 'object_id', 'action', 'created_at']
+    list_filter = ['object_type', 'action', 'site']
+    readonly_fields = ['site', 'object_type', 'object_id', 'action', 'data', 'created_at']
+
+
 admin.site.unregister(Site)
 admin.site.unregister(djangoGroup)
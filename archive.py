@@ -0,0 +1,159 @@
+import json
+from datetime import timedelta
+
+from django.core import serializers
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import transaction
+from django.db.models import Q
+from django.db.models.deletion import Collector, ProtectedError
+from django.utils import timezone
+
+from .changes import record_changes
+from .conf import app_settings
+from .models import User, Group, Note, Diploma, ArchivedUser, Invitation, normalize_email
+
+# Models that may be touched when an archived User row is deleted.
+# Users referenced by anything else (payments, access requests,
+# organization admins, authors of groups and of other users' notes...)
+# are left in place, so archiving never cascades into other data
+# and never nulls references to the user.
+ARCHIVE_SAFE_MODELS = {User, User.groups.through, User.tags.through, User.user_permissions.through, Invitation}
+# SET_NULL references, which archive_user deletes itself and restore_user puts back
+ARCHIVED_REFERENCES = {(Note, 'user'), (Diploma, 'user')}
+
+
+def archivable_users(days=None, site=None):
+    """
+    :return: deactivated users, who were inactive longer than 'days'.
+    Users deactivated before deactivated_at was tracked are checked
+    by their last login (or registration, if they never logged in)
+    """
+    if days is None:
+        days = app_settings.ARCHIVE_AFTER_DAYS
+    cutoff = timezone.now() - timedelta(days=days)
+
+    q = Q(deactivated_at__lt=cutoff)
+    q |= Q(deactivated_at__isnull=True) & (Q(last_login__lt=cutoff) |
+                                           Q(last_login__isnull=True, registered_at__lt=cutoff))
+    qs = User.objects.filter(q, is_active=False)
+    if site is not None:
+        qs = qs.filter(site=site)
+    return qs
+
+
+def _dump(objects):
+    return [{'pk': obj['pk'], 'fields': obj['fields']} for obj in serializers.serialize('python', objects)]
+
+
+def _load(model, objects):
+    return serializers.deserialize('python', [dict(obj, model=model._meta.label_lower) for obj in objects])
+
+
+def can_archive(user):
+    """
+    Checks that deleting the user touches nothing but his own m2m rows,
+    notes and diplomas
+    """
+    collector = Collector(using=user._state.db or 'default')
+    try:
+        collector.collect([user])
+    except ProtectedError:
+        return False
+
+    if not set(collector.data) <= ARCHIVE_SAFE_MODELS:
+        return False
+    # SET_NULL would silently clear references, which restore_user can not put back
+    for model, updates in collector.field_updates.items():
+        if any((model, field.name) not in ARCHIVED_REFERENCES for field, value in updates):
+            return False
+    # Fast deletes are not evaluated by the collector, so they may be empty
+    return not any(qs.model not in ARCHIVE_SAFE_MODELS and qs.exists() for qs in collector.fast_deletes)
+
+
+def archive_user(user):
+    """
+    Moves User with his notes, diplomas and custom field values to ArchivedUser.
+    :return: ArchivedUser or None, if user is referenced from other apps
+    """
+    if not can_archive(user):
+        return None
+
+    notes = list(Note.objects.filter(user=user))
+    diplomas = list(Diploma.objects.filter(user=user))
+    data = {
+        'user': _dump([user])[0],
+        'custom_fields': {field.name: field.values[user.email]
+                          for field in user.site.organization.custom_fields.all() if user.email in field.values},
+        'notes': _dump(notes),
+        'diplomas': _dump(diplomas),
+    }
+
+    with transaction.atomic():
+        Note.objects.filter(user=user).delete()
+        Diploma.objects.filter(user=user).delete()
+        archived = ArchivedUser.objects.create(site_id=user.site_id,
+                                               original_id=user.id,
+                                               email=user.email,
+                                               full_name=user.full_name[:100],
+                                               data=json.dumps(data, cls=DjangoJSONEncoder, separators=(',', ':')))
+        # pre_delete signal removes user's email from custom fields values
+        user.delete()
+    return archived
+
+
+@transaction.atomic
+def restore_user(archived):
+    """
+    Rehydrates User from ArchivedUser and deletes the archive row.
+    User keeps his id, if it was not taken by another user. The restored user
+    is active, so archive_users does not archive him again.
+    :raise ValueError: if the email is already used on the site
+    """
+    if User.objects.filter(site_id=archived.site_id, email_normalized=normalize_email(archived.email)).exists():
+        raise ValueError('Пользователь с email {} уже существует'.format(archived.email))
+
+    data = json.loads(archived.data)
+    user_data = data['user']
+    if User.objects.filter(pk=user_data['pk']).exists():
+        user_data['pk'] = None
+
+    fields = user_data['fields']
+    fields['groups'] = list(Group.objects.filter(site_id=archived.site_id, id__in=fields.get('groups', []))
+                            .values_list('id', flat=True))
+    fields['tags'] = list(User._meta.get_field('tags').related_model.objects.filter(id__in=fields.get('tags', []))
+                          .values_list('id', flat=True))
+    fields['user_permissions'] = []
+    fields['is_active'] = True
+    fields['deactivated_at'] = None
+
+    restored = next(_load(User, [user_data]))
+    restored.save()
+    user = restored.object
+
+    custom_fields = data['custom_fields']
+    for field in user.site.organization.custom_fields.filter(name__in=list(custom_fields)):
+        field.values.update({user.email: custom_fields[field.name]})
+        field.save(update_fields=['values'])
+
+    authors = set(User.objects.filter(id__in=[note['fields']['author'] for note in data['notes']
+                                              if note['fields']['author']])
+                  .values_list('id', flat=True))
+    for note in data['notes']:
+        note['pk'] = None
+        note['fields']['user'] = user.id
+        if note['fields']['author'] not in authors:
+            note['fields']['author'] = None
+    Note.objects.bulk_create([obj.object for obj in _load(Note, data['notes'])])
+
+    for diploma in data['diplomas']:
+        diploma['pk'] = None
+        diploma['fields']['user'] = user.id
+    Diploma.objects.bulk_create([obj.object for obj in _load(Diploma, data['diplomas'])])
+
+    # bulk_create sends no signals and sets ids only on PostgreSQL,
+    # the user is new, so all his notes and diplomas are the restored ones
+    record_changes(Note.objects.filter(user=user), 'created')
+    record_changes(Diploma.objects.filter(user=user), 'created')
+
+    archived.delete()
+    return user
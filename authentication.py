@@ -0,0 +1,108 @@
+"""
+Cached resolution of the authenticated user.
+
+AuthenticationMiddleware loads request.user from the database on every request.
+CachedModelBackend builds it from a snapshot in the cache instead: the fields
+views check (id, role, site, active flag...) and the permission scope, ids of
+the courses the user is an author of (see authored_course_ids). Other fields
+are deferred and loaded on first access.
+
+The snapshot is deleted when the user is saved, including password change
+(sessions are verified against the cached get_session_auth_hash(), the cache
+never gets the password hash itself), and when course
+authors change. Queryset update() sends no signals, so views call forget_users
+after it, and the snapshot expires after USER_AUTH_CACHE_TIMEOUT seconds anyway.
+
+    AUTHENTICATION_BACKENDS = ['user.authentication.CachedModelBackend']
+    MIDDLEWARE = [
+        ...
+        'user.authentication.CachedUserMiddleware',  # instead of AuthenticationMiddleware
+    ]
+"""
+from django.conf import settings
+from django.contrib import auth
+from django.contrib.auth.backends import ModelBackend
+from django.contrib.auth.middleware import AuthenticationMiddleware
+from django.core.cache import cache
+from django.db import router
+
+from course.models import Course
+from .conf import app_settings
+from .models import User
+
+SNAPSHOT_KEY = 'user:auth:{}'
+SNAPSHOT_FIELDS = ['id', 'site_id', 'role', 'is_active', 'is_staff', 'is_superuser',
+                   'email', 'first_name', 'last_name', 'middle_name']
+MODEL_BACKEND = 'django.contrib.auth.backends.ModelBackend'
+CACHED_BACKEND = 'user.authentication.CachedModelBackend'
+
+
+def authored_course_ids(user):
+    """
+    :return: set of ids of the courses the user is an author of
+    """
+    if not hasattr(user, '_authored_course_ids'):
+        user._authored_course_ids = set(Course.objects.filter(authors=user.pk).values_list('id', flat=True))
+    return user._authored_course_ids
+
+
+def make_snapshot(user):
+    snapshot = {name: getattr(user, name) for name in SNAPSHOT_FIELDS}
+    snapshot['authored_course_ids'] = authored_course_ids(user)
+    snapshot['session_auth_hash'] = user.get_session_auth_hash()
+    return snapshot
+
+
+def from_snapshot(snapshot):
+    """
+    :return: User with the snapshot fields loaded and the rest deferred
+    """
+    # from_db takes values in the order of the model fields
+    names = [field.attname for field in User._meta.concrete_fields if field.attname in snapshot]
+    user = User.from_db(router.db_for_read(User), names, [snapshot[name] for name in names])
+    user._authored_course_ids = snapshot['authored_course_ids']
+    user._session_auth_hash = snapshot['session_auth_hash']
+    user._from_snapshot = True
+    return user
+
+
+def get_cached_user(user_id):
+    """
+    :return: User from the snapshot, or from the database if there is no snapshot; None if it does not exist
+    """
+    key = SNAPSHOT_KEY.format(user_id)
+    snapshot = cache.get(key)
+    if snapshot is not None:
+        return from_snapshot(snapshot)
+    try:
+        user = User._default_manager.get(pk=user_id)
+    except User.DoesNotExist:
+        return None
+    cache.set(key, make_snapshot(user), app_settings.AUTH_CACHE_TIMEOUT)
+    return user
+
+
+def forget_users(*user_ids):
+    cache.delete_many([SNAPSHOT_KEY.format(user_id) for user_id in user_ids])
+
+
+class CachedModelBackend(ModelBackend):
+    """
+    ModelBackend, which gets the user of the session from the cached snapshot
+    """
+    def get_user(self, user_id):
+        user = get_cached_user(user_id)
+        return user if self.user_can_authenticate(user) else None
+
+
+class CachedUserMiddleware(AuthenticationMiddleware):
+    """
+    AuthenticationMiddleware, which moves sessions logged in with ModelBackend
+    to CachedModelBackend, so they use the snapshot too
+    """
+    def process_request(self, request):
+        session = getattr(request, 'session', None)
+        if session is not None and CACHED_BACKEND in settings.AUTHENTICATION_BACKENDS \
+                and session.get(auth.BACKEND_SESSION_KEY) == MODEL_BACKEND:
+            session[auth.BACKEND_SESSION_KEY] = CACHED_BACKEND
+        super(CachedUserMiddleware, self).process_request(request)
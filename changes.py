@@ -0,0 +1,120 @@
+"""
+Change data capture: an outbox of changes for downstream systems (CRM, analytics, billing).
+
+user.signals appends a ChangeEvent for every saved or deleted User, Group,
+Note and Diploma and for every membership added or removed, in the same
+transaction as the change. Bulk operations, which send no signals, call
+record_changes / record_memberships themselves.
+
+Consumers read users/changes/?since=<cursor> in batches and keep the last
+cursor. Ids are given out before commit, so an event of a concurrent
+transaction may get a smaller id than an already visible one: the feed
+returns only events older than USER_CHANGES_DELAY seconds, which covers
+transactions shorter than that. move_site_shard keeps the cursors of a moved
+site valid: ids in the target shard continue above the ones of the source.
+"""
+import json
+from datetime import timedelta
+
+from django.db import models
+from django.db.models import Q
+from django.utils import timezone
+
+from .conf import app_settings
+from .models import User, Group, Note, Diploma, ChangeEvent
+
+# Fields in the event data, full objects are at their endpoints
+EVENT_FIELDS = {
+    User: ('user', ['email', 'role', 'is_active', 'last_name', 'first_name', 'middle_name']),
+    Group: ('group', ['title', 'course', 'author']),
+    Note: ('note', ['user', 'author', 'type']),
+    Diploma: ('diploma', ['user', 'description']),
+}
+
+
+def event_data(instance):
+    object_type, fields = EVENT_FIELDS[instance.__class__]
+    data = dict()
+    for name in fields:
+        field = instance._meta.get_field(name)
+        data[field.attname] = getattr(instance, field.attname)
+    return data
+
+
+def is_tracked(instance, update_fields=None):
+    """
+    :return: False for saves of fields, which are not in the event data (e.g. last_login)
+    """
+    if not update_fields:
+        return True
+    object_type, fields = EVENT_FIELDS[instance.__class__]
+    return bool(set(update_fields) & set(fields))
+
+
+def make_event(instance, action):
+    object_type, fields = EVENT_FIELDS[instance.__class__]
+    data = event_data(instance) if action != 'deleted' else {}
+    return ChangeEvent(site_id=instance.site_id, object_type=object_type, object_id=instance.pk, action=action,
+                       data=json.dumps(data, ensure_ascii=False, separators=(',', ':')))
+
+
+def record_change(instance, action):
+    make_event(instance, action).save()
+
+
+def record_changes(instances, action):
+    """
+    Records changes of saved objects with one query
+    """
+    ChangeEvent.objects.bulk_create([make_event(instance, action) for instance in instances])
+
+
+def record_cleared_references(user, using=None):
+    """
+    Records updates of the objects, whose references the deletion of the user
+    clears with SET_NULL: the collector updates them with one query and no signals
+    """
+    for model, (object_type, names) in EVENT_FIELDS.items():
+        fields = [field for field in map(model._meta.get_field, names) if field.is_relation
+                  and field.related_model is User and field.remote_field.on_delete is models.SET_NULL]
+        if not fields:
+            continue
+        q = Q()
+        for field in fields:
+            q |= Q(**{field.attname: user.pk})
+        instances = list(model._base_manager.db_manager(using).filter(q))
+        for instance in instances:
+            for field in fields:
+                if getattr(instance, field.attname) == user.pk:
+                    setattr(instance, field.attname, None)
+        record_changes(instances, 'updated')
+
+
+def record_memberships(site_id, pairs, action):
+    """
+    :param pairs: (user id, group id) of added or removed memberships
+    """
+    ChangeEvent.objects.bulk_create([
+        ChangeEvent(site_id=site_id, object_type='membership', object_id=user_id, action=action,
+                    data=json.dumps({'group_id': group_id}, separators=(',', ':')))
+        for user_id, group_id in pairs
+    ])
+
+
+def changes_since(site_id, cursor, limit):
+    """
+    :return: list of events of the site after the cursor, by cursor
+    """
+    visible = timezone.now() - timedelta(seconds=app_settings.CHANGES_DELAY)
+    qs = ChangeEvent.objects.filter(site_id=site_id, id__gt=cursor, created_at__lte=visible).order_by('id')
+    return [{'cursor': event_id, 'type': object_type, 'id': object_id, 'action': action,
+             'data': json.loads(data), 'at': created_at}
+            for event_id, object_type, object_id, action, data, created_at
+            in qs.values_list('id', 'object_type', 'object_id', 'action', 'data', 'created_at')[:limit]]
+
+
+def purge_changes(before):
+    """
+    :return: number of deleted events
+    """
+    return ChangeEvent.objects.filter(created_at__lt=before).delete()[0]
@@ -0,0 +1,54 @@
+import hashlib
+
+from django.utils import timezone
+from django.utils.http import quote_etag
+from rest_framework import status
+from rest_framework.response import Response
+
+from .versions import site_version
+
+
+class NotModified(Exception):
+    pass
+
+
+class ConditionalGetMixin(object):
+    """
+    Answers 304 Not Modified to safe requests to conditional_actions, if nothing
+    on the site changed since the client got its copy.
+    Validators are computed from the site change version (see user.versions),
+    so a repeated poll costs no queries and no serialization.
+    Only ETag is sent: Last-Modified has whole seconds, so a second change
+    in the same second would be answered with 304 to If-Modified-Since.
+    """
+    conditional_actions = ['list', 'retrieve']
+
+    def get_etag(self, request, version):
+        # Visibility depends on the user, and group status on the current date
+        key = '{}:{}:{}:{}:{}:{}'.format(request.site.id, version, request.get_full_path(), request.user.pk,
+                                         request.META.get('HTTP_ACCEPT', ''), timezone.now().date())
+        return quote_etag(hashlib.md5(key.encode()).hexdigest())
+
+    def initial(self, request, *args, **kwargs):
+        super(ConditionalGetMixin, self).initial(request, *args, **kwargs)
+        if request.method not in ['GET', 'HEAD'] or self.action not in self.conditional_actions:
+            return
+
+        version = site_version(request.site.id)
+        self.etag = self.get_etag(request, version)
+
+        if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+        if if_none_match and self.etag in [tag.strip() for tag in if_none_match.split(',')]:
+            raise NotModified()
+
+    def handle_exception(self, exc):
+        if isinstance(exc, NotModified):
+            return Response(status=status.HTTP_304_NOT_MODIFIED)
+        return super(ConditionalGetMixin, self).handle_exception(exc)
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        response = super(ConditionalGetMixin, self).finalize_response(request, response, *args, **kwargs)
+        if getattr(self, 'etag', None) and response.status_code in [status.HTTP_200_OK,
+                                                                    status.HTTP_304_NOT_MODIFIED]:
+            response['ETag'] = self.etag
+        return response
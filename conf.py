@@ -0,0 +1,73 @@
+from django.conf import settings
+
+
+class UserAppSettings(object):
+    """
+    Settings of the user app with their defaults.
+    Each one can be overridden in project settings with 'USER_' prefix,
+    e.g. USER_ARCHIVE_AFTER_DAYS = 180
+    """
+    defaults = {
+        # Deactivated users are moved to the archive after this many days
+        'ARCHIVE_AFTER_DAYS': 365,
+        'ARCHIVE_CHUNK_SIZE': 500,
+        # Background tasks (emails etc.), see user.tasks
+        'TASK_WORKERS': 2,
+        'TASKS_EAGER': False,
+        # Admin changelist shows estimated count above this number of rows
+        'ESTIMATED_COUNT_THRESHOLD': 10000,
+        # Read replicas, see user.routers
+        'READ_REPLICAS': [],
+        'REPLICA_MAX_LAG': 5,
+        'REPLICA_LAG_CHECK_INTERVAL': 1,
+        'REPLICA_PIN_SECONDS': 10,
+        # Database aliases for site shards, see user.routers
+        'SHARDS': [],
+        'SHARD_MOVE_CHUNK_SIZE': 1000,
+        # Seconds the site shard map is cached, processes see a moved site after it
+        'SHARD_CACHE_TIMEOUT': 60,
+        # Invitations to set a password, see user.invitations
+        'INVITATION_DAYS': 7,
+        'INVITATION_URL': 'http://{domain}.grandclass.net/invitation/{token}',
+        # Background reports, see user.reports
+        'REPORT_WORKERS': 2,
+        'REPORT_TTL': 3600,
+        'REPORT_CHUNK_SIZE': 500,
+        # Pending and running jobs, which did not progress for this time, are orphaned
+        # by a restart of the web process and are not reused
+        'REPORT_STALE_SECONDS': 600,
+        # Batch diplomas, see user.diplomas. None processes is the number of CPUs,
+        # 0 renders in the worker thread
+        'DIPLOMA_PROCESSES': None,
+        'DIPLOMA_CHUNK_SIZE': 20,
+        # TrueType font with cyrillic letters, searched in system font directories
+        'DIPLOMA_FONT': 'DejaVuSans.ttf',
+        # Bulk mailing, see user.mailing. Rate is messages per second, 0 is unlimited
+        'MAILING_WORKERS': 1,
+        'MAILING_BATCH_SIZE': 100,
+        'MAILING_RATE': 10,
+        'MAILING_STALE_SECONDS': 600,
+        'UNSUBSCRIBE_URL': 'http://{domain}.grandclass.net/unsubscribe/{code}',
+        # Users serialized at once in the streamed list, see user.streaming
+        'STREAM_CHUNK_SIZE': 500,
+        # Lifetime of the authenticated user snapshot, see user.authentication
+        'AUTH_CACHE_TIMEOUT': 300,
+        # Members shown in the group payload and per page of groups/{id}/members/
+        'GROUP_PREVIEW_SIZE': 5,
+        'GROUP_MEMBERS_PAGE_SIZE': 50,
+        # Change feed, see user.changes. TTL is in seconds, see the purge_changes command
+        'CHANGES_BATCH_SIZE': 500,
+        'CHANGES_DELAY': 5,
+        'CHANGES_TTL': 30 * 24 * 60 * 60,
+        # Password hasher costs by algorithm, see user.hashers and the calibrate_password_hashers command
+        'PASSWORD_COST': {},
+        'PASSWORD_BULK_COST': {},
+    }
+
+    def __getattr__(self, name):
+        if name not in self.defaults:
+            raise AttributeError(name)
+        return getattr(settings, 'USER_' + name, self.defaults[name])
+
+
+app_settings = UserAppSettings()
@@ -0,0 +1,37 @@
+"""
+Cached schema of organization.CustomField.
+Values of custom fields change all the time (they are stored in the same row),
+so the schema version is bumped only when anything but 'values' is saved.
+Code updating only values must save with update_fields=['values'].
+"""
+import uuid
+
+from django.core.cache import cache
+
+VERSION_KEY = 'user:custom_fields:version:{}'
+NAMES_KEY = 'user:custom_fields:names:{}:{}'
+
+
+def schema_version(organization_id):
+    """
+    :return: opaque token, which changes on every custom fields schema change
+    """
+    key = VERSION_KEY.format(organization_id)
+    version = cache.get(key)
+    if version is None:
+        cache.add(key, uuid.uuid4().hex, None)
+        version = cache.get(key)
+    return version
+
+
+def bump_schema_version(organization_id):
+    cache.set(VERSION_KEY.format(organization_id), uuid.uuid4().hex, None)
+
+
+def custom_field_names(organization):
+    key = NAMES_KEY.format(organization.id, schema_version(organization.id))
+    names = cache.get(key)
+    if names is None:
+        names = list(organization.custom_fields.values_list('name', flat=True))
+        cache.set(key, names, None)
+    return names
@@ -0,0 +1,100 @@
+"""
+Personalized diploma certificates: the user's full name drawn on a template image.
+Rendering runs in worker processes, see user.reports.DiplomasReport
+"""
+import io
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+from django.core.exceptions import ImproperlyConfigured
+
+from .conf import app_settings
+
+DEFAULT_OPTIONS = {
+    # Center of the name, as a fraction of the image width and height
+    'x': 0.5,
+    'y': 0.5,
+    # Font size as a fraction of the image height
+    'font_size': 0.05,
+    'color': '#000000',
+}
+# Shared by all the batches, see get_process_pool
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def load_font(path, size):
+    """
+    The default bitmap font of Pillow has no cyrillic letters,
+    so a missing font is an error, not a fallback
+    """
+    from PIL import ImageFont
+
+    try:
+        return ImageFont.truetype(path, size)
+    except (IOError, OSError):
+        raise ImproperlyConfigured('USER_DIPLOMA_FONT {} is not found'.format(path))
+
+
+def render_diplomas(template, names, options):
+    """
+    :param template: template image content
+    :return: list of JPEG contents, one for each name
+    """
+    from PIL import Image, ImageDraw
+
+    options = dict(DEFAULT_OPTIONS, **options)
+    base = Image.open(io.BytesIO(template)).convert('RGB')
+    font = load_font(options['font'], max(1, int(base.height * float(options['font_size']))))
+
+    result = list()
+    for name in names:
+        image = base.copy()
+        draw = ImageDraw.Draw(image)
+        if hasattr(draw, 'textbbox'):
+            left, top, right, bottom = draw.textbbox((0, 0), name, font=font)
+            width, height = right - left, bottom - top
+        else:
+            width, height = draw.textsize(name, font=font)
+        x = base.width * float(options['x']) - width / 2
+        y = base.height * float(options['y']) - height / 2
+        draw.text((x, y), name, fill=options['color'], font=font)
+
+        content = io.BytesIO()
+        image.save(content, 'JPEG', quality=90)
+        result.append(content.getvalue())
+    return result
+
+
+def get_process_pool():
+    """
+    :return: process pool of USER_DIPLOMA_PROCESSES, started once,
+    so batches do not pay for starting processes
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ProcessPoolExecutor(max_workers=app_settings.DIPLOMA_PROCESSES)
+        return _pool
+
+
+def render_in_processes(template, names, options):
+    """
+    Renders diplomas for the names in USER_DIPLOMA_PROCESSES processes
+    (0 renders in the current process)
+    :return: iterator over lists of JPEG contents, by chunks of USER_DIPLOMA_CHUNK_SIZE names
+    """
+    options = dict(options, font=app_settings.DIPLOMA_FONT)
+    # Fails the batch at once, not in every worker process
+    load_font(options['font'], 1)
+    size = app_settings.DIPLOMA_CHUNK_SIZE
+    chunks = [names[i:i + size] for i in range(0, len(names), size)]
+    if app_settings.DIPLOMA_PROCESSES == 0:
+        for chunk in chunks:
+            yield render_diplomas(template, chunk, options)
+        return
+
+    # The template is sent once per chunk, not once per name
+    for rendered in get_process_pool().map(render_diplomas, [template] * len(chunks), chunks,
+                                           [options] * len(chunks)):
+        yield rendered
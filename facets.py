@@ -0,0 +1,60 @@
+"""
+Counts of users by role, group, tag and active state for the user list filters
+"""
+from django.core.cache import cache
+from django.db.models import CharField, Count, F, IntegerField, Value
+from django.db.models.functions import Cast
+
+from .models import User
+from .versions import site_version
+
+FACETS_KEY = 'user:facets:{}:{}:{}'
+FACETS_TIMEOUT = 24 * 60 * 60
+
+
+def count_facets(scope):
+    """
+    Counts all facets with one query (UNION ALL of three GROUP BYs).
+    Roles, groups and tags are counted for active users.
+    :param scope: queryset of users visible to the current user, active or not
+    :return: dict of {'role': {role: count}, 'group': {id: count}, 'tag': {id: count},
+    'is_active': {True: count, False: count}}
+    """
+    ids = scope.values('id')
+    states = User.objects.filter(id__in=ids) \
+        .annotate(facet=F('role'), key=Cast('is_active', IntegerField())) \
+        .values('facet', 'key').annotate(count=Count('id')) \
+        .values_list('facet', 'key', 'count').order_by()
+    groups = User.groups.through.objects.filter(user__in=ids, user__is_active=True) \
+        .annotate(facet=Value('group', output_field=CharField()), key=F('group_id')) \
+        .values('facet', 'key').annotate(count=Count('user_id')) \
+        .values_list('facet', 'key', 'count').order_by()
+    tags = User.tags.through.objects.filter(user__in=ids, user__is_active=True) \
+        .annotate(facet=Value('tag', output_field=CharField()), key=F('tag_id')) \
+        .values('facet', 'key').annotate(count=Count('user_id')) \
+        .values_list('facet', 'key', 'count').order_by()
+
+    result = {'role': {role: 0 for role, title in User.ROLE_TYPES}, 'group': {}, 'tag': {},
+              'is_active': {True: 0, False: 0}}
+    for facet, key, count in states.union(groups, tags, all=True):
+        if facet in ['group', 'tag']:
+            result[facet][key] = count
+        else:
+            # Rows of the first query are (role, is_active)
+            result['is_active'][bool(key)] += count
+            if key:
+                result['role'][facet] = result['role'].get(facet, 0) + count
+    return result
+
+
+def cached_facets(site_id, scope_key, scope):
+    """
+    :param scope_key: identifies the visibility scope, e.g. id of the teacher
+    :return: count_facets(scope), cached until the site data changes
+    """
+    key = FACETS_KEY.format(site_id, site_version(site_id), scope_key)
+    result = cache.get(key)
+    if result is None:
+        result = count_facets(scope)
+        cache.set(key, result, FACETS_TIMEOUT)
+    return result
@@ -0,0 +1,158 @@
+"""
+Read path for user lists, which builds exactly the same data as
+UserSerializer from .values() rows and a few bulk lookups,
+instead of model instances and per-row field introspection.
+"""
+import ast
+from collections import defaultdict
+from types import SimpleNamespace
+
+from django.contrib.sites.models import Site
+from rest_framework.relations import ManyRelatedField
+from rest_framework.serializers import SerializerMethodField
+
+from .models import User, Group
+from .serializers import UserSerializer
+
+DEFAULT_AVATAR = '/static/images/default-profile.jpg'
+
+# Columns needed by UserSerializer method fields
+METHOD_FIELDS = {
+    'role': ['role'],
+    'groups': [],
+    'avatar': ['avatar'],
+    'full_name': ['first_name', 'last_name', 'middle_name'],
+    'short_name': ['first_name', 'last_name', 'middle_name'],
+    'custom_fields': ['site_id', 'email'],
+}
+
+_compiled = None
+
+
+def compile_user_serializer():
+    """
+    Introspects UserSerializer once.
+    :return: list of (name, kind, source, to_representation) in output order and list of columns
+    """
+    global _compiled
+    if _compiled is None:
+        fields, columns = list(), ['id']
+        for name, field in UserSerializer().fields.items():
+            if isinstance(field, SerializerMethodField):
+                if name not in METHOD_FIELDS:
+                    raise ValueError('Unknown UserSerializer method field {}'.format(name))
+                fields.append((name, 'method', None, None))
+                columns.extend(METHOD_FIELDS[name])
+            elif isinstance(field, ManyRelatedField):
+                fields.append((name, 'many', field.source, field.child_relation.to_representation))
+            else:
+                fields.append((name, 'value', field.source, field.to_representation))
+                columns.append(field.source)
+        _compiled = fields, list(dict.fromkeys(columns))
+    return _compiled
+
+
+def _custom_fields(site_ids, using=None):
+    """
+    :return: {site id: list of CustomFields of the site's organization}
+    """
+    result = dict()
+    for site in Site.objects.db_manager(using).filter(id__in=site_ids).select_related('organization'):
+        result[site.id] = list(site.organization.custom_fields.all())
+    return result
+
+
+def serialize_users(queryset):
+    """
+    :return: list of dicts, equal to UserSerializer(queryset, many=True).data
+    """
+    fields, columns = compile_user_serializer()
+    return serialize_rows(list(queryset.values(*columns)))
+
+
+def iter_serialized_users(queryset, chunk_size):
+    """
+    Streams the queryset (server-side cursor on PostgreSQL) and serializes it by chunks,
+    so only one chunk is in memory. The body runs when the first chunk is taken,
+    so the queryset should be bound to its database with using() beforehand,
+    see user.streaming.stream_users
+    :return: iterator over lists of serialized users
+    """
+    fields, columns = compile_user_serializer()
+    using = queryset.db
+    # Custom fields with their values are big, they are loaded once per stream
+    custom_fields = dict()
+    chunk = list()
+    for row in queryset.using(using).values(*columns).iterator():
+        chunk.append(row)
+        if len(chunk) == chunk_size:
+            yield serialize_rows(chunk, using, custom_fields)
+            chunk = list()
+    if chunk:
+        yield serialize_rows(chunk, using, custom_fields)
+
+
+def serialize_rows(rows, using=None, custom_fields=None):
+    """
+    :param rows: dicts from .values() of compile_user_serializer() columns
+    :param custom_fields: {site id: CustomFields} shared between calls, sites missing in it are added
+    :return: list of dicts, equal to UserSerializer data of the users
+    """
+    fields, columns = compile_user_serializer()
+    if not rows:
+        return []
+    ids = [row['id'] for row in rows]
+
+    groups = defaultdict(list)
+    for user_id, group_id, title in Group.objects.db_manager(using).filter(users__in=ids) \
+            .values_list('users', 'id', 'title'):
+        groups[user_id].append({'id': group_id, 'title': title})
+
+    many = dict()
+    for name, kind, source, to_representation in fields:
+        if kind == 'many':
+            model_field = User._meta.get_field(source)
+            lookup = model_field.related_query_name()
+            many[name] = defaultdict(list)
+            for user_id, pk in model_field.related_model.objects.db_manager(using) \
+                    .filter(**{lookup + '__in': ids}).values_list(lookup, 'pk'):
+                many[name][user_id].append(to_representation(SimpleNamespace(pk=pk)))
+
+    if custom_fields is None:
+        custom_fields = dict()
+    missing = {row['site_id'] for row in rows} - set(custom_fields)
+    if missing:
+        custom_fields.update(_custom_fields(missing, using))
+    role_titles = dict(User._meta.get_field('role').flatchoices)
+    avatar_storage = User._meta.get_field('avatar').storage
+
+    result = list()
+    for row in rows:
+        names = SimpleNamespace(first_name=row.get('first_name'), last_name=row.get('last_name'),
+                                middle_name=row.get('middle_name'))
+        data = dict()
+        for name, kind, source, to_representation in fields:
+            if kind == 'value':
+                value = row[source]
+                data[name] = None if value is None else to_representation(value)
+            elif kind == 'many':
+                data[name] = many[name][row['id']]
+            elif name == 'role':
+                data[name] = {'value': row['role'], 'title': str(role_titles.get(row['role'], row['role']))}
+            elif name == 'groups':
+                data[name] = groups[row['id']]
+            elif name == 'avatar':
+                data[name] = avatar_storage.url(row['avatar']) if row['avatar'] else DEFAULT_AVATAR
+            elif name == 'full_name':
+                data[name] = User.full_name.fget(names)
+            elif name == 'short_name':
+                data[name] = User.short_name.fget(names)
+            elif name == 'custom_fields':
+                data[name] = list()
+                for field in custom_fields[row['site_id']]:
+                    values = field.values.get(row['email'])
+                    if values and field.field_type == 5:  # 5 is MultipleChoice
+                        values = ', '.join(ast.literal_eval(values))  # Represent "[1, 2]" like "1, 2"
+                    data[name].append([field.name, values, field.visible, field.field_type])
+        result.append(data)
+    return result
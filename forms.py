@@ -1,12 +1,11 @@
 import ast
 
-from dateutil.parser import parse
-
 from django import forms
 from django.contrib.admin import widgets
 from django.contrib.auth.forms import UserChangeForm
 from django.utils.translation import ugettext_lazy as _
 
+from user.custom_fields import schema_version
 from user.models import User
 from user.utils import get_choices
 
@@ -27,52 +26,102 @@ class UserFormCreate(forms.ModelForm):
         fields = ['email', 'password']
 
 
+def custom_form_field(field):
+    """
+    :return: form field for organization.CustomField
+    """
+    field_type, required = field.field_type, field.required
+    if field_type == 1:  # Checkbox. We need choices here, so that 'False' value could also be stored in table
+        return forms.CharField(widget=forms.Select(choices=[(True, 'Да'), (False, 'Нет')]), required=required)
+    elif field_type == 2:  # Text
+        return forms.CharField(widget=forms.TextInput(), required=required)
+    elif field_type == 3:  # TextArea
+        return forms.CharField(widget=forms.Textarea(), required=required)
+    elif field_type == 4:  # DropDown menu. We need an empty choice here
+        return forms.CharField(widget=forms.Select(choices=get_choices(field, dropdown=True)), required=required)
+    elif field_type == 5:  # MultipleChoice
+        return forms.MultipleChoiceField(choices=get_choices(field), required=required)
+    elif field_type == 6:  # Date
+        return forms.DateField(widget=widgets.AdminDateWidget(), required=required)
+    elif field_type == 7:  # DateTime
+        return forms.SplitDateTimeField(widget=widgets.AdminSplitDateTime(), required=required)
+
+
+def custom_field_initial(field_type, value):
+    """
+    Converts value stored in CustomField values to form field initial
+    """
+    if not value:
+        return value
+    if field_type == 1:
+        return ast.literal_eval(value)
+    if field_type in [6, 7]:
+        from dateutil.parser import parse
+        return parse(value)
+    return value
+
+
 class UserFormChange(UserChangeForm):
+    """
+    Base form for UserAdmin. Use user_form_change_class()
+    to get the form with organization's CustomFields
+    """
+    # {name: field_type} of CustomFields declared on the form class
+    custom_field_types = {}
+
     def __init__(self, *args, **kwargs):
-        """
-        It's overrided because we need prettified
-        representation of CustomFields in UserAdmin
-        """
         super(UserFormChange, self).__init__(*args, **kwargs)
-        self.custom_fields_qs = self.instance.site.organization.custom_fields.all()
-
-        for field in self.custom_fields_qs:
-            field_name, initial = field.name, field.values.get(self.instance.email)
-            field_type, required = field.field_type, field.required
-            # These constants are different, because we need an empty choice for DropDown
-            CHOICES = get_choices(field)
-            DROP_CHOICES = get_choices(field, dropdown=True)
-
-            if field_type == 1:  # Checkbox. We need choices here, so that 'False' value could also be stored in table
-                self.fields[field_name] = forms.CharField(widget=forms.Select(choices=[(True, 'Да'), (False, 'Нет')]),
-                                                          required=required, initial=ast.literal_eval(initial))
-            elif field_type == 2:  # Text
-                self.fields[field_name] = forms.CharField(widget=forms.TextInput(), required=required, initial=initial)
-            elif field_type == 3:  # TextArea
-                self.fields[field_name] = forms.CharField(widget=forms.Textarea(), required=required, initial=initial)
-            elif field_type == 4:  # DropDown menu
-                self.fields[field_name] = forms.CharField(widget=forms.Select(choices=DROP_CHOICES),
-                                                          required=required, initial=initial)
-            elif field_type == 5:  # MultipleChoice
-                self.fields[field_name] = forms.MultipleChoiceField(choices=CHOICES, required=required, initial=initial)
-
-            elif field_type == 6:  # Date
-                if initial:
-                    initial = parse(initial)
-                self.fields[field_name] = forms.DateField(widget=widgets.AdminDateWidget(),
-                                                          required=required, initial=initial)
-            elif field_type == 7:  # DateTime
-                if initial:
-                    initial = parse(initial)
-                self.fields[field_name] = forms.SplitDateTimeField(widget=widgets.AdminSplitDateTime(),
-                                                                   required=required, initial=initial)
+        # Values of custom fields for this user, as they are stored in CustomField values
+        self.custom_values = dict()
+        if self.custom_field_types:
+            qs = self.instance.site.organization.custom_fields.filter(name__in=list(self.custom_field_types))
+            for name, values in qs.values_list('name', 'values'):
+                self.custom_values[name] = values.get(self.instance.email)
+                self.initial[name] = custom_field_initial(self.custom_field_types[name], self.custom_values[name])
 
     def save(self, commit=False):
         instance = super(UserFormChange, self).save(commit=False)
-        for field in self.custom_fields_qs:
-            if self.cleaned_data[field.name]:
-                field.values.update({instance.email: str(self.cleaned_data[field.name])})
-            else:
-                field.values.pop(instance.email, '')  # If we removed field value, remove it from CustomField's values
-            field.save()
+        new_values = dict()
+        for name in self.custom_field_types:
+            value = self.cleaned_data[name]
+            # If we removed field value, remove it from CustomField's values
+            new_values[name] = str(value) if value else None
+
+        # With new email all values are stored under the new key
+        email_changed = 'email' in self.changed_data
+        changed = [name for name in new_values if email_changed or new_values[name] != self.custom_values.get(name)]
+        if changed:
+            for field in instance.site.organization.custom_fields.filter(name__in=changed):
+                if new_values[field.name] is None:
+                    field.values.pop(instance.email, '')
+                else:
+                    field.values.update({instance.email: new_values[field.name]})
+                field.save(update_fields=['values'])
         return instance
+
+
+# {organization id: (schema version, form class)}
+_form_classes = dict()
+
+
+def user_form_change_class(organization):
+    """
+    :return: UserFormChange subclass with CustomFields of the organization.
+    Classes are built once per process and rebuilt when the schema changes,
+    so instances only bind initial values
+    """
+    version = schema_version(organization.id)
+    cached = _form_classes.get(organization.id)
+    if cached and cached[0] == version:
+        return cached[1]
+
+    attrs, field_types = dict(), dict()
+    for field in organization.custom_fields.all():
+        form_field = custom_form_field(field)
+        if form_field is not None:
+            attrs[field.name] = form_field
+            field_types[field.name] = field.field_type
+    attrs['custom_field_types'] = field_types
+    form_class = type(str('UserFormChange'), (UserFormChange,), attrs)
+    _form_classes[organization.id] = (version, form_class)
+    return form_class
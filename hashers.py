@@ -0,0 +1,145 @@
+"""
+Password hashers with the cost calibrated for the host.
+
+The calibrate_password_hashers command measures PBKDF2, Argon2 and bcrypt
+(the ones whose libraries are installed) and prints USER_PASSWORD_COST
+and USER_PASSWORD_BULK_COST for the target time of one hash:
+
+    PASSWORD_HASHERS = [
+        'user.hashers.CalibratedPBKDF2PasswordHasher',
+        'user.hashers.CalibratedArgon2PasswordHasher',
+        'user.hashers.CalibratedBCryptSHA256PasswordHasher',
+    ]
+    USER_PASSWORD_COST = {'pbkdf2_sha256': {'iterations': 120000}}
+    USER_PASSWORD_BULK_COST = {'pbkdf2_sha256': {'iterations': 12000}}
+
+Algorithm names are Django's, so existing hashes are verified as before.
+Hashes with another cost report must_update(), and Django rehashes them
+on the next successful login (ModelBackend.authenticate -> check_password).
+Accounts created in bulk (register_bulk) are hashed with the bulk cost,
+which is cheaper, and get the full cost on their first login this way.
+"""
+import math
+import time
+
+from django.contrib.auth.hashers import PBKDF2PasswordHasher, Argon2PasswordHasher, BCryptSHA256PasswordHasher, \
+    get_hasher
+
+from .conf import app_settings
+
+
+class CalibratedHasherMixin(object):
+    """
+    Takes the cost parameters of the algorithm from USER_PASSWORD_COST,
+    or from USER_PASSWORD_BULK_COST for the 'bulk' profile
+    """
+    cost_names = []
+
+    def __init__(self, profile='default', costs=None):
+        self.profile = profile
+        # Explicit parameters, for calibration
+        self.costs = costs
+
+    def cost(self, name, default):
+        costs = self.costs
+        if costs is None:
+            profiles = app_settings.PASSWORD_BULK_COST if self.profile == 'bulk' else app_settings.PASSWORD_COST
+            costs = profiles.get(self.algorithm, {})
+            if self.profile == 'bulk' and not costs:
+                costs = app_settings.PASSWORD_COST.get(self.algorithm, {})
+        return costs.get(name, default)
+
+    def get_costs(self):
+        return {name: getattr(self, name) for name in self.cost_names}
+
+
+class CalibratedPBKDF2PasswordHasher(CalibratedHasherMixin, PBKDF2PasswordHasher):
+    cost_names = ['iterations']
+
+    @property
+    def iterations(self):
+        return self.cost('iterations', PBKDF2PasswordHasher.iterations)
+
+
+class CalibratedArgon2PasswordHasher(CalibratedHasherMixin, Argon2PasswordHasher):
+    cost_names = ['time_cost', 'memory_cost', 'parallelism']
+
+    @property
+    def time_cost(self):
+        return self.cost('time_cost', Argon2PasswordHasher.time_cost)
+
+    @property
+    def memory_cost(self):
+        return self.cost('memory_cost', Argon2PasswordHasher.memory_cost)
+
+    @property
+    def parallelism(self):
+        return self.cost('parallelism', Argon2PasswordHasher.parallelism)
+
+
+class CalibratedBCryptSHA256PasswordHasher(CalibratedHasherMixin, BCryptSHA256PasswordHasher):
+    cost_names = ['rounds']
+
+    @property
+    def rounds(self):
+        return self.cost('rounds', BCryptSHA256PasswordHasher.rounds)
+
+
+CALIBRATED_HASHERS = [CalibratedPBKDF2PasswordHasher, CalibratedArgon2PasswordHasher,
+                      CalibratedBCryptSHA256PasswordHasher]
+
+
+def bulk_hasher():
+    """
+    :return: the preferred hasher with the bulk cost, for accounts created in bulk
+    """
+    hasher = get_hasher('default')
+    if isinstance(hasher, CalibratedHasherMixin):
+        return hasher.__class__(profile='bulk')
+    return hasher
+
+
+def is_available(hasher_class):
+    if hasher_class.library is None:
+        return True
+    try:
+        hasher_class()._load_library()
+    except ValueError:
+        return False
+    return True
+
+
+def time_hash(hasher, repeat=3):
+    """
+    :return: seconds of the fastest of the hashes
+    """
+    best = None
+    for i in range(repeat):
+        salt = hasher.salt()
+        start = time.perf_counter()
+        hasher.encode('calibration password', salt)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def calibrate(hasher_class, seconds):
+    """
+    Scales the work parameter of the algorithm from a measured hash:
+    PBKDF2 iterations and Argon2 time_cost linearly, bcrypt rounds by powers of 2
+    (Argon2 memory_cost and parallelism keep Django defaults)
+    :return: cost parameters, with which one hash takes about the seconds
+    """
+    hasher = hasher_class(costs={})
+    elapsed = time_hash(hasher)
+    if hasher_class is CalibratedPBKDF2PasswordHasher:
+        iterations = hasher.iterations * seconds / elapsed
+        # Rounded to thousands, as Django's defaults are
+        return {'iterations': max(1000, int(round(iterations, -3)))}
+    if hasher_class is CalibratedArgon2PasswordHasher:
+        return {'time_cost': max(1, int(round(hasher.time_cost * seconds / elapsed))),
+                'memory_cost': hasher.memory_cost, 'parallelism': hasher.parallelism}
+    if hasher_class is CalibratedBCryptSHA256PasswordHasher:
+        # bcrypt accepts 4..31 rounds
+        return {'rounds': min(31, max(4, int(round(hasher.rounds + math.log(seconds / elapsed, 2)))))}
+    raise ValueError('Unknown hasher')
@@ -0,0 +1,47 @@
+"""
+Invitations replace generated passwords for users created by somebody else.
+User is created with unusable password, and gets a signed one-time link,
+so the password is hashed only once, when the user sets it.
+"""
+import uuid
+
+from django.core import signing
+from django.utils import timezone
+
+from .conf import app_settings
+from .models import Invitation
+
+SALT = 'user.invitation'
+
+
+def invitation_url(site, token):
+    return app_settings.INVITATION_URL.format(domain=site.domain, token=token)
+
+
+def create_invitations(users):
+    """
+    :return: dict of {user id: token}
+    """
+    invitations = [Invitation(user_id=user.id, key=uuid.uuid4().hex) for user in users]
+    Invitation.objects.bulk_create(invitations)
+    signer = signing.TimestampSigner(salt=SALT)
+    return {invitation.user_id: signer.sign(invitation.key) for invitation in invitations}
+
+
+def accept_invitation(token):
+    """
+    Uses the invitation up. All other invitations of the user expire too.
+    :return: invited User or None, if the token is invalid, expired or used
+    """
+    try:
+        key = signing.TimestampSigner(salt=SALT).unsign(token, max_age=app_settings.INVITATION_DAYS * 24 * 60 * 60)
+    except signing.BadSignature:  # SignatureExpired is BadSignature too
+        return None
+
+    invitation = Invitation.objects.select_related('user').filter(key=key, used_at__isnull=True).first()
+    if invitation is None:
+        return None
+    # Conditional update makes concurrent use of the same token impossible
+    if not Invitation.objects.filter(user=invitation.user_id, used_at__isnull=True).update(used_at=timezone.now()):
+        return None
+    return invitation.user
@@ -0,0 +1,175 @@
+"""
+Bulk mailing to a segment of users.
+
+Recipients are selected by role, group, tag and custom field value,
+unsubscribed and inactive users are filtered out in SQL and streamed
+with iterator() (a server-side cursor on PostgreSQL). The body template
+is compiled once per mailing and rendered for every recipient.
+
+Messages are sent in batches of USER_MAILING_BATCH_SIZE over one
+connection, at most USER_MAILING_RATE per second. Mailing.last_user_id
+is saved after every batch, so an interrupted mailing is continued
+by the send_mailings command from the next recipient (only the batch
+in flight at the moment of the crash may be sent twice).
+"""
+import json
+import logging
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.mail import EmailMessage, get_connection
+from django.db.models import F, Q
+from django.template import engines, TemplateSyntaxError
+from django.utils import timezone
+
+from . import tasks
+from .conf import app_settings
+from .models import User, Mailing
+
+logger = logging.getLogger(__name__)
+
+# Loaded for every recipient, and available in the body as {{ user.<name> }}
+MAILING_USER_FIELDS = ['email', 'first_name', 'last_name', 'middle_name', 'role', 'unsubscribe_code']
+
+
+def clean_segment(site, data):
+    """
+    :param data: dict with optional role, group, tag and custom_field: [name, value]
+    :return: segment to store in Mailing
+    """
+    segment = dict()
+    if data.get('role'):
+        if data['role'] not in dict(User.ROLE_TYPES):
+            raise ValueError('Unknown role')
+        segment['role'] = data['role']
+    if data.get('group'):
+        segment['group'] = int(data['group'])
+    if data.get('tag'):
+        segment['tag'] = int(data['tag'])
+    if data.get('custom_field'):
+        name, value = data['custom_field']
+        if not site.organization.custom_fields.filter(name=name).exists():
+            raise ValueError('Unknown custom field')
+        segment['custom_field'] = [name, str(value)]
+    return segment
+
+
+def segment_queryset(site, segment):
+    """
+    :return: active subscribed users of the site in the segment
+    """
+    qs = User.objects.filter(site=site, is_active=True, is_unsubscribed=False)
+    if segment.get('role'):
+        qs = qs.filter(role=segment['role'])
+    if segment.get('group'):
+        qs = qs.filter(groups__id=segment['group'])
+    if segment.get('tag'):
+        qs = qs.filter(tags__id=segment['tag'])
+    if segment.get('custom_field'):
+        name, value = segment['custom_field']
+        # Values of custom fields are stored by email in CustomField
+        values = site.organization.custom_fields.get(name=name).values
+        qs = qs.filter(email__in=[email for email, user_value in values.items() if user_value == value])
+    return qs.distinct()
+
+
+def compile_body(body):
+    # Emails are plain text, so values are not HTML-escaped
+    return engines['django'].from_string('{% autoescape off %}' + body + '{% endautoescape %}')
+
+
+def template_user(user):
+    """
+    The body is written by site admins, so it gets plain values,
+    not the User, which reaches related objects and runs queries
+    :return: dict of the user fields available in the body
+    """
+    context = {name: getattr(user, name) for name in MAILING_USER_FIELDS if name != 'unsubscribe_code'}
+    context.update(full_name=user.full_name, short_name=user.short_name)
+    return context
+
+
+def unsubscribe_url(site, user):
+    return app_settings.UNSUBSCRIBE_URL.format(domain=site.domain, code=user.unsubscribe_code)
+
+
+def start_mailing(site, user, subject, body, segment):
+    """
+    :return: Mailing, which is sent in the background
+    """
+    try:
+        compile_body(body)
+    except TemplateSyntaxError as e:
+        raise ValueError(str(e))
+    mailing = Mailing.objects.create(site=site, created_by=user if user and user.is_authenticated() else None,
+                                     subject=subject, body=body, segment=json.dumps(segment),
+                                     recipients=segment_queryset(site, segment).count())
+    tasks.submit_to('mailings', send_mailing, mailing.id)
+    return mailing
+
+
+def claim_mailing(mailing_id, resume=False):
+    """
+    Marks the mailing as running, unless another worker is sending it.
+    Mailings, which did not progress for USER_MAILING_STALE_SECONDS,
+    and failed ones are claimed with resume=True
+    :return: True if the mailing is claimed
+    """
+    now = timezone.now()
+    q = Q(status='pending')
+    if resume:
+        stale = now - timedelta(seconds=app_settings.MAILING_STALE_SECONDS)
+        q = Q(status__in=['pending', 'running'], updated_at__lt=stale) | Q(status='failed')
+    return bool(Mailing.objects.filter(q, pk=mailing_id).update(status='running', error='', updated_at=now))
+
+
+def send_mailing(mailing_id, resume=False):
+    if not claim_mailing(mailing_id, resume):
+        return
+    mailing = Mailing.objects.select_related('site').get(pk=mailing_id)
+    template = compile_body(mailing.body)
+    qs = segment_queryset(mailing.site, json.loads(mailing.segment)).filter(id__gt=mailing.last_user_id) \
+        .order_by('id').only(*MAILING_USER_FIELDS)
+
+    connection = get_connection()
+    try:
+        connection.open()
+        batch = list()
+        for user in qs.iterator():
+            batch.append(user)
+            if len(batch) == app_settings.MAILING_BATCH_SIZE:
+                send_batch(mailing, template, batch, connection)
+                batch = list()
+        if batch:
+            send_batch(mailing, template, batch, connection)
+    except Exception as e:
+        logger.exception('Mailing %s failed', mailing_id)
+        Mailing.objects.filter(pk=mailing_id).update(status='failed', error=str(e), updated_at=timezone.now())
+        return
+    finally:
+        connection.close()
+    Mailing.objects.filter(pk=mailing_id).update(status='done', finished_at=timezone.now(), updated_at=timezone.now())
+
+
+def send_batch(mailing, template, users, connection):
+    started = time.time()
+    # Users could unsubscribe after the cursor was opened
+    unsubscribed = set(User.objects.filter(id__in=[user.id for user in users], is_unsubscribed=True)
+                       .values_list('id', flat=True))
+    messages = list()
+    for user in users:
+        if user.id in unsubscribed:
+            continue
+        url = unsubscribe_url(mailing.site, user)
+        body = template.render({'user': template_user(user), 'unsubscribe_url': url})
+        messages.append(EmailMessage(mailing.subject, body, settings.DEFAULT_FROM_EMAIL, [user.email],
+                                     headers={'List-Unsubscribe': '<{}>'.format(url)}))
+    sent = connection.send_messages(messages) or 0
+    Mailing.objects.filter(pk=mailing.pk).update(sent=F('sent') + sent, last_user_id=users[-1].id,
+                                                 updated_at=timezone.now())
+
+    if app_settings.MAILING_RATE:
+        delay = len(messages) / app_settings.MAILING_RATE - (time.time() - started)
+        if delay > 0:
+            time.sleep(delay)
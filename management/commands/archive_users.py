@@ -0,0 +1,47 @@
+from django.contrib.sites.models import Site
+from django.core.management.base import BaseCommand
+
+from user.archive import archivable_users, archive_user
+from user.conf import app_settings
+from user.models import User
+
+
+class Command(BaseCommand):
+    help = 'Moves users deactivated longer than USER_ARCHIVE_AFTER_DAYS ago to the archive'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=None,
+                            help='Archive users inactive longer than this number of days')
+        parser.add_argument('--site', type=int, default=None, help='Archive users of this site only')
+        parser.add_argument('--chunk-size', type=int, default=None, help='Users processed per chunk')
+        parser.add_argument('--start-after', type=int, default=0,
+                            help='Resume from the user id printed by an interrupted run')
+        parser.add_argument('--dry-run', action='store_true', help='Only count users to archive')
+
+    def handle(self, *args, **options):
+        site = Site.objects.get(pk=options['site']) if options['site'] else None
+        chunk_size = options['chunk_size'] or app_settings.ARCHIVE_CHUNK_SIZE
+        qs = archivable_users(days=options['days'], site=site)
+
+        if options['dry_run']:
+            self.stdout.write('Users to archive: {}'.format(qs.count()))
+            return
+
+        archived = skipped = 0
+        last_id = options['start_after']
+        while True:
+            # Every user is archived in its own transaction, so an interrupted
+            # run can simply be started again: archived users are gone from qs
+            ids = list(qs.filter(pk__gt=last_id).order_by('pk').values_list('pk', flat=True)[:chunk_size])
+            if not ids:
+                break
+
+            for user in User.objects.filter(pk__in=ids).select_related('site').order_by('pk'):
+                if archive_user(user):
+                    archived += 1
+                else:
+                    skipped += 1
+            last_id = ids[-1]
+            self.stdout.write('Archived: {}, skipped: {}, last id: {}'.format(archived, skipped, last_id))
+
+        self.stdout.write(self.style.SUCCESS('Done. Archived: {}, skipped: {}'.format(archived, skipped)))
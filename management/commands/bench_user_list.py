@@ -0,0 +1,41 @@
+import time
+
+from django.core.management.base import BaseCommand
+from rest_framework.renderers import JSONRenderer
+
+from user.fast_serializers import serialize_users
+from user.models import User
+from user.renderers import FastJSONRenderer
+from user.serializers import UserSerializer
+
+
+class Command(BaseCommand):
+    help = 'Compares users/sec of the user list with UserSerializer and with the values() fast path'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--limit', type=int, default=1000, help='Users in the list')
+        parser.add_argument('--repeat', type=int, default=5, help='Runs of each variant, the best one is shown')
+
+    def handle(self, *args, **options):
+        qs = User.objects.filter(is_active=True).order_by('-id')[:options['limit']]
+
+        def model_path():
+            return JSONRenderer().render(UserSerializer(qs.all(), many=True).data)
+
+        def fast_path():
+            return FastJSONRenderer().render(serialize_users(qs.all()))
+
+        if model_path() != fast_path():
+            self.stderr.write('Warning: outputs of the two variants differ')
+
+        users = qs.count()
+        for title, func in [('UserSerializer + JSONRenderer', model_path),
+                            ('serialize_users + FastJSONRenderer', fast_path)]:
+            best = None
+            for i in range(options['repeat']):
+                start = time.perf_counter()
+                size = len(func())
+                elapsed = time.perf_counter() - start
+                best = elapsed if best is None else min(best, elapsed)
+            self.stdout.write('{}: {:.0f} users/sec ({} users, {} bytes, {:.1f} ms)'.format(
+                title, users / best if best else 0, users, size, best * 1000))
@@ -0,0 +1,38 @@
+import pprint
+
+from django.core.management.base import BaseCommand
+
+from user.hashers import CALIBRATED_HASHERS, calibrate, is_available, time_hash
+
+
+class Command(BaseCommand):
+    help = 'Chooses password hasher costs for the target hash time on this host and reports hashes/sec'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--target-ms', type=float, default=250, help='Time of one hash for logins and '
+                                                                         'registrations, milliseconds')
+        parser.add_argument('--bulk-target-ms', type=float, default=25, help='Time of one hash for accounts '
+                                                                              'created in bulk, milliseconds')
+        parser.add_argument('--benchmark', action='store_true', help='Only report hashes/sec with the current '
+                                                                      'USER_PASSWORD_COST and USER_PASSWORD_BULK_COST')
+
+    def handle(self, *args, **options):
+        profiles = {'default': dict(), 'bulk': dict()}
+        for hasher_class in CALIBRATED_HASHERS:
+            if not is_available(hasher_class):
+                self.stdout.write('{}: library is not installed, skipped'.format(hasher_class.algorithm))
+                continue
+            for profile, target in [('default', options['target_ms']), ('bulk', options['bulk_target_ms'])]:
+                if options['benchmark']:
+                    hasher = hasher_class(profile=profile)
+                else:
+                    hasher = hasher_class(costs=calibrate(hasher_class, target / 1000))
+                    profiles[profile][hasher.algorithm] = hasher.get_costs()
+                elapsed = time_hash(hasher)
+                self.stdout.write('{} {} {}: {:.1f} hashes/sec ({:.1f} ms)'.format(
+                    hasher.algorithm, profile, hasher.get_costs(), 1 / elapsed, elapsed * 1000))
+
+        if not options['benchmark']:
+            self.stdout.write('\nSettings:\n')
+            self.stdout.write('USER_PASSWORD_COST = {}'.format(pprint.pformat(profiles['default'])))
+            self.stdout.write('USER_PASSWORD_BULK_COST = {}'.format(pprint.pformat(profiles['bulk'])))
@@ -0,0 +1,201 @@
+from django.conf import settings
+from django.contrib.sites.models import Site
+from django.core.cache import caches
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.management.base import BaseCommand, CommandError
+from django.core.management.color import no_style
+from django.db import connections, transaction
+
+from user.conf import app_settings
+from user.models import User, Group, Note, Diploma, ArchivedUser, Invitation, ReportJob, Mailing, ChangeEvent
+from user.routers import shard_for_site, set_shard_for_site, sharded_models
+
+
+def site_tables(site_id):
+    """
+    :return: list of (model, queryset of the site's rows) in the order of copying
+    """
+    return [
+        (User, User.objects.filter(site_id=site_id)),
+        (Group, Group.objects.filter(site_id=site_id)),
+        (User.groups.through, User.groups.through.objects.filter(user__site_id=site_id)),
+        (User.tags.through, User.tags.through.objects.filter(user__site_id=site_id)),
+        (User.user_permissions.through, User.user_permissions.through.objects.filter(user__site_id=site_id)),
+        (Note, Note.objects.filter(site_id=site_id)),
+        (Diploma, Diploma.objects.filter(site_id=site_id)),
+        (ArchivedUser, ArchivedUser.objects.filter(site_id=site_id)),
+        (Invitation, Invitation.objects.filter(user__site_id=site_id)),
+        (ReportJob, ReportJob.objects.filter(site_id=site_id)),
+        (Mailing, Mailing.objects.filter(site_id=site_id)),
+        (ChangeEvent, ChangeEvent.objects.filter(site_id=site_id)),
+    ]
+
+
+def blocking_references(tables, source):
+    """
+    Rows of other apps (access requests, payments, course authors...) stay
+    in the source, so they would point to deleted rows after the move
+    :return: list of (relation label, number of rows of other apps, which reference the site's rows)
+    """
+    models = sharded_models()
+    references = list()
+    for model, qs in tables:
+        # Hidden ones too, e.g. Organization.admin has related_name='+'
+        for rel in model._meta.get_fields(include_hidden=True):
+            if not rel.auto_created or rel.concrete or rel.related_model in models:
+                continue
+            if rel.related_model._meta.auto_created:
+                # Through tables of other apps, counted by their ManyToManyField
+                continue
+            count = rel.related_model._base_manager.using(source).filter(
+                **{'{}__in'.format(rel.field.name): qs.using(source).values('pk')}).count()
+            if count:
+                references.append(('{}.{}'.format(rel.related_model._meta.label, rel.field.name), count))
+    return references
+
+
+def missing_references(tables, source, target):
+    """
+    Shared rows (tags, courses...) must be present in the target shard
+    :return: list of (field label, ids of shared rows missing in the target)
+    """
+    models = sharded_models()
+    missing = list()
+    for model, qs in tables:
+        for field in model._meta.concrete_fields:
+            if not field.is_relation or field.related_model in models or field.related_model is Site:
+                continue
+            ids = set(qs.using(source).exclude(**{field.attname: None}).order_by()
+                      .values_list(field.attname, flat=True).distinct())
+            if not ids:
+                continue
+            present = set(field.related_model._base_manager.using(target).filter(pk__in=ids)
+                          .values_list('pk', flat=True))
+            if ids - present:
+                missing.append(('{}.{}'.format(model._meta.label, field.name), sorted(ids - present)))
+    return missing
+
+
+def last_id(alias, model):
+    """
+    :return: last id given out by the autoincrement of the table (MAX(id) where it is unknown)
+    """
+    connection = connections[alias]
+    table, column = model._meta.db_table, model._meta.pk.column
+    with connection.cursor() as cursor:
+        if connection.vendor == 'postgresql':
+            cursor.execute('SELECT pg_get_serial_sequence(%s, %s)', [table, column])
+            cursor.execute('SELECT last_value FROM {}'.format(cursor.fetchone()[0]))
+        elif connection.vendor == 'sqlite':
+            cursor.execute('SELECT seq FROM sqlite_sequence WHERE name = %s', [table])
+        else:
+            cursor.execute('SELECT MAX({}) FROM {}'.format(connection.ops.quote_name(column),
+                                                          connection.ops.quote_name(table)))
+        row = cursor.fetchone()
+    return (row[0] if row else None) or 0
+
+
+def raise_autoincrement(alias, model, value):
+    """
+    Makes the next id of the table greater than the value
+    """
+    if last_id(alias, model) >= value:
+        return
+    connection = connections[alias]
+    table, column = model._meta.db_table, model._meta.pk.column
+    with connection.cursor() as cursor:
+        if connection.vendor == 'postgresql':
+            cursor.execute('SELECT setval(pg_get_serial_sequence(%s, %s), %s)', [table, column, value])
+        elif connection.vendor == 'sqlite':
+            cursor.execute('UPDATE sqlite_sequence SET seq = %s WHERE name = %s', [value, table])
+            if not cursor.rowcount:
+                cursor.execute('INSERT INTO sqlite_sequence (name, seq) VALUES (%s, %s)', [table, value])
+        elif connection.vendor == 'mysql':
+            cursor.execute('ALTER TABLE {} AUTO_INCREMENT = {:d}'.format(connection.ops.quote_name(table), value + 1))
+
+
+class Command(BaseCommand):
+    help = 'Moves user app data of the site to another shard (database alias)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('site', type=int, help='Site id')
+        parser.add_argument('alias', help='Target database alias from USER_SHARDS')
+        parser.add_argument('--chunk-size', type=int, default=None, help='Rows copied per chunk')
+        parser.add_argument('--keep-source', action='store_true', help='Do not delete data from the old shard')
+
+    def handle(self, *args, **options):
+        site_id, target = options['site'], options['alias']
+        if target not in settings.DATABASES or target not in app_settings.SHARDS:
+            raise CommandError('Unknown shard {}'.format(target))
+        # The shard map is switched in the cache, web processes must see it
+        if isinstance(caches['default'], LocMemCache):
+            raise CommandError('The default cache is local to the process, web processes would not see '
+                               'the moved site. Use a cache shared by the processes, see user.routers')
+        source = shard_for_site(site_id)
+        if source == target:
+            raise CommandError('Site {} is already in {}'.format(site_id, target))
+        chunk_size = options['chunk_size'] or app_settings.SHARD_MOVE_CHUNK_SIZE
+
+        # Moving is safe to restart: rows already copied are skipped,
+        # and the shard map is switched only after the source is deleted.
+        # Writes of the site should be stopped while it is being moved.
+        tables = site_tables(site_id)
+        errors = ['{} rows of {} reference the site'.format(count, label)
+                  for label, count in blocking_references(tables, source)]
+        errors += ['{} references rows missing in {}: {}'.format(label, target, ', '.join(map(str, ids[:10])))
+                   for label, ids in missing_references(tables, source, target)]
+        if errors:
+            raise CommandError('Site {} can not be moved:\n{}'.format(site_id, '\n'.join(errors)))
+
+        site = Site.objects.using(source).get(pk=site_id)
+        if not Site.objects.using(target).filter(pk=site_id).exists():
+            site.save(using=target)
+
+        for model, qs in tables:
+            copied = self.copy(model, qs, source, target, chunk_size)
+            self.stdout.write('{}: copied {}'.format(model._meta.label, copied))
+
+        with connections[target].cursor() as cursor:
+            for sql in connections[target].ops.sequence_reset_sql(no_style(), [model for model, qs in tables]):
+                cursor.execute(sql)
+        # ChangeEvent ids are the cursors of the changes feed: new events of the site
+        # must get ids above everything consumers could have read from the source
+        raise_autoincrement(target, ChangeEvent, last_id(source, ChangeEvent))
+
+        if not options['keep_source']:
+            # Dependent rows first, all or nothing: if anything references
+            # the rows, the site stays in the source.
+            # Raw delete skips signals, so the custom field values of moved users are kept
+            with transaction.atomic(using=source):
+                for model, qs in reversed(tables):
+                    deleted = self.delete(qs, source, chunk_size)
+                    self.stdout.write('{}: deleted {} from {}'.format(model._meta.label, deleted, source))
+
+        set_shard_for_site(site_id, target)
+        self.stdout.write(self.style.SUCCESS('Site {} is now served from {}'.format(site_id, target)))
+
+    def copy(self, model, qs, source, target, chunk_size):
+        copied, last_pk = 0, None
+        while True:
+            chunk = qs.using(source).order_by('pk')
+            if last_pk is not None:
+                chunk = chunk.filter(pk__gt=last_pk)
+            rows = list(chunk[:chunk_size])
+            if not rows:
+                return copied
+
+            pks = [row.pk for row in rows]
+            existing = set(model._default_manager.using(target).filter(pk__in=pks).values_list('pk', flat=True))
+            with transaction.atomic(using=target):
+                model._default_manager.using(target).bulk_create([row for row in rows if row.pk not in existing])
+            copied += len(rows) - len(existing)
+            last_pk = pks[-1]
+
+    def delete(self, qs, source, chunk_size):
+        deleted = 0
+        while True:
+            pks = list(qs.using(source).order_by('pk').values_list('pk', flat=True)[:chunk_size])
+            if not pks:
+                return deleted
+            qs.model._default_manager.using(source).filter(pk__in=pks)._raw_delete(source)
+            deleted += len(pks)
@@ -0,0 +1,40 @@
+from django.core.management.base import BaseCommand
+from django.db.models import Count, Func
+from django.db.models.functions import Lower
+
+from user.models import User
+
+
+def normalized_email():
+    """
+    :return: SQL expression of user.models.normalize_email
+    """
+    return Lower(Func('email', function='TRIM'))
+
+
+class Command(BaseCommand):
+    help = 'Fills User.email_normalized for users created before it was added'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=1000, help='Users updated per query')
+
+    def handle(self, *args, **options):
+        # Emails differing only in case or spaces can't both get the normalized value,
+        # they are left empty and printed to be merged by hand
+        duplicates = User.objects.annotate(lower=normalized_email()).values('site', 'lower') \
+            .annotate(count=Count('id')).filter(count__gt=1)
+        skipped = set()
+        for row in duplicates:
+            self.stdout.write('Site {}: several users with email {}'.format(row['site'], row['lower']))
+            skipped.update(User.objects.annotate(lower=normalized_email())
+                           .filter(site=row['site'], lower=row['lower']).values_list('id', flat=True))
+
+        qs = User.objects.filter(email_normalized__isnull=True).exclude(id__in=skipped)
+        updated, last_id = 0, 0
+        while True:
+            ids = list(qs.filter(id__gt=last_id).order_by('id').values_list('id', flat=True)[:options['chunk_size']])
+            if not ids:
+                break
+            updated += User.objects.filter(id__in=ids).update(email_normalized=normalized_email())
+            last_id = ids[-1]
+        self.stdout.write(self.style.SUCCESS('Updated {} users, skipped {}'.format(updated, len(skipped))))
@@ -0,0 +1,19 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from user.conf import app_settings
+from user.changes import purge_changes
+
+
+class Command(BaseCommand):
+    help = 'Deletes change feed events older than USER_CHANGES_TTL'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--seconds', type=int, default=None, help='Delete events older than this number of seconds')
+
+    def handle(self, *args, **options):
+        seconds = options['seconds'] if options['seconds'] is not None else app_settings.CHANGES_TTL
+        deleted = purge_changes(timezone.now() - timedelta(seconds=seconds))
+        self.stdout.write('Deleted events: {}'.format(deleted))
@@ -0,0 +1,22 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from user.conf import app_settings
+from user.reports import purge_reports, fail_stale_reports
+
+
+class Command(BaseCommand):
+    help = 'Deletes background report jobs and their files older than USER_REPORT_TTL, ' \
+           'marks failed jobs orphaned by a restart'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--seconds', type=int, default=None, help='Delete jobs older than this number of seconds')
+
+    def handle(self, *args, **options):
+        failed = fail_stale_reports()
+        self.stdout.write('Failed stale reports: {}'.format(failed))
+        seconds = options['seconds'] if options['seconds'] is not None else app_settings.REPORT_TTL
+        deleted = purge_reports(timezone.now() - timedelta(seconds=seconds))
+        self.stdout.write('Deleted reports: {}'.format(deleted))
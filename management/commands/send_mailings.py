@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand
+
+from user.mailing import send_mailing
+from user.models import Mailing
+
+
+class Command(BaseCommand):
+    help = 'Continues mailings interrupted by a crash or failed, from the next recipient'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--mailing', type=int, default=None, help='Continue only this mailing')
+
+    def handle(self, *args, **options):
+        qs = Mailing.objects.exclude(status='done').order_by('id')
+        if options['mailing']:
+            qs = qs.filter(pk=options['mailing'])
+
+        # Mailings, which are still being sent by a worker, are not claimed
+        for mailing_id in qs.values_list('id', flat=True):
+            send_mailing(mailing_id, resume=True)
+            mailing = Mailing.objects.get(pk=mailing_id)
+            self.stdout.write('{}: {} ({} of {} sent)'.format(mailing.subject, mailing.get_status_display(),
+                                                             mailing.sent, mailing.recipients))
@@ -5,10 +5,62 @@ from django.core.mail import send_mail
 from django.contrib.sites.managers import CurrentSiteManager
 from django.contrib.sites.models import Site
 from django.contrib.auth.models import BaseUserManager, AbstractBaseUser, PermissionsMixin
-from django.db import models
+from django.db import models, router, transaction
 from django.utils import timezone
 
-from email_validator import validate_email
+
+class UpdatedAtField(models.DateTimeField):
+    """
+    Like auto_now DateTimeField, but with a default,
+    so that fixtures without this field still load
+    """
+    def __init__(self, *args, **kwargs):
+        kwargs.setdefault('default', timezone.now)
+        kwargs.setdefault('editable', False)
+        kwargs.setdefault('blank', True)
+        super(UpdatedAtField, self).__init__(*args, **kwargs)
+
+    def pre_save(self, model_instance, add):
+        value = timezone.now()
+        setattr(model_instance, self.attname, value)
+        return value
+
+
+def normalize_email(email):
+    """
+    :return: email in the form it is unique in, within a site
+    """
+    return email.strip().lower() if email else email
+
+
+class AtomicSaveMixin(object):
+    """
+    Saves in a transaction together with post_save receivers, so the change
+    outbox (see user.changes) is written in the same transaction as the change.
+    Model.delete() and m2m changes send their signals in a transaction already
+    """
+    def save(self, *args, **kwargs):
+        using = kwargs.get('using') or router.db_for_write(self.__class__, instance=self)
+        with transaction.atomic(using=using):
+            super(AtomicSaveMixin, self).save(*args, **kwargs)
+
+
+class NormalizedEmailField(models.CharField):
+    """
+    Lowercase copy of the user's email, set on save and bulk_create
+    (raw saves are handled in user.signals). Unique together with site,
+    so emails differing only in case can't be registered twice
+    """
+    def __init__(self, *args, **kwargs):
+        kwargs.setdefault('max_length', 255)
+        kwargs.setdefault('editable', False)
+        kwargs.setdefault('null', True)
+        super(NormalizedEmailField, self).__init__(*args, **kwargs)
+
+    def pre_save(self, model_instance, add):
+        value = normalize_email(model_instance.email)
+        setattr(model_instance, self.attname, value)
+        return value
 
 
 class UserManager(BaseUserManager):
@@ -47,7 +99,7 @@ class UserManager(BaseUserManager):
         return self._create_user(email, password, Site.objects.first(), True, True, **extra_fields)
 
 
-class User(AbstractBaseUser, PermissionsMixin):
+class User(AtomicSaveMixin, AbstractBaseUser, PermissionsMixin):
     ROLE_TYPES = [
         ['student', 'Ученик'],
         ['teacher', 'Преподаватель'],
@@ -79,6 +131,7 @@ class User(AbstractBaseUser, PermissionsMixin):
     middle_name = models.CharField(verbose_name='Отчество', max_length=30, blank=True)
     avatar = models.ImageField(verbose_name='Аватар', blank=True)
     email = models.EmailField(verbose_name='Электронная почта', max_length=255)
+    email_normalized = NormalizedEmailField(verbose_name='Электронная почта в нижнем регистре')
     role = models.CharField(verbose_name='Роль', max_length=20, choices=ROLE_TYPES, default=ROLE_TYPES[0][0])
     groups = models.ManyToManyField('user.Group', verbose_name='Группы', related_name='users', blank=True)
 
@@ -100,6 +153,8 @@ class User(AbstractBaseUser, PermissionsMixin):
     is_paid = models.BooleanField(verbose_name='Оплачен', default=True)
     is_approved = models.BooleanField(verbose_name='Подтверждён', default=False)
     registered_at = models.DateTimeField(verbose_name='Зарегистрирован', default=timezone.now)
+    deactivated_at = models.DateTimeField(verbose_name='Деактивирован', blank=True, null=True)
+    updated_at = UpdatedAtField(verbose_name='Дата изменения')
 
     unsubscribe_code = models.UUIDField(default=uuid.uuid4, editable=False)
     is_unsubscribed = models.BooleanField(verbose_name='Отписка', default=False)
@@ -111,7 +166,7 @@ class User(AbstractBaseUser, PermissionsMixin):
     on_site = CurrentSiteManager()
 
     class Meta:
-        unique_together = ['site', 'email']
+        unique_together = [['site', 'email'], ['site', 'email_normalized']]
         verbose_name = 'Пользователь'
         verbose_name_plural = 'Пользователи'
 
@@ -142,16 +197,31 @@ class User(AbstractBaseUser, PermissionsMixin):
         Sends an email to this User.
         """
         try:
+            # Imported here, email_validator loads DNS resolver modules
+            from email_validator import validate_email
             validate_email(self.email, check_deliverability=True)
             send_mail(subject, message, from_email, [self.email], **kwargs)
         except:
             pass
 
+    def get_session_auth_hash(self):
+        if getattr(self, '_from_snapshot', False) and 'password' in self.get_deferred_fields():
+            # The snapshot keeps the hash instead of the password
+            return self._session_auth_hash
+        return super(User, self).get_session_auth_hash()
+
+    def refresh_from_db(self, using=None, fields=None):
+        if fields and getattr(self, '_from_snapshot', False):
+            # User from the authentication snapshot (see user.authentication)
+            # loads all deferred fields at once, not one query per field
+            fields = set(fields) | self.get_deferred_fields()
+        super(User, self).refresh_from_db(using, fields)
+
     def __str__(self):
         return '({}) - {} - {}'.format(self.site.domain, self.email, self.full_name)
 
 
-class Group(models.Model):
+class Group(AtomicSaveMixin, models.Model):
     site = models.ForeignKey(Site, verbose_name='Сайт')
     author = models.ForeignKey(settings.AUTH_USER_MODEL, verbose_name='Создатель', blank=True, null=True, on_delete=models.SET_NULL)
     title = models.CharField(verbose_name='Название группы', max_length=60)
@@ -164,6 +234,7 @@ class Group(models.Model):
     duration = models.PositiveSmallIntegerField(verbose_name='Продолжительность доступа', default=30)
 
     created_at = models.DateTimeField(verbose_name='Дата создания', auto_now_add=True)
+    updated_at = UpdatedAtField(verbose_name='Дата изменения')
 
     objects = models.Manager()
     on_site = CurrentSiteManager()
@@ -177,11 +248,12 @@ class Group(models.Model):
         verbose_name_plural = 'Группы'
 
 
-class Diploma(models.Model):
+class Diploma(AtomicSaveMixin, models.Model):
     site = models.ForeignKey(Site, verbose_name='Сайт')
     user = models.ForeignKey(settings.AUTH_USER_MODEL, verbose_name='Владелец', blank=True, null=True, on_delete=models.SET_NULL)
     description = models.CharField(verbose_name='Доп. информация', max_length=155, blank=True)
     image = models.ImageField(verbose_name='Изображение', blank=True)
+    updated_at = UpdatedAtField(verbose_name='Дата изменения')
 
     objects = models.Manager()
     on_site = CurrentSiteManager()
@@ -194,7 +266,7 @@ class Diploma(models.Model):
         verbose_name_plural = 'Дипломы'
 
 
-class Note(models.Model):
+class Note(AtomicSaveMixin, models.Model):
     TYPES = [
         ['Клинический диагноз', 'Клинический диагноз'],
         ['Жалобы', 'Жалобы'],
@@ -209,6 +281,7 @@ class Note(models.Model):
     title = models.CharField(verbose_name='Заголовок', max_length=60, blank=True, null=True)
     text = models.TextField(verbose_name='Текст записи', blank=True, null=True)
     created_at = models.DateTimeField(verbose_name='Дата создания', auto_now_add=True)
+    updated_at = UpdatedAtField(verbose_name='Дата изменения')
 
     objects = models.Manager()
     on_site = CurrentSiteManager()
@@ -219,3 +292,179 @@ class Note(models.Model):
     class Meta:
         verbose_name = 'Запись о пользователе'
         verbose_name_plural = 'Записи о пользователях'
+
+
+class Invitation(models.Model):
+    """
+    One-time invitation to set a password, see user.invitations
+    """
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, verbose_name='Пользователь', related_name='invitations',
+                             on_delete=models.CASCADE)
+    key = models.CharField(verbose_name='Ключ', max_length=32, unique=True)
+    created_at = models.DateTimeField(verbose_name='Дата создания', auto_now_add=True)
+    used_at = models.DateTimeField(verbose_name='Дата использования', blank=True, null=True)
+
+    def __str__(self):
+        return str(self.user_id)
+
+    class Meta:
+        verbose_name = 'Приглашение'
+        verbose_name_plural = 'Приглашения'
+
+
+class SiteShard(models.Model):
+    """
+    Database alias, which stores user app data of the site.
+    Sites without SiteShard live in 'default', see user.routers.SiteShardRouter
+    """
+    site = models.OneToOneField(Site, verbose_name='Сайт', related_name='shard')
+    alias = models.CharField(verbose_name='База данных', max_length=50)
+
+    def __str__(self):
+        return '{} - {}'.format(self.site.domain, self.alias)
+
+    class Meta:
+        verbose_name = 'Шард сайта'
+        verbose_name_plural = 'Шарды сайтов'
+
+
+class ArchivedUser(models.Model):
+    """
+    Deactivated User moved out of the User table by archive_users command.
+    Profile, groups, tags, custom field values, notes and diplomas
+    are kept in 'data' as compact JSON, see user.archive
+    """
+    site = models.ForeignKey(Site, verbose_name='Сайт', related_name='archived_users')
+    original_id = models.PositiveIntegerField(verbose_name='ID пользователя')
+    email = models.EmailField(verbose_name='Электронная почта', max_length=255)
+    full_name = models.CharField(verbose_name='Полное имя', max_length=100)
+    data = models.TextField(verbose_name='Данные')
+    archived_at = models.DateTimeField(verbose_name='Дата архивации', auto_now_add=True)
+
+    objects = models.Manager()
+    on_site = CurrentSiteManager()
+
+    def __str__(self):
+        return '({}) - {}'.format(self.site.domain, self.email)
+
+    class Meta:
+        index_together = ['site', 'email']
+        verbose_name = 'Архивный пользователь'
+        verbose_name_plural = 'Архивные пользователи'
+
+
+class ReportJob(models.Model):
+    """
+    Report built in the background, see user.reports
+    """
+    STATUS_CHOICES = (
+        ('pending', 'В очереди'),
+        ('running', 'Формируется'),
+        ('done', 'Готов'),
+        ('failed', 'Ошибка'),
+    )
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    site = models.ForeignKey(Site, verbose_name='Сайт', related_name='report_jobs')
+    created_by = models.ForeignKey(settings.AUTH_USER_MODEL, verbose_name='Автор', related_name='report_jobs',
+                                   blank=True, null=True, on_delete=models.SET_NULL)
+    kind = models.CharField(verbose_name='Отчет', max_length=20)
+    params = models.TextField(verbose_name='Параметры')
+    # Hash of site, kind, params and site data version, identical jobs share it
+    key = models.CharField(verbose_name='Ключ', max_length=64, db_index=True)
+    status = models.CharField(verbose_name='Статус', max_length=10, choices=STATUS_CHOICES, default='pending')
+    progress = models.PositiveSmallIntegerField(verbose_name='Прогресс, %', default=0)
+    file = models.FileField(verbose_name='Файл', upload_to='reports', blank=True)
+    # Input file of the report (diploma template), deleted when the job is finished
+    upload = models.FileField(verbose_name='Загруженный файл', upload_to='reports/uploads', blank=True)
+    error = models.TextField(verbose_name='Ошибка', blank=True)
+    created_at = models.DateTimeField(verbose_name='Дата создания', auto_now_add=True)
+    # Heartbeat of the worker, jobs of crashed workers stop updating it
+    updated_at = UpdatedAtField(verbose_name='Дата изменения')
+    finished_at = models.DateTimeField(verbose_name='Дата завершения', blank=True, null=True)
+
+    objects = models.Manager()
+    on_site = CurrentSiteManager()
+
+    def __str__(self):
+        return '{} - {}'.format(self.kind, self.created_at)
+
+    class Meta:
+        verbose_name = 'Отчет'
+        verbose_name_plural = 'Отчеты'
+
+
+class Mailing(models.Model):
+    """
+    Email to a segment of users, sent in the background, see user.mailing
+    """
+    STATUS_CHOICES = (
+        ('pending', 'В очереди'),
+        ('running', 'Отправляется'),
+        ('done', 'Отправлена'),
+        ('failed', 'Ошибка'),
+    )
+
+    site = models.ForeignKey(Site, verbose_name='Сайт', related_name='mailings')
+    created_by = models.ForeignKey(settings.AUTH_USER_MODEL, verbose_name='Автор', related_name='mailings',
+                                   blank=True, null=True, on_delete=models.SET_NULL)
+    subject = models.CharField(verbose_name='Тема', max_length=255)
+    # Django template, rendered for every recipient with 'user' (fields from user.mailing.template_user)
+    # and 'unsubscribe_url'
+    body = models.TextField(verbose_name='Текст')
+    # JSON with role, group, tag and custom_field: [name, value]
+    segment = models.TextField(verbose_name='Получатели', default='{}')
+    status = models.CharField(verbose_name='Статус', max_length=10, choices=STATUS_CHOICES, default='pending')
+    recipients = models.PositiveIntegerField(verbose_name='Получателей', default=0)
+    sent = models.PositiveIntegerField(verbose_name='Отправлено', default=0)
+    # Id of the last user of the last sent batch, the run is resumed after it
+    last_user_id = models.PositiveIntegerField(verbose_name='Последний получатель', default=0)
+    error = models.TextField(verbose_name='Ошибка', blank=True)
+    created_at = models.DateTimeField(verbose_name='Дата создания', auto_now_add=True)
+    updated_at = UpdatedAtField(verbose_name='Дата изменения')
+    finished_at = models.DateTimeField(verbose_name='Дата завершения', blank=True, null=True)
+
+    objects = models.Manager()
+    on_site = CurrentSiteManager()
+
+    def __str__(self):
+        return self.subject
+
+    class Meta:
+        verbose_name = 'Рассылка'
+        verbose_name_plural = 'Рассылки'
+
+
+class ChangeEvent(models.Model):
+    """
+    Outbox of changes of users, groups, memberships, notes and diplomas,
+    read by downstream systems from users/changes/, see user.changes
+    """
+    ACTION_CHOICES = (
+        ('created', 'Создан'),
+        ('updated', 'Изменен'),
+        ('deleted', 'Удален'),
+        ('added', 'Добавлен в группу'),
+        ('removed', 'Исключен из группы'),
+    )
+
+    # Cursor of the feed
+    id = models.BigAutoField(primary_key=True)
+    site = models.ForeignKey(Site, verbose_name='Сайт', related_name='change_events')
+    object_type = models.CharField(verbose_name='Тип объекта', max_length=20)
+    object_id = models.PositiveIntegerField(verbose_name='Id объекта')
+    action = models.CharField(verbose_name='Действие', max_length=10, choices=ACTION_CHOICES)
+    # Compact JSON with the changed object's fields, see user.changes.EVENT_FIELDS
+    data = models.TextField(verbose_name='Данные', default='{}')
+    created_at = models.DateTimeField(verbose_name='Дата создания', auto_now_add=True, db_index=True)
+
+    objects = models.Manager()
+    on_site = CurrentSiteManager()
+
+    def __str__(self):
+        return '{} {} {}'.format(self.object_type, self.object_id, self.action)
+
+    class Meta:
+        index_together = [['site', 'id']]
+        verbose_name = 'Изменение'
+        verbose_name_plural = 'Изменения'
@@ -0,0 +1,85 @@
+from django.conf import settings
+from django.contrib.sites.models import Site
+from django.core.mail import EmailMessage, get_connection
+from django.template.loader import render_to_string
+
+from .conf import app_settings
+from .models import User
+
+
+def new_user_email(site, user, password=None, invitation_url=None):
+    """
+    :return: subject and body of email for new user. Users without
+    password get an invitation link to set it
+    """
+    params = {
+        'address': site.domain + '.grandclass.net',
+        'user': user,
+        'password': password,
+        'invitation_url': invitation_url,
+        'invitation_days': app_settings.INVITATION_DAYS,
+    }
+    if invitation_url:
+        email_body = render_to_string('mail/new_user_invitation.txt', params)
+    elif user.role == 'student':
+        email_body = render_to_string('mail/new_student_registered.txt', params)
+    else:
+        email_body = render_to_string('mail/new_teacher_registered.txt', params)
+    return site.organization.title, email_body
+
+
+def admin_notification_email(site, user):
+    """
+    :return: admin, subject and body of email about new user
+    for organization admin, or None if he is not notified
+    """
+    admin = site.organization.admin
+    if not (admin and site.organization.notify_about_clients):
+        return None
+    if user.role == 'student':
+        email_body = render_to_string('mail/new_user_notification_for_platform_admin.txt', {'user': user})
+        return admin, 'Новый ученик', email_body
+    email_body = render_to_string('mail/new_teacher_notification_for_platform_admin.txt', {'user': user})
+    return admin, 'Новый преподаватель', email_body
+
+
+def registration_messages(site, user, password=None, invitation_url=None):
+    """
+    :return: EmailMessages about new user for himself and for organization admin
+    """
+    subject, email_body = new_user_email(site, user, password, invitation_url)
+    messages = [EmailMessage(subject, email_body, settings.DEFAULT_FROM_EMAIL, [user.email])]
+
+    notification = admin_notification_email(site, user)
+    if notification:
+        admin, subject, email_body = notification
+        messages.append(EmailMessage(subject, email_body, settings.DEFAULT_FROM_EMAIL, [admin.email]))
+    return messages
+
+
+def send_registration_emails(site_id, credentials):
+    """
+    Background task for bulk registration.
+    :param credentials: dict of {user id: {'password': ...} or {'invitation_url': ...}}
+    All emails are sent over one SMTP connection
+    """
+    site = Site.objects.select_related('organization__admin').get(pk=site_id)
+    messages = list()
+    for user in User.objects.filter(id__in=list(credentials)):
+        messages.extend(registration_messages(site, user, **credentials[user.id]))
+    get_connection(fail_silently=True).send_messages(messages)
+
+
+def send_password_reset_emails(invitation_urls):
+    """
+    Background task for batch_reset.
+    :param invitation_urls: dict of {user id: invitation url}
+    """
+    messages = list()
+    for user in User.objects.filter(id__in=list(invitation_urls)):
+        messages.append(EmailMessage(
+            'Новые данные для входа',
+            'Ваш пароль был сброшен, задайте новый пароль по ссылке: {}\n'
+            'Ссылка действительна {} дн.'.format(invitation_urls[user.id], app_settings.INVITATION_DAYS),
+            settings.DEFAULT_FROM_EMAIL, [user.email]))
+    get_connection(fail_silently=True).send_messages(messages)
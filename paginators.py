@@ -0,0 +1,45 @@
+import json
+
+from django.core.paginator import Paginator
+from django.db import connections
+from django.db.models import QuerySet
+from django.utils.functional import cached_property
+from rest_framework.pagination import CursorPagination
+
+from .conf import app_settings
+
+
+class EstimatedCountPaginator(Paginator):
+    """
+    Paginator for huge tables, which uses PostgreSQL planner estimate
+    instead of exact COUNT(*), when the estimate is large enough.
+    Small result sets and other databases get the exact count.
+    """
+    @cached_property
+    def count(self):
+        qs = self.object_list
+        if isinstance(qs, QuerySet) and connections[qs.db].vendor == 'postgresql':
+            estimate = self.estimate_count(qs)
+            if estimate >= app_settings.ESTIMATED_COUNT_THRESHOLD:
+                return estimate
+        return super(EstimatedCountPaginator, self).count
+
+    @staticmethod
+    def estimate_count(qs):
+        sql, params = qs.query.sql_with_params()
+        with connections[qs.db].cursor() as cursor:
+            cursor.execute('EXPLAIN (FORMAT JSON) ' + sql, params)
+            plan = cursor.fetchone()[0]
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+        return int(plan[0]['Plan']['Plan Rows'])
+
+
+class MembersCursorPagination(CursorPagination):
+    """
+    Pages of group members by user id, without COUNT(*) and OFFSET
+    """
+    ordering = 'id'
+
+    def get_page_size(self, request):
+        return app_settings.GROUP_MEMBERS_PAGE_SIZE
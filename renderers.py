@@ -0,0 +1,40 @@
+from rest_framework.renderers import JSONRenderer
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+class FastJSONRenderer(JSONRenderer):
+    """
+    JSONRenderer, which encodes with orjson when it is installed.
+    Output is the same: compact utf-8 JSON, types unknown to orjson
+    (datetimes, decimals, lazy strings...) go through DRF's encoder.
+    Falls back to JSONRenderer for indented or ASCII-only output.
+    """
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if orjson is None or data is None or self.ensure_ascii or not self.compact \
+                or self.get_indent(accepted_media_type, renderer_context or {}) is not None:
+            return super(FastJSONRenderer, self).render(data, accepted_media_type, renderer_context)
+        try:
+            ret = orjson.dumps(data, default=self.encoder_class().default,
+                               option=orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_NON_STR_KEYS)
+        except TypeError:
+            return super(FastJSONRenderer, self).render(data, accepted_media_type, renderer_context)
+        # Same as JSONRenderer: keep the output a strict javascript subset
+        return ret.replace(b'\xe2\x80\xa8', b'\\u2028').replace(b'\xe2\x80\xa9', b'\\u2029')
+
+
+class NDJSONRenderer(FastJSONRenderer):
+    """
+    Newline delimited JSON: one item of a list per line
+    """
+    media_type = 'application/x-ndjson'
+    format = 'ndjson'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if not isinstance(data, list):
+            data = [data]
+        render = super(NDJSONRenderer, self).render
+        return b''.join(render(item, accepted_media_type, renderer_context) + b'\n' for item in data)
@@ -0,0 +1,321 @@
+"""
+Reports and other long jobs built in the background.
+
+A client POSTs report parameters (e.g. to users/export/ or diplomas/batch/)
+and gets a ReportJob id. A worker of the 'reports' pool builds the file
+in chunks, stores it in the default file storage and updates the job progress.
+The client polls reports/{id}/ and downloads reports/{id}/download/.
+
+Identical requests (same site, report, parameters and site data version)
+share a running job, and finished results are reused for USER_REPORT_TTL
+seconds. Uploaded files (the diploma template) are identified in the parameters
+by the hash of their content, stored in ReportJob.upload and deleted when
+the job is finished, failed or purged. Workers are threads of the web process, so a restart orphans
+its jobs: pending and running jobs, which did not progress for
+USER_REPORT_STALE_SECONDS, are not shared, and the purge_reports command
+marks them failed. Old jobs are removed with the purge_reports command too.
+"""
+import hashlib
+import io
+import json
+import logging
+import os
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from payment.models import Payment
+from . import tasks
+from .changes import record_changes
+from .conf import app_settings
+from .diplomas import DEFAULT_OPTIONS, render_in_processes
+from .models import User, Diploma, ReportJob
+from .versions import site_version, touch_site
+
+logger = logging.getLogger(__name__)
+
+
+def chunks(items, size):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+class ExportReport(object):
+    """
+    XLSX with name, role, registration date and email of the users
+    """
+    filename = 'export.xlsx'
+    content_type = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+
+    def clean(self, data):
+        users = data.getlist('users') if hasattr(data, 'getlist') else data.get('users', [])
+        return {'users': sorted(set(map(int, users)))}
+
+    def build(self, site, params, progress=None):
+        from openpyxl import Workbook
+
+        wb = Workbook(write_only=True)
+        ws = wb.create_sheet('Пользователи')
+        for column in 'ABCD':
+            ws.column_dimensions[column].width = 50.0
+        ws.append(['ФИО', 'Роль', 'Дата регистрации', 'Email'])
+
+        ids, done = params['users'], 0
+        for chunk in chunks(ids, app_settings.REPORT_CHUNK_SIZE):
+            qs = User.objects.filter(site=site, is_active=True, id__in=chunk).order_by('id') \
+                .only('first_name', 'last_name', 'middle_name', 'role', 'registered_at', 'email')
+            for user in qs:
+                ws.append([user.full_name,
+                           user.get_role_display(),
+                           user.registered_at.strftime('%d.%m.%Y'),
+                           user.email])
+            done += len(chunk)
+            if progress:
+                progress(done, len(ids))
+
+        content = io.BytesIO()
+        wb.save(content)
+        return content.getvalue()
+
+
+class SalesReport(object):
+    """
+    JSON with sums of paid courses and webinars by their teachers
+    """
+    filename = 'sales.json'
+    content_type = 'application/json'
+
+    def clean(self, data):
+        params = {'date_start': data.get('date_start'), 'date_end': data.get('date_end')}
+        for value in params.values():
+            datetime.strptime(value or '', '%d.%m.%Y')
+        return params
+
+    def get_data(self, params, progress=None):
+        date_start = datetime.strptime(params['date_start'], '%d.%m.%Y')
+        date_end = datetime.strptime(params['date_end'], '%d.%m.%Y') + timedelta(days=1)
+
+        payments = Payment.objects.filter(is_paid=True, paid_at__gte=date_start, paid_at__lte=date_end).order_by('id')
+        total, done = payments.count(), 0
+        # {teacher id: {'courses': sum, 'webinars': sum}}
+        sums = dict()
+        for payment in payments.iterator():
+            access_request = payment.access_requests.last()
+            target = access_request.target if access_request else None
+            kind = {'Course': 'courses', 'Webinar': 'webinars'}.get(target.__class__.__name__)
+            if kind:
+                for teacher_id in target.authors.filter(role='teacher').values_list('id', flat=True):
+                    sums.setdefault(teacher_id, {'courses': 0, 'webinars': 0})[kind] += payment.amount
+            done += 1
+            if progress and done % app_settings.REPORT_CHUNK_SIZE == 0:
+                progress(done, total)
+
+        result = list()
+        for teacher in User.objects.filter(id__in=list(sums)).order_by('id'):
+            data = OrderedDict([('id', teacher.id), ('full_name', teacher.full_name)])
+            data.update(sums[teacher.id])
+            if data['courses'] or data['webinars']:
+                result.append(data)
+        return result
+
+    def build(self, site, params, progress=None):
+        # Payment amounts are Decimal
+        return json.dumps(self.get_data(params, progress), ensure_ascii=False, cls=DjangoJSONEncoder).encode()
+
+
+class DiplomasReport(object):
+    """
+    Diplomas with names of the users of a group or a list, drawn on the template image.
+    The result is JSON with the number of created diplomas
+    """
+    filename = 'diplomas.json'
+    content_type = 'application/json'
+    # Request data key of the file stored in ReportJob.upload
+    upload_field = 'template'
+
+    def clean(self, data):
+        from PIL import Image
+
+        users = data.getlist('users') if hasattr(data, 'getlist') else data.get('users', [])
+        params = {
+            'group': int(data['group']) if data.get('group') else None,
+            'users': sorted(set(map(int, users))),
+            'description': (data.get('description') or '')[:155],
+            'options': {name: type(value)(data[name]) for name, value in DEFAULT_OPTIONS.items() if data.get(name)},
+        }
+        if not params['group'] and not params['users']:
+            raise ValueError('Group or users are required')
+
+        template = data.get('template')
+        if not template:
+            raise ValueError('Template image is required')
+        try:
+            Image.open(template).verify()
+        except Exception:
+            raise ValueError('Template is not an image')
+        template.seek(0)
+        # Identical requests share the job, whatever the name of the upload
+        params['template'] = hashlib.sha256(template.read()).hexdigest()
+        template.seek(0)
+        return params
+
+    def build(self, site, params, progress=None):
+        qs = User.objects.filter(site=site, is_active=True)
+        if params['group']:
+            qs = qs.filter(groups__id=params['group'])
+        if params['users']:
+            qs = qs.filter(id__in=params['users'])
+        users = list(qs.distinct().order_by('id').only('first_name', 'last_name', 'middle_name'))
+
+        with default_storage.open(params['upload'], 'rb') as f:
+            template = f.read()
+
+        done, images = 0, list()
+        rendered = render_in_processes(template, [user.full_name for user in users], params['options'])
+        try:
+            for chunk, contents in zip(chunks(users, app_settings.DIPLOMA_CHUNK_SIZE), rendered):
+                diplomas = list()
+                for user, content in zip(chunk, contents):
+                    diploma = Diploma(site=site, user=user, description=params['description'])
+                    diploma.image.save('diploma_{}.jpg'.format(user.id), ContentFile(content), save=False)
+                    images.append(diploma.image.name)
+                    diplomas.append(diploma)
+                with transaction.atomic():
+                    Diploma.objects.bulk_create(diplomas)
+                    # bulk_create sets ids only on PostgreSQL, images have unique names
+                    record_changes(Diploma.objects.filter(image__in=[diploma.image.name for diploma in diplomas]),
+                                   'created')
+                done += len(chunk)
+                if progress:
+                    progress(done, len(users))
+        except Exception:
+            self.rollback(images)
+            raise
+
+        # bulk_create sends no signals
+        touch_site(site.id)
+        return json.dumps({'created': done}).encode()
+
+    def rollback(self, images):
+        """
+        Deletes diplomas and images of a failed batch, so a retry does not duplicate them
+        """
+        for chunk in chunks(images, app_settings.DIPLOMA_CHUNK_SIZE):
+            # Sends post_delete, which records the changes
+            Diploma.objects.filter(image__in=chunk).delete()
+            for name in chunk:
+                default_storage.delete(name)
+
+
+REPORTS = {
+    'export': ExportReport(),
+    'sales': SalesReport(),
+    'diplomas': DiplomasReport(),
+}
+
+
+def report_key(site_id, kind, params):
+    raw = json.dumps([site_id, kind, params, site_version(site_id)], sort_keys=True)
+    return hashlib.sha256(raw.encode()).hexdigest()
+
+
+def start_report(site, user, kind, params, upload=None):
+    """
+    :param params: cleaned parameters of the report
+    :param upload: uploaded file of the report, see upload_field; kept only for a new job
+    :return: ReportJob, new or identical one which is running or recently done
+    """
+    key = report_key(site.id, kind, params)
+    now = timezone.now()
+    since = now - timedelta(seconds=app_settings.REPORT_TTL)
+    # Jobs of crashed workers are not reused
+    stale = now - timedelta(seconds=app_settings.REPORT_STALE_SECONDS)
+    job = ReportJob.objects.filter(site=site, key=key) \
+        .filter(Q(status__in=['pending', 'running'], created_at__gte=since, updated_at__gte=stale) |
+                Q(status='done', finished_at__gte=since)) \
+        .order_by('-created_at').first()
+    if job is None:
+        job = ReportJob(site=site, created_by=user if user and user.is_authenticated() else None,
+                        kind=kind, params=json.dumps(params), key=key)
+        if upload:
+            job.upload.save(os.path.basename(upload.name), upload, save=False)
+        job.save()
+        tasks.submit_to('reports', run_report, job.id)
+    return job
+
+
+def run_report(job_id):
+    # The job could be already taken by another worker
+    if not ReportJob.objects.filter(pk=job_id, status='pending').update(status='running', updated_at=timezone.now()):
+        return
+    job = ReportJob.objects.select_related('site').get(pk=job_id)
+    report = REPORTS[job.kind]
+    params = json.loads(job.params)
+    if job.upload:
+        params['upload'] = job.upload.name
+
+    def progress(done, total):
+        ReportJob.objects.filter(pk=job_id).update(progress=min(99, done * 100 // total) if total else 0,
+                                                   updated_at=timezone.now())
+
+    try:
+        content = report.build(job.site, params, progress)
+        job.file.save(report.filename, ContentFile(content), save=False)
+    except Exception as e:
+        logger.exception('Report %s failed', job_id)
+        now = timezone.now()
+        ReportJob.objects.filter(pk=job_id).update(status='failed', error=str(e), finished_at=now, updated_at=now)
+        return
+    finally:
+        delete_upload(job)
+    now = timezone.now()
+    # The job could be marked failed as stale meanwhile
+    if not ReportJob.objects.filter(pk=job_id, status='running').update(
+            file=job.file.name, status='done', progress=100, finished_at=now, updated_at=now):
+        job.file.delete(save=False)
+
+
+def delete_upload(job):
+    """
+    Deletes the uploaded file of the job, it is not needed once the job is finished
+    """
+    if job.upload:
+        job.upload.delete(save=False)
+        ReportJob.objects.filter(pk=job.pk).update(upload='')
+
+
+def fail_stale_reports():
+    """
+    Marks failed pending and running jobs, which did not progress
+    for USER_REPORT_STALE_SECONDS, e.g. after a restart of the web process
+    :return: number of failed jobs
+    """
+    now = timezone.now()
+    stale = now - timedelta(seconds=app_settings.REPORT_STALE_SECONDS)
+    jobs = list(ReportJob.objects.filter(status__in=['pending', 'running'], updated_at__lt=stale))
+    for job in jobs:
+        delete_upload(job)
+    return ReportJob.objects.filter(pk__in=[job.pk for job in jobs]) \
+        .update(status='failed', error='Формирование прервано', finished_at=now, updated_at=now)
+
+
+def purge_reports(before):
+    """
+    Deletes jobs created before the date with their files
+    :return: number of deleted jobs
+    """
+    count = 0
+    for job in ReportJob.objects.filter(created_at__lt=before):
+        if job.file:
+            job.file.delete(save=False)
+        if job.upload:
+            job.upload.delete(save=False)
+        job.delete()
+        count += 1
+    return count
@@ -0,0 +1,283 @@
+"""
+Database routing for the user app: read replicas and site shards.
+
+Read replicas
+
+Views opt in with ReplicaReadMixin: safe requests to the listed actions
+read from USER_READ_REPLICAS. The request is pinned to the primary
+as soon as it writes anything, and a lagging replica is skipped.
+ReplicaPinMiddleware also keeps the next requests of the same client
+on the primary for USER_REPLICA_PIN_SECONDS after a write.
+Reads of a site, whose data changed (see user.versions) within
+USER_REPLICA_MAX_LAG, go to the primary too: ETags come from the site
+version, so a body from a lagging replica would be cached under the new one.
+
+Settings example (works locally with two SQLite databases):
+
+    DATABASES = {
+        'default': {'ENGINE': 'django.db.backends.sqlite3', 'NAME': 'db.sqlite3'},
+        'replica': {'ENGINE': 'django.db.backends.sqlite3', 'NAME': 'db.sqlite3',
+                    'TEST': {'MIRROR': 'default'}},
+    }
+    DATABASE_ROUTERS = ['user.routers.ReplicaRouter']
+    USER_READ_REPLICAS = ['replica']
+    # Required: resets routing state of the thread and sets the pin cookie
+    MIDDLEWARE = [
+        ...
+        'user.routers.ReplicaPinMiddleware',
+    ]
+
+Site shards
+
+SiteShardRouter keeps users, groups, notes and diplomas of every site
+in the database alias from SiteShard (or 'default'). Queries without
+an instance hint go to the shard of the site of the current request
+(set by SiteShardMiddleware from request.site), or of settings.SITE_ID
+outside of requests. Sites are moved between shards with the
+move_site_shard command.
+
+Shared tables (sites, tags, courses, permissions...) are created in every
+shard, since sharded rows reference them, and their rows must be copied
+to the shards by the deployment: the router does not relate a sharded
+object to a shared row, which is missing in its shard. Rows of other apps
+(payments, access requests, organization admins, course authors) stay in
+'default', so move_site_shard refuses to move a site they reference.
+
+The shard map is cached for USER_SHARD_CACHE_TIMEOUT seconds. The cache
+must be shared by the web processes and move_site_shard (e.g. memcached
+or redis, not the per-process LocMemCache), otherwise they keep routing
+a moved site to its old shard; move_site_shard checks it.
+
+    DATABASES = {
+        'default': {'ENGINE': 'django.db.backends.sqlite3', 'NAME': 'db.sqlite3'},
+        'shard1': {'ENGINE': 'django.db.backends.sqlite3', 'NAME': 'shard1.sqlite3'},
+    }
+    DATABASE_ROUTERS = ['user.routers.SiteShardRouter']
+    USER_SHARDS = ['default', 'shard1']
+    MIDDLEWARE = [
+        ...
+        'user.routers.SiteShardMiddleware',  # after the middleware, which sets request.site
+    ]
+
+Shards and replicas are not combined: sharded models always use the shard primary.
+"""
+import random
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connections, DatabaseError
+from django.utils.deprecation import MiddlewareMixin
+from rest_framework.permissions import SAFE_METHODS
+
+from .conf import app_settings
+from .versions import site_version
+
+PRIMARY = 'default'
+PIN_COOKIE = 'use_primary'
+SHARD_KEY = 'user:shard:{}'
+
+_state = threading.local()
+# Site of the current request, see SiteShardMiddleware
+_site = threading.local()
+# {alias: (checked at, lag in seconds)}
+_replica_lag = dict()
+
+LAG_SQL = {
+    'postgresql': 'SELECT CASE WHEN NOT pg_is_in_recovery() '
+                  'OR pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0 '
+                  'ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()) END',
+}
+
+
+def reset_state():
+    _state.__dict__.clear()
+
+
+def use_replica():
+    _state.use_replica = True
+
+
+def pin_primary():
+    _state.pinned = True
+
+
+def is_pinned():
+    return getattr(_state, 'pinned', False)
+
+
+def replica_lag(alias):
+    """
+    :return: replication lag of the replica in seconds, checked once
+    in USER_REPLICA_LAG_CHECK_INTERVAL. Unreachable replica is infinitely late
+    """
+    checked_at, lag = _replica_lag.get(alias, (0, None))
+    if time.time() - checked_at < app_settings.REPLICA_LAG_CHECK_INTERVAL:
+        return lag
+
+    lag = 0
+    sql = LAG_SQL.get(connections[alias].vendor)
+    if sql:
+        try:
+            with connections[alias].cursor() as cursor:
+                cursor.execute(sql)
+                lag = float(cursor.fetchone()[0] or 0)
+        except DatabaseError:
+            lag = float('inf')
+    _replica_lag[alias] = (time.time(), lag)
+    return lag
+
+
+def get_replica():
+    """
+    :return: alias of a random replica, which is not lagging, or None
+    """
+    replicas = [alias for alias in app_settings.READ_REPLICAS
+                if alias in settings.DATABASES and replica_lag(alias) <= app_settings.REPLICA_MAX_LAG]
+    return random.choice(replicas) if replicas else None
+
+
+class ReplicaRouter(object):
+    def db_for_read(self, model, **hints):
+        if getattr(_state, 'use_replica', False) and not is_pinned():
+            return get_replica() or PRIMARY
+        return None
+
+    def db_for_write(self, model, **hints):
+        # Read-your-writes: everything after the first write goes to the primary
+        pin_primary()
+        return PRIMARY
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Replicas have the same data as the primary
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        if db in app_settings.READ_REPLICAS:
+            return False
+        return None
+
+
+class ReplicaReadMixin(object):
+    """
+    Viewset mixin, which sends reads of safe requests to replica_actions to replicas
+    """
+    replica_actions = ['list', 'retrieve']
+
+    def initial(self, request, *args, **kwargs):
+        super(ReplicaReadMixin, self).initial(request, *args, **kwargs)
+        if request.method in SAFE_METHODS and self.action in self.replica_actions \
+                and not request.COOKIES.get(PIN_COOKIE) \
+                and time.time() - site_version(request.site.id) > app_settings.REPLICA_MAX_LAG:
+            use_replica()
+
+
+class ReplicaPinMiddleware(MiddlewareMixin):
+    """
+    Keeps the client on the primary for a while after it wrote something,
+    so it does not read stale data from a lagging replica
+    """
+    def process_request(self, request):
+        reset_state()
+
+    def process_response(self, request, response):
+        if is_pinned() and request.method not in SAFE_METHODS:
+            response.set_cookie(PIN_COOKIE, '1', max_age=app_settings.REPLICA_PIN_SECONDS, httponly=True)
+        reset_state()
+        return response
+
+
+_sharded_models = None
+
+
+def sharded_models():
+    global _sharded_models
+    if _sharded_models is None:
+        from .models import User, Group, Note, Diploma, ArchivedUser, Invitation, ReportJob, Mailing, ChangeEvent
+        _sharded_models = {User, Group, Note, Diploma, ArchivedUser, Invitation, ReportJob, Mailing, ChangeEvent,
+                           User.groups.through, User.tags.through, User.user_permissions.through}
+    return _sharded_models
+
+
+def shard_for_site(site_id):
+    """
+    :return: database alias of the site, cached for USER_SHARD_CACHE_TIMEOUT
+    """
+    key = SHARD_KEY.format(site_id)
+    alias = cache.get(key)
+    if alias is None:
+        from .models import SiteShard
+        alias = SiteShard.objects.using(PRIMARY).filter(site_id=site_id).values_list('alias', flat=True).first()
+        alias = alias or PRIMARY
+        cache.set(key, alias, app_settings.SHARD_CACHE_TIMEOUT)
+    return alias
+
+
+def set_shard_for_site(site_id, alias):
+    from .models import SiteShard
+    SiteShard.objects.using(PRIMARY).update_or_create(site_id=site_id, defaults={'alias': alias})
+    cache.set(SHARD_KEY.format(site_id), alias, app_settings.SHARD_CACHE_TIMEOUT)
+
+
+def set_current_site(site_id):
+    _site.id = site_id
+
+
+def current_site_id():
+    return getattr(_site, 'id', None) or settings.SITE_ID
+
+
+class SiteShardMiddleware(MiddlewareMixin):
+    """
+    Routes queries without an instance hint to the shard of request.site
+    """
+    def process_request(self, request):
+        site = getattr(request, 'site', None)
+        set_current_site(site.id if site is not None else None)
+
+    def process_response(self, request, response):
+        set_current_site(None)
+        return response
+
+
+class SiteShardRouter(object):
+    def _db(self, model, **hints):
+        from django.contrib.sites.models import Site
+
+        models = sharded_models()
+        if model not in models:
+            return None
+        instance = hints.get('instance')
+        if instance is not None and instance.__class__ in models:
+            if instance._state.db:
+                return instance._state.db
+            if getattr(instance, 'site_id', None):
+                return shard_for_site(instance.site_id)
+        if isinstance(instance, Site):  # e.g. site.user_set
+            return shard_for_site(instance.pk)
+        return shard_for_site(current_site_id())
+
+    def db_for_read(self, model, **hints):
+        return self._db(model, **hints)
+
+    def db_for_write(self, model, **hints):
+        return self._db(model, **hints)
+
+    def allow_relation(self, obj1, obj2, **hints):
+        models = sharded_models()
+        if obj1.__class__ in models and obj2.__class__ in models:
+            return obj1._state.db == obj2._state.db
+        if obj1.__class__ in models or obj2.__class__ in models:
+            sharded, shared = (obj1, obj2) if obj1.__class__ in models else (obj2, obj1)
+            if sharded._state.db and shared._state.db and sharded._state.db != shared._state.db:
+                # The shard must have its own copy of the shared row
+                return shared.__class__._default_manager.using(sharded._state.db).filter(pk=shared.pk).exists()
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        if app_label == 'user' and model_name == 'siteshard':
+            return db == PRIMARY
+        if db in app_settings.SHARDS:
+            return True
+        return None
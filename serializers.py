@@ -1,10 +1,13 @@
 import ast
+import json
 
 from django.conf import settings
+from django.db import connections
 from rest_framework import serializers
 
-from core.utils import resize_image
-from .models import User, Group, Note, Diploma
+from .authentication import authored_course_ids
+from .conf import app_settings
+from .models import User, Group, Note, Diploma, ArchivedUser, ReportJob, Mailing
 from datetime import datetime, timedelta
 
 
@@ -53,13 +56,15 @@ class UserSerializer(serializers.ModelSerializer):
 
     class Meta:
         model = User
-        exclude = ['site', 'is_staff', 'is_paid', 'is_active', 'password',
+        exclude = ['site', 'is_staff', 'is_paid', 'is_active', 'deactivated_at', 'password', 'email_normalized',
                    'unsubscribe_code', 'is_unsubscribed', 'user_permissions']
 
 
 class UserWriteSerializer(serializers.ModelSerializer):
     def validate_avatar(self, value):
         if value:
+            # Imported here, image processing libraries are needed only for avatar uploads
+            from core.utils import resize_image
             return resize_image(value, 'user_avatar')
         else:
             return
@@ -69,13 +74,92 @@ class UserWriteSerializer(serializers.ModelSerializer):
         fields = '__all__'
 
 
+# Fields of User loaded for GroupMemberSerializer
+GROUP_MEMBER_FIELDS = ['id', 'email', 'first_name', 'last_name', 'middle_name', 'role', 'avatar']
+
+
+class GroupMemberSerializer(serializers.ModelSerializer):
+    role = serializers.SerializerMethodField(read_only=True)
+    avatar = serializers.SerializerMethodField(read_only=True)
+
+    def get_role(self, obj):
+        return {'value': obj.role, 'title': obj.get_role_display()}
+
+    def get_avatar(self, obj):
+        return obj.avatar.url if obj.avatar else '/static/images/default-profile.jpg'
+
+    class Meta:
+        model = User
+        fields = ['id', 'email', 'full_name', 'short_name', 'role', 'avatar']
+
+
+def preview_members(groups, size):
+    """
+    First members of every group with one windowed query over the memberships
+    (PostgreSQL, SQLite 3.25+) and one query for the users, instead of a query per group
+    :return: {group id: list of Users with GROUP_MEMBER_FIELDS, ordered by id}
+    """
+    result = {group.pk: list() for group in groups}
+    if not result:
+        return result
+    using = groups[0]._state.db
+    connection = connections[using]
+    through = User.groups.through
+    group_column = connection.ops.quote_name(through._meta.get_field('group').column)
+    user_column = connection.ops.quote_name(through._meta.get_field('user').column)
+    sql = 'SELECT {group}, {user} FROM (' \
+          'SELECT {group}, {user}, ROW_NUMBER() OVER (PARTITION BY {group} ORDER BY {user}) AS preview_position ' \
+          'FROM {table} WHERE {group} IN ({ids})) AS members WHERE preview_position <= %s'
+
+    pairs, ids = list(), list(result)
+    # SQLite allows 999 parameters in a query
+    for i in range(0, len(ids), 500):
+        chunk = ids[i:i + 500]
+        with connection.cursor() as cursor:
+            cursor.execute(sql.format(group=group_column, user=user_column,
+                                      table=connection.ops.quote_name(through._meta.db_table),
+                                      ids=', '.join(['%s'] * len(chunk))), chunk + [size])
+            pairs += cursor.fetchall()
+
+    users = User.objects.db_manager(using).only(*GROUP_MEMBER_FIELDS).in_bulk({user_id for _, user_id in pairs})
+    for group_id, user_id in sorted(pairs):
+        result[group_id].append(users[user_id])
+    return result
+
+
+class GroupListSerializer(serializers.ListSerializer):
+    def to_representation(self, data):
+        groups = list(data.all() if hasattr(data, 'all') else data)
+        previews = preview_members(groups, app_settings.GROUP_PREVIEW_SIZE)
+        for group in groups:
+            group._users_preview = previews[group.pk]
+        return super(GroupListSerializer, self).to_representation(groups)
+
+
 class GroupSerializer(serializers.ModelSerializer):
-    users = UserSerializer(read_only=True, many=True)
+    users_count = serializers.SerializerMethodField(read_only=True)
+    users_preview = serializers.SerializerMethodField(read_only=True)
     is_active = serializers.SerializerMethodField(read_only=True)
     can_edit = serializers.SerializerMethodField(read_only=True)
     status = serializers.SerializerMethodField(read_only=True)
     payment = serializers.SerializerMethodField(read_only=True)
 
+    def get_users_count(self, obj):
+        # Annotated in GroupViewSet
+        if hasattr(obj, 'users_count'):
+            return obj.users_count
+        return obj.users.count()
+
+    def get_users_preview(self, obj):
+        """
+        :return: first members of the group, all of them are at groups/{id}/members/
+        """
+        # Loaded for all the groups of a list by GroupListSerializer
+        users = getattr(obj, '_users_preview', None)
+        if users is None:
+            users = obj.users.only(*GROUP_MEMBER_FIELDS).order_by('id')[:app_settings.GROUP_PREVIEW_SIZE]
+        return GroupMemberSerializer(users, many=True).data
+
     def get_payment(self, obj):
         return obj.access_requests.filter(payment__is_paid=True).count()
 
@@ -101,11 +185,12 @@ class GroupSerializer(serializers.ModelSerializer):
             return False
 
         if user.role == 'teacher':
+            courses = authored_course_ids(user)
             for request in obj.access_requests.all():
-                if user in request.course.authors.all():
+                if request.course_id in courses:
                     return True
 
-            if user == obj.author:
+            if user.pk == obj.author_id:
                 return True
 
         if user.role == 'admin':
@@ -116,6 +201,7 @@ class GroupSerializer(serializers.ModelSerializer):
     class Meta:
         model = Group
         fields = '__all__'
+        list_serializer_class = GroupListSerializer
 
 
 class NoteSerializer(serializers.ModelSerializer):
@@ -154,3 +240,36 @@ class NoteWriteSerializer(serializers.ModelSerializer):
     class Meta:
         model = Note
         fields = '__all__'
+
+
+class ArchivedUserSerializer(serializers.ModelSerializer):
+
+    class Meta:
+        model = ArchivedUser
+        exclude = ['site', 'data']
+
+
+class ReportJobSerializer(serializers.ModelSerializer):
+    status = serializers.SerializerMethodField(read_only=True)
+
+    def get_status(self, obj):
+        return {'value': obj.status, 'title': obj.get_status_display()}
+
+    class Meta:
+        model = ReportJob
+        fields = ['id', 'kind', 'status', 'progress', 'error', 'created_at', 'finished_at']
+
+
+class MailingSerializer(serializers.ModelSerializer):
+    status = serializers.SerializerMethodField(read_only=True)
+    segment = serializers.SerializerMethodField(read_only=True)
+
+    def get_status(self, obj):
+        return {'value': obj.status, 'title': obj.get_status_display()}
+
+    def get_segment(self, obj):
+        return json.loads(obj.segment)
+
+    class Meta:
+        model = Mailing
+        exclude = ['site', 'last_user_id']
@@ -1,6 +1,16 @@
-from django.db.models.signals import pre_delete, pre_save
+from django.core.signals import request_started
+from django.db.models.signals import pre_delete, pre_save, post_save, post_delete, m2m_changed
 from django.dispatch import receiver
-from .models import User
+
+from course.models import Course
+from organization.models import CustomField, AccessRequest
+from payment.models import Payment
+from .authentication import forget_users
+from .changes import is_tracked, record_change, record_cleared_references, record_memberships
+from .custom_fields import bump_schema_version
+from .models import User, Group, Note, Diploma, normalize_email
+from .routers import reset_state, set_current_site
+from .versions import touch_site
 
 
 @receiver(pre_delete, sender=User, dispatch_uid='clear custom_fields')
@@ -11,7 +21,7 @@ def log_deleted_question(sender, instance, using, **kwargs):
     """
     for field in instance.site.organization.custom_fields.all():
         field.values.pop(instance.email, None)
-        field.save()
+        field.save(update_fields=['values'])
 
 
 @receiver(pre_save, sender=User, dispatch_uid='change_email_cfield')
@@ -25,4 +35,156 @@ def edit_custom_fields_remove_duplicate_emails(sender, instance, using, **kwargs
         if instance.email != old_email:
             for field in instance.site.organization.custom_fields.all():
                 field.values.pop(old_email, None)
-                field.save()
+                field.save(update_fields=['values'])
+
+
+@receiver(pre_save, sender=User, dispatch_uid='normalize_email_raw')
+def normalize_email_raw(sender, instance, raw=False, **kwargs):
+    """
+    Raw saves (fixtures, restored archive) skip field pre_save,
+    so the normalized email is set here
+    """
+    if raw:
+        instance.email_normalized = normalize_email(instance.email)
+
+
+@receiver([post_save, post_delete], sender=CustomField, dispatch_uid='custom_fields_schema_version')
+def custom_fields_schema_changed(sender, instance, update_fields=None, **kwargs):
+    """
+    Invalidates cached custom fields schema (see user.custom_fields),
+    unless only values of the field were saved
+    """
+    if update_fields and set(update_fields) == {'values'}:
+        return
+    bump_schema_version(instance.organization_id)
+
+
+@receiver([post_save, post_delete], sender=User, dispatch_uid='site_version_user')
+@receiver([post_save, post_delete], sender=Group, dispatch_uid='site_version_group')
+@receiver([post_save, post_delete], sender=Note, dispatch_uid='site_version_note')
+@receiver([post_save, post_delete], sender=Diploma, dispatch_uid='site_version_diploma')
+def site_data_changed(sender, instance, **kwargs):
+    """
+    Bumps site version used as ETag, see user.conditional
+    """
+    touch_site(instance.site_id)
+
+
+@receiver(m2m_changed, sender=User.groups.through, dispatch_uid='site_version_user_groups')
+@receiver(m2m_changed, sender=User.tags.through, dispatch_uid='site_version_user_tags')
+def site_relations_changed(sender, instance, action, pk_set, **kwargs):
+    if not action.startswith('post_'):
+        return
+    if hasattr(instance, 'site_id'):
+        touch_site(instance.site_id)
+    elif pk_set:  # Tag side of the relation
+        touch_site(*User.objects.filter(id__in=pk_set).values_list('site_id', flat=True).distinct())
+
+
+@receiver(post_save, sender=CustomField, dispatch_uid='site_version_custom_field')
+def site_custom_field_changed(sender, instance, **kwargs):
+    """
+    Custom field values are shown with users
+    """
+    touch_site(instance.organization.site_id)
+
+
+@receiver([post_save, post_delete], sender=AccessRequest, dispatch_uid='site_version_access_request')
+def site_access_request_changed(sender, instance, **kwargs):
+    """
+    Access requests are shown in groups (is_active, payment, can_edit),
+    and requests of users decide which notes teachers see
+    """
+    if instance.group_id:
+        touch_site(*Group.objects.filter(id=instance.group_id).values_list('site_id', flat=True))
+    if instance.user_id:
+        touch_site(*User.objects.filter(id=instance.user_id).values_list('site_id', flat=True))
+
+
+@receiver(post_save, sender=Payment, dispatch_uid='site_version_payment')
+def site_payment_changed(sender, instance, **kwargs):
+    touch_site(*Group.objects.filter(access_requests__payment=instance).values_list('site_id', flat=True))
+
+
+@receiver([post_save, post_delete], sender=User, dispatch_uid='forget_user_snapshot')
+def user_snapshot_changed(sender, instance, **kwargs):
+    """
+    Deletes the cached snapshot of the authenticated user (see user.authentication),
+    password changes are saved this way too
+    """
+    forget_users(instance.pk)
+
+
+def changed_course_authors(instance, action, reverse, pk_set):
+    """
+    :return: ids of users, whose authored courses are changed by the m2m_changed action
+    """
+    if reverse:  # User side of the relation
+        return [instance.pk] if action.startswith('post_') else []
+    if action == 'pre_clear':
+        return list(instance.authors.values_list('id', flat=True))
+    if action in ['post_add', 'post_remove']:
+        return list(pk_set)
+    return []
+
+
+@receiver(m2m_changed, sender=Course.authors.through, dispatch_uid='forget_course_authors_snapshot')
+def course_authors_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    """
+    Authored courses are the permission scope in the user snapshot
+    and decide which notes and groups teachers see and edit
+    """
+    user_ids = changed_course_authors(instance, action, reverse, pk_set)
+    if user_ids:
+        forget_users(*user_ids)
+        touch_site(*User.objects.filter(id__in=user_ids).values_list('site_id', flat=True).distinct())
+
+
+@receiver(post_save, sender=User, dispatch_uid='outbox_save_user')
+@receiver(post_save, sender=Group, dispatch_uid='outbox_save_group')
+@receiver(post_save, sender=Note, dispatch_uid='outbox_save_note')
+@receiver(post_save, sender=Diploma, dispatch_uid='outbox_save_diploma')
+def outbox_saved(sender, instance, created, update_fields=None, **kwargs):
+    """
+    Appends the change to the outbox, see user.changes
+    """
+    if created or is_tracked(instance, update_fields):
+        record_change(instance, 'created' if created else 'updated')
+
+
+@receiver(post_delete, sender=User, dispatch_uid='outbox_delete_user')
+@receiver(post_delete, sender=Group, dispatch_uid='outbox_delete_group')
+@receiver(post_delete, sender=Note, dispatch_uid='outbox_delete_note')
+@receiver(post_delete, sender=Diploma, dispatch_uid='outbox_delete_diploma')
+def outbox_deleted(sender, instance, **kwargs):
+    record_change(instance, 'deleted')
+
+
+@receiver(pre_delete, sender=User, dispatch_uid='outbox_cleared_references')
+def outbox_cleared_references(sender, instance, using, **kwargs):
+    """
+    Groups and notes of the deleted user lose their author with SET_NULL, which sends no signals
+    """
+    record_cleared_references(instance, using)
+
+
+@receiver(m2m_changed, sender=User.groups.through, dispatch_uid='outbox_memberships')
+def outbox_memberships(sender, instance, action, reverse, pk_set, **kwargs):
+    if action in ['post_add', 'post_remove'] and pk_set:
+        pairs = [(pk, instance.pk) for pk in pk_set] if reverse else [(instance.pk, pk) for pk in pk_set]
+    elif action == 'pre_clear':
+        # pk_set is not sent for clear()
+        pairs = list(User.groups.through.objects.filter(**{'group' if reverse else 'user': instance})
+                     .values_list('user_id', 'group_id'))
+    else:
+        return
+    record_memberships(instance.site_id, pairs, 'added' if action == 'post_add' else 'removed')
+
+
+@receiver(request_started, dispatch_uid='reset_replica_routing')
+def reset_replica_routing(sender, **kwargs):
+    """
+    Routing state is thread local, so it must not leak into the next request
+    """
+    reset_state()
+    set_current_site(None)
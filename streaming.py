@@ -0,0 +1,55 @@
+"""
+Streaming of the unpaginated user list.
+
+Users are read with iterator() (a server-side cursor on PostgreSQL), serialized
+by chunks of USER_STREAM_CHUNK_SIZE and written to the response as they are
+ready, so memory does not grow with the number of users on the site.
+"""
+from django.http import StreamingHttpResponse
+
+from .conf import app_settings
+from .fast_serializers import iter_serialized_users
+from .renderers import FastJSONRenderer, NDJSONRenderer
+
+
+def iter_json_array(chunks):
+    """
+    :param chunks: iterator over lists of serializable objects
+    :return: iterator over bytes of one JSON array, equal to the rendered list of all objects
+    """
+    renderer = FastJSONRenderer()
+    yield b'['
+    first = True
+    for chunk in chunks:
+        if not chunk:
+            continue
+        if not first:
+            yield b','
+        first = False
+        # Rendered chunk without the brackets
+        yield renderer.render(chunk)[1:-1]
+    yield b']'
+
+
+def iter_ndjson(chunks):
+    """
+    :return: iterator over bytes of newline delimited JSON, one object per line
+    """
+    renderer = NDJSONRenderer()
+    for chunk in chunks:
+        if chunk:
+            yield renderer.render(chunk)
+
+
+def stream_users(queryset, ndjson=False):
+    """
+    :param ndjson: one user per line instead of a JSON array
+    :return: StreamingHttpResponse with UserSerializer data of the users
+    """
+    # The response is consumed after the middleware reset the routing state
+    # of the request (replica, site shard), so the database is chosen now
+    queryset = queryset.using(queryset.db)
+    chunks = iter_serialized_users(queryset, app_settings.STREAM_CHUNK_SIZE)
+    if ndjson:
+        return StreamingHttpResponse(iter_ndjson(chunks), content_type=NDJSONRenderer.media_type)
+    return StreamingHttpResponse(iter_json_array(chunks), content_type='application/json')
@@ -0,0 +1,49 @@
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from django.db import connection, transaction
+
+from .conf import app_settings
+
+logger = logging.getLogger(__name__)
+
+# Worker pools and settings with their sizes. Long tasks (reports)
+# have their own pool, so they do not delay emails
+POOLS = {
+    'default': 'TASK_WORKERS',
+    'reports': 'REPORT_WORKERS',
+    'mailings': 'MAILING_WORKERS',
+}
+_executors = dict()
+
+
+def get_executor(pool='default'):
+    if pool not in _executors:
+        _executors[pool] = ThreadPoolExecutor(max_workers=getattr(app_settings, POOLS[pool]))
+    return _executors[pool]
+
+
+def _run(func, args, kwargs):
+    try:
+        func(*args, **kwargs)
+    except Exception:
+        logger.exception('Background task %s failed', func.__name__)
+    finally:
+        # Worker threads get their own DB connections, close them after each task
+        connection.close()
+
+
+def submit_to(pool, func, *args, **kwargs):
+    """
+    Runs func in a background worker thread of the pool, once the current
+    transaction is committed, so the task sees the rows created by the request.
+    With USER_TASKS_EAGER = True (e.g. in tests) func is called inline.
+    """
+    if app_settings.TASKS_EAGER:
+        transaction.on_commit(lambda: func(*args, **kwargs))
+    else:
+        transaction.on_commit(lambda: get_executor(pool).submit(_run, func, args, kwargs))
+
+
+def submit(func, *args, **kwargs):
+    submit_to('default', func, *args, **kwargs)
@@ -1,9 +1,21 @@
+import json
+from unittest import mock
+
+from django.db import connection
+from django.test import override_settings
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
 
 from rest_framework import status
+from rest_framework.renderers import JSONRenderer
 from rest_framework.test import APIClient, APITestCase
 
-from user.models import User, Group
+from organization.models import AccessRequest
+from user import fast_serializers
+from user.fast_serializers import serialize_users
+from user.invitations import create_invitations
+from user.models import User, Group, Invitation
+from user.serializers import UserSerializer
 
 
 class UserTests(APITestCase):
@@ -24,9 +36,220 @@ class UserTests(APITestCase):
 
         self.assertContains(response, 'Teacher')
 
+    def test_list_fast_path(self):
+        """
+        Ensure the fast user list is the same as UserSerializer output.
+        """
+        qs = User.on_site.filter(is_active=True).order_by('-id')
+        expected = JSONRenderer().render(UserSerializer(qs, many=True).data)
+        self.assertEqual(JSONRenderer().render(serialize_users(qs.all())), expected)
+
+        response = self.client.get(self.list_url)
+        self.assertEqual(response.content, expected)
+
+    @override_settings(USER_STREAM_CHUNK_SIZE=2)
+    def test_list_stream(self):
+        """
+        Ensure the streamed user list is the same as the regular one, in JSON and NDJSON.
+        """
+        expected = self.client.get(self.list_url).content
+
+        response = self.client.get(self.list_url, {'stream': 1})
+        self.assertTrue(response.streaming)
+        self.assertEqual(b''.join(response.streaming_content), expected)
+
+        response = self.client.get(self.list_url, HTTP_ACCEPT='application/x-ndjson')
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        lines = b''.join(response.streaming_content).decode().splitlines()
+        self.assertEqual([json.loads(line) for line in lines], json.loads(expected.decode()))
+
+    def test_stream_custom_fields(self):
+        """
+        Ensure custom fields are loaded once per stream, not once per chunk.
+        """
+        with mock.patch('user.fast_serializers._custom_fields', wraps=fast_serializers._custom_fields) as load:
+            chunks = list(fast_serializers.iter_serialized_users(User.objects.order_by('id'), 1))
+        self.assertEqual(len(chunks), User.objects.count())
+        self.assertEqual(load.call_count, 1)
+
+    def test_facets(self):
+        """
+        Ensure facets count users like the list filters do.
+        """
+        User.objects.filter(email='student@grandclass.net').update(is_active=False)
+        response = self.client.get(reverse('api:user-facets'))
+        users = User.on_site.all()
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        for role, count in response.data['role'].items():
+            self.assertEqual(count, users.filter(is_active=True, role=role).count())
+        for group in Group.objects.all():
+            self.assertEqual(response.data['group'].get(group.id, 0), group.users.filter(is_active=True).count())
+        self.assertEqual(response.data['is_active'][False], 1)
+
     def test_detail(self):
         """
         Ensure we can get user details.
         """
         response = self.client.get(self.detail_url, format='json')
         self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_register_existing_email(self):
+        """
+        Ensure an email is registered once regardless of its case.
+        """
+        response = self.client.post(reverse('api:user-register'),
+                                    {'email': 'Student@GrandClass.net ', 'role': 'student'}, format='json')
+        self.assertEqual(response.data['status'], 209)
+        self.assertEqual(User.objects.filter(email_normalized='student@grandclass.net').count(), 1)
+
+    def test_password_reset_not_normalized(self):
+        """
+        Ensure users without email_normalized can reset the password.
+        """
+        User.objects.filter(email='student@grandclass.net').update(email_normalized=None)
+        response = self.client.post(reverse('api:user-password-reset'), {'email': 'Student@GrandClass.net'},
+                                    format='json')
+        self.assertEqual(response.data['status'], status.HTTP_200_OK)
+        self.assertFalse(User.objects.get(email='student@grandclass.net').check_password('123qwe'))
+
+    def test_register_bulk(self):
+        """
+        Ensure we can register many users with one request.
+        """
+        url = reverse('api:user-register-bulk')
+        data = [{'email': 'First@example.com', 'first_name': 'First', 'last_name': 'User'},
+                {'email': 'first@example.com'},
+                {'email': 'admin@grandclass.net'},
+                {'email': ' Admin@GrandClass.net '}]
+        response = self.client.post(url, data, format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual([item['status'] for item in response.data], ['created', 'duplicate', 'exists', 'duplicate'])
+        self.assertEqual(response.data[3]['email'], 'admin@grandclass.net')
+        self.assertTrue(User.objects.filter(email='first@example.com').exists())
+
+    def test_register_bulk_empty_password(self):
+        """
+        Ensure an empty password is not usable and the user gets an invitation instead.
+        """
+        response = self.client.post(reverse('api:user-register-bulk'),
+                                    [{'email': 'empty@example.com', 'password': ''}], format='json')
+        self.assertEqual(response.data[0]['status'], 'created')
+        user = User.objects.get(email='empty@example.com')
+        self.assertFalse(user.has_usable_password())
+        self.assertTrue(Invitation.objects.filter(user=user).exists())
+
+    def test_conditional_get(self):
+        """
+        Ensure unchanged list is answered with 304 Not Modified.
+        """
+        response = self.client.get(self.list_url)
+        etag = response['ETag']
+
+        response = self.client.get(self.list_url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+
+        user = User.objects.last()
+        user.first_name = 'Changed'
+        user.save()
+        response = self.client.get(self.list_url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertFalse(response.has_header('Last-Modified'))
+
+        # Teachers see notes by access requests of users to their courses
+        etag = response['ETag']
+        AccessRequest.objects.create(user=user)
+        response = self.client.get(self.list_url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    @override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.dummy.DummyCache'}})
+    def test_conditional_get_without_cache(self):
+        """
+        Ensure a cache, which keeps nothing, never answers 304.
+        """
+        response = self.client.get(self.list_url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        response = self.client.get(self.list_url, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_invitation(self):
+        """
+        Ensure invited user can set his password once.
+        """
+        response = self.client.post(reverse('api:user-register'),
+                                    {'email': 'invited@example.com', 'role': 'student'}, format='json')
+        user = User.objects.get(id=response.data['id'])
+        self.assertFalse(user.has_usable_password())
+
+        token = create_invitations([user])[user.id]
+        url = reverse('api:user-accept-invitation')
+        with override_settings(AUTH_PASSWORD_VALIDATORS=[
+                {'NAME': 'django.contrib.auth.password_validation.MinimumLengthValidator'}]):
+            response = self.client.post(url, {'token': token, 'password': 'short'}, format='json')
+        # The token is still valid
+        self.assertEqual(response.data['status'], status.HTTP_400_BAD_REQUEST)
+        response = self.client.post(url, {'token': token, 'password': 'secret'}, format='json')
+        self.assertEqual(response.data['status'], status.HTTP_200_OK)
+        self.assertTrue(User.objects.get(id=user.id).check_password('secret'))
+
+        response = self.client.post(url, {'token': token, 'password': 'other'}, format='json')
+        self.assertEqual(response.data['status'], status.HTTP_404_NOT_FOUND)
+
+
+@override_settings(USER_GROUP_MEMBERS_PAGE_SIZE=2, USER_GROUP_PREVIEW_SIZE=1)
+class GroupTests(APITestCase):
+    fixtures = ['test']
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.login(username='admin@grandclass.net', password='123qwe')
+        self.group = Group.objects.first()
+        self.group.users.add(*User.objects.all())
+
+    def test_detail(self):
+        """
+        Ensure the group has a count and a preview of members instead of all of them.
+        """
+        response = self.client.get(reverse('api:group-detail', kwargs={'pk': self.group.id}))
+
+        self.assertEqual(response.data['users_count'], self.group.users.count())
+        self.assertEqual([user['id'] for user in response.data['users_preview']],
+                         [self.group.users.order_by('id').first().id])
+        self.assertNotIn('users', response.data)
+
+    def test_list_preview(self):
+        """
+        Ensure previews of all the groups are loaded with a fixed number of queries.
+        """
+        def user_queries():
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.get(reverse('api:group-list'))
+            table = 'FROM "{}"'.format(User._meta.db_table)
+            return response, len([query for query in queries if table in query['sql']])
+
+        response, count = user_queries()
+        other = Group.objects.create(site_id=1, title='Другая группа')
+        other.users.add(*User.objects.order_by('-id')[:2])
+        response, other_count = user_queries()
+        self.assertEqual(other_count, count)
+
+        previews = {group['id']: [user['id'] for user in group['users_preview']] for group in response.data}
+        self.assertEqual(previews[self.group.id], [self.group.users.order_by('id').first().id])
+        self.assertEqual(previews[other.id], [other.users.order_by('id').first().id])
+
+    def test_members(self):
+        """
+        Ensure members are paged by cursor and searched by name or email.
+        """
+        url = reverse('api:group-members', kwargs={'pk': self.group.id})
+        ids = list()
+        while url:
+            response = self.client.get(url)
+            self.assertLessEqual(len(response.data['results']), 2)
+            ids += [user['id'] for user in response.data['results']]
+            url = response.data['next']
+        self.assertEqual(ids, list(self.group.users.order_by('id').values_list('id', flat=True)))
+
+        response = self.client.get(reverse('api:group-members', kwargs={'pk': self.group.id}), {'search': 'TEACHER@'})
+        self.assertEqual([user['email'] for user in response.data['results']], ['teacher@grandclass.net'])
@@ -0,0 +1,53 @@
+from datetime import timedelta
+
+from django.test import TestCase
+from django.utils import timezone
+
+from user.archive import archivable_users, archive_user, restore_user
+from user.models import User, Group, Note, ArchivedUser, ChangeEvent
+
+
+class ArchiveTest(TestCase):
+    fixtures = ['test']
+
+    def setUp(self):
+        self.user = User.objects.filter(role='student').first()
+        self.user.is_active = False
+        self.user.deactivated_at = timezone.now() - timedelta(days=400)
+        self.user.save()
+
+    def test_archivable_users(self):
+        """
+        Ensure only users inactive longer than the period are archived
+        """
+        self.assertIn(self.user, archivable_users(days=365))
+        self.assertNotIn(self.user, archivable_users(days=500))
+
+    def test_archive_and_restore(self):
+        """
+        Ensure archived user is removed from User table and can be restored
+        """
+        Note.objects.create(site_id=self.user.site_id, user=self.user, title='title')
+        user_id, groups = self.user.id, list(self.user.groups.values_list('id', flat=True))
+
+        archived = archive_user(self.user)
+        self.assertFalse(User.objects.filter(id=user_id).exists())
+        self.assertFalse(Note.objects.filter(title='title').exists())
+
+        user = restore_user(archived)
+        self.assertEqual(user.id, user_id)
+        self.assertEqual(user.email, self.user.email)
+        self.assertEqual(list(user.groups.values_list('id', flat=True)), groups)
+        note = Note.objects.get(user=user, title='title')
+        self.assertTrue(ChangeEvent.objects.filter(object_type='note', object_id=note.id, action='created').exists())
+        self.assertFalse(ArchivedUser.objects.exists())
+        self.assertTrue(user.is_active)
+        self.assertNotIn(user, archivable_users(days=365))
+
+    def test_referenced_user(self):
+        """
+        Ensure users, whose deletion would null references to them, are not archived
+        """
+        Group.objects.create(site_id=self.user.site_id, title='Группа', author=self.user)
+        self.assertIsNone(archive_user(self.user))
+        self.assertTrue(User.objects.filter(id=self.user.id).exists())
@@ -0,0 +1,68 @@
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+
+from rest_framework.test import APIClient, APITestCase
+
+from course.models import Course
+from user.authentication import SNAPSHOT_KEY, authored_course_ids, get_cached_user
+from user.models import User
+
+MIDDLEWARE = [name.replace('django.contrib.auth.middleware.AuthenticationMiddleware',
+                           'user.authentication.CachedUserMiddleware') for name in settings.MIDDLEWARE]
+
+
+class CachedUserTest(APITestCase):
+    fixtures = ['test']
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.get(email='teacher@grandclass.net')
+        self.client = APIClient()
+        self.url = reverse('api:user-profile')
+
+    def test_snapshot(self):
+        """
+        Ensure the user is resolved from the cache and forgotten on save.
+        """
+        get_cached_user(self.user.id)
+        with self.assertNumQueries(0):
+            user = get_cached_user(self.user.id)
+            self.assertEqual(user, self.user)
+            self.assertEqual(user.role, 'teacher')
+            self.assertEqual(authored_course_ids(user), set())
+            self.assertEqual(user.get_session_auth_hash(), self.user.get_session_auth_hash())
+        self.assertNotIn(self.user.password, str(cache.get(SNAPSHOT_KEY.format(self.user.id))))
+
+        course = Course.objects.create(title='Курс')
+        course.authors.add(self.user)
+        self.assertEqual(authored_course_ids(get_cached_user(self.user.id)), {course.id})
+
+        self.user.role = 'admin'
+        self.user.save()
+        self.assertEqual(get_cached_user(self.user.id).role, 'admin')
+
+    def test_session(self):
+        """
+        Ensure requests do not load the user, and a password change logs the session out.
+        """
+        with self.settings(AUTHENTICATION_BACKENDS=['user.authentication.CachedModelBackend'],
+                           MIDDLEWARE=MIDDLEWARE):
+            self.client.login(username='teacher@grandclass.net', password='123qwe')
+            self.assertEqual(self.client.get(self.url).data['id'], self.user.id)
+
+            with CaptureQueriesContext(connection) as queries:
+                self.client.get(reverse('api:note-list'))
+            self.assertFalse([query for query in queries if 'FROM "{}"'.format(User._meta.db_table) in query['sql']])
+
+            # Other fields are loaded with one query
+            with CaptureQueriesContext(connection) as queries:
+                self.client.get(self.url)
+            self.assertEqual(len([query for query in queries if 'FROM "{}"'.format(User._meta.db_table)
+                                  in query['sql']]), 1)
+
+            self.user.set_password('new password')
+            self.user.save()
+            self.assertEqual(self.client.get(self.url).data['role']['value'], 'anonymous')
@@ -0,0 +1,86 @@
+from django.test import override_settings
+from django.urls import reverse
+
+from rest_framework.test import APIClient, APITestCase
+
+from user.models import User, Group, ChangeEvent
+
+
+@override_settings(USER_CHANGES_DELAY=0, USER_CHANGES_BATCH_SIZE=2)
+class ChangesTest(APITestCase):
+    fixtures = ['test']
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.login(username='admin@grandclass.net', password='123qwe')
+        self.url = reverse('api:user-changes')
+        ChangeEvent.objects.all().delete()
+
+    def read_feed(self, since=0):
+        events = list()
+        while True:
+            response = self.client.get(self.url, {'since': since})
+            self.assertEqual(response.status_code, 200)
+            if not response.data['results']:
+                return events, since
+            events += response.data['results']
+            since = response.data['next']
+
+    def test_feed(self):
+        """
+        Ensure changes are in the feed in order, and only once.
+        """
+        student = User.objects.get(email='student@grandclass.net')
+        group = Group.objects.create(site_id=1, title='Новая группа')
+        group.users.add(student)
+        student.first_name = 'Иван'
+        student.save()
+        # Not in the event data
+        student.save(update_fields=['last_login'])
+        group.users.clear()
+        group_id = group.id
+        group.delete()
+
+        events, cursor = self.read_feed()
+        self.assertEqual([(event['type'], event['action']) for event in events], [
+            ('group', 'created'), ('membership', 'added'), ('user', 'updated'), ('membership', 'removed'),
+            ('group', 'deleted'),
+        ])
+        self.assertEqual(events[1]['data'], {'group_id': group_id})
+        self.assertEqual(events[2]['data']['first_name'], 'Иван')
+        self.assertEqual(self.read_feed(cursor), ([], cursor))
+
+    def test_bulk(self):
+        """
+        Ensure bulk registration and deactivation are in the feed.
+        """
+        group = Group.objects.first()
+        self.client.post(reverse('api:user-register-bulk'), {'users': [
+            {'email': 'new@grandclass.net', 'groups': [group.id]},
+        ]}, format='json')
+        user = User.objects.get(email='new@grandclass.net')
+        self.client.post(reverse('api:user-batch-delete'), {'ids': [user.id]}, format='json')
+
+        events, cursor = self.read_feed()
+        self.assertEqual([(event['type'], event['id'], event['action']) for event in events], [
+            ('user', user.id, 'created'), ('membership', user.id, 'added'), ('user', user.id, 'updated'),
+        ])
+        self.assertFalse(events[2]['data']['is_active'])
+
+    def test_deleted_author(self):
+        """
+        Ensure references cleared by the deletion of a user are in the feed.
+        """
+        teacher = User.objects.get(email='teacher@grandclass.net')
+        group = Group.objects.create(site_id=1, title='Группа', author=teacher)
+        ChangeEvent.objects.all().delete()
+        teacher.delete()
+
+        events, cursor = self.read_feed()
+        self.assertIn(('group', group.id, 'updated'), [(event['type'], event['id'], event['action'])
+                                                       for event in events])
+        self.assertIsNone([event for event in events if event['type'] == 'group'][0]['data']['author_id'])
+
+    def test_admin_only(self):
+        self.client.login(username='teacher@grandclass.net', password='123qwe')
+        self.assertEqual(self.client.get(self.url).status_code, 403)
@@ -0,0 +1,30 @@
+from django.test import TestCase
+
+from user.forms import user_form_change_class
+from user.models import User
+
+
+class UserFormChangeTest(TestCase):
+    fixtures = ['test']
+
+    def test_form_class_cache(self):
+        """
+        Ensure form class is built once and rebuilt after custom fields change
+        """
+        organization = User.objects.first().organization
+        form_class = user_form_change_class(organization)
+        self.assertIs(user_form_change_class(organization), form_class)
+
+        organization.custom_fields.create(name='new field', field_type=2)
+        form_class = user_form_change_class(organization)
+        self.assertIn('new field', form_class.base_fields)
+
+    def test_initial(self):
+        """
+        Ensure custom field values are bound per instance
+        """
+        user = User.objects.first()
+        field = user.organization.custom_fields.create(name='new field', field_type=2,
+                                                       values={user.email: 'value'})
+        form = user_form_change_class(user.organization)(instance=user)
+        self.assertEqual(form.initial[field.name], 'value')
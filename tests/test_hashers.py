@@ -0,0 +1,44 @@
+from django.contrib.auth.hashers import get_hasher
+from django.test import override_settings
+from django.urls import reverse
+
+from rest_framework.test import APIClient, APITestCase
+
+from user.hashers import CalibratedPBKDF2PasswordHasher, calibrate
+from user.models import User
+
+
+@override_settings(PASSWORD_HASHERS=['user.hashers.CalibratedPBKDF2PasswordHasher',
+                                     'django.contrib.auth.hashers.MD5PasswordHasher'],
+                   USER_PASSWORD_COST={'pbkdf2_sha256': {'iterations': 2000}},
+                   USER_PASSWORD_BULK_COST={'pbkdf2_sha256': {'iterations': 1000}})
+class HashersTest(APITestCase):
+    fixtures = ['test']
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.login(username='admin@grandclass.net', password='123qwe')
+
+    def iterations(self, email):
+        return int(User.objects.get(email=email).password.split('$')[1])
+
+    def test_rehash_on_login(self):
+        """
+        Ensure accounts created in bulk get the bulk cost, and the full one on login.
+        """
+        self.client.post(reverse('api:user-register-bulk'),
+                         [{'email': 'bulk@example.com', 'password': 'secret'}], format='json')
+        self.assertEqual(self.iterations('bulk@example.com'), 1000)
+
+        response = APIClient().post(reverse('api:user-login'), {'email': 'bulk@example.com', 'password': 'secret'})
+        self.assertEqual(response.data['status'], 200)
+        self.assertEqual(self.iterations('bulk@example.com'), 2000)
+        self.assertEqual(get_hasher('default').iterations, 2000)
+
+    def test_calibrate(self):
+        """
+        Ensure a longer target gives a higher cost.
+        """
+        fast = calibrate(CalibratedPBKDF2PasswordHasher, 0.001)['iterations']
+        slow = calibrate(CalibratedPBKDF2PasswordHasher, 0.05)['iterations']
+        self.assertLess(fast, slow)
@@ -0,0 +1,98 @@
+import os
+import subprocess
+import sys
+
+from django.conf import settings
+from django.test import SimpleTestCase
+
+# Modules of the app, which are imported on startup
+APP_MODULES = ['user.models', 'user.views']
+# Import time of user.views at most this part of django.setup() (with user.models) in the same interpreter.
+# A ratio holds on slow machines, where absolute times do not
+VIEWS_IMPORT_RATIO = 0.4
+# Imported only where they are used
+LAZY_MODULES = ['openpyxl', 'dateutil', 'pytz', 'email_validator', 'core.utils']
+
+# Django imports app modules with importlib, which -X importtime does not report,
+# so the script imports them with __import__ instead
+SCRIPT = '''
+import django
+import django.apps.config
+django.apps.config.import_module = lambda name, package=None: __import__(name, fromlist=['__name__'])
+django.setup()
+import user.views
+'''
+
+TIMING_SCRIPT = '''
+import time
+start = time.perf_counter()
+import django
+django.setup()
+setup = time.perf_counter()
+import user.views
+print(setup - start, time.perf_counter() - setup)
+'''
+
+
+def subprocess_env():
+    return dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path), DJANGO_SETTINGS_MODULE=settings.SETTINGS_MODULE)
+
+
+def views_import_ratio(repeat=3):
+    """
+    :return: the smallest ratio of user.views import time to django.setup() time of fresh interpreters
+    """
+    ratios = list()
+    for i in range(repeat):
+        output = subprocess.run([sys.executable, '-c', TIMING_SCRIPT], env=subprocess_env(), check=True,
+                                stdout=subprocess.PIPE).stdout.decode()
+        setup, views = map(float, output.split())
+        ratios.append(views / setup)
+    return min(ratios)
+
+
+def imported_modules():
+    """
+    Import times vary between runs and hosts, so only the import tree
+    of -X importtime is used: it does not depend on the timing
+    :return: {module: names of modules imported by it}
+    """
+    output = subprocess.run([sys.executable, '-X', 'importtime', '-c', SCRIPT], env=subprocess_env(), check=True,
+                            stderr=subprocess.PIPE).stderr.decode()
+
+    entries = list()  # (level, name)
+    for line in output.splitlines():
+        if not line.startswith('import time:') or '[us]' in line:
+            continue
+        name = line[len('import time:'):].split('|')[2]
+        entries.append(((len(name) - len(name.lstrip()) - 1) // 2, name.strip()))
+
+    result = dict()
+    for i, (level, name) in enumerate(entries):
+        # Nested imports are reported before the module, one level deeper
+        children, j = list(), i - 1
+        while j >= 0 and entries[j][0] > level:
+            children.append(entries[j][1])
+            j -= 1
+        result[name] = children
+    return result
+
+
+class ImportTimeTest(SimpleTestCase):
+    def test_lazy_imports(self):
+        """
+        Ensure heavy libraries are not imported with the app
+        """
+        modules = imported_modules()
+        for module in APP_MODULES:
+            for name in modules[module]:
+                self.assertFalse(any(name == lazy or name.startswith(lazy + '.') for lazy in LAZY_MODULES),
+                                 '{} imports {}'.format(module, name))
+
+    def test_import_budget(self):
+        """
+        Ensure user.views imports fast relative to Django startup
+        """
+        ratio = views_import_ratio()
+        self.assertLessEqual(ratio, VIEWS_IMPORT_RATIO,
+                             'user.views imports in {:.0%} of django.setup() time'.format(ratio))
@@ -0,0 +1,59 @@
+import json
+
+from django.contrib.sites.models import Site
+from django.core import mail
+from django.test import TestCase, override_settings
+
+from user.mailing import clean_segment, segment_queryset, send_mailing, start_mailing
+from user.models import User, Mailing
+
+
+@override_settings(USER_MAILING_RATE=0, USER_MAILING_BATCH_SIZE=1)
+class MailingTest(TestCase):
+    fixtures = ['test']
+
+    def setUp(self):
+        self.site = Site.objects.get(pk=1)
+
+    def test_segment(self):
+        """
+        Ensure unsubscribed users are not in the segment
+        """
+        segment = clean_segment(self.site, {'role': 'student'})
+        self.assertTrue(segment_queryset(self.site, segment).exists())
+        User.objects.filter(role='student').update(is_unsubscribed=True)
+        self.assertFalse(segment_queryset(self.site, segment).exists())
+
+        with self.assertRaises(ValueError):
+            clean_segment(self.site, {'role': 'unknown'})
+
+    def test_send_and_resume(self):
+        """
+        Ensure every recipient gets the email once, also after an interrupted run
+        """
+        users = list(User.objects.filter(site=self.site, is_active=True).order_by('id'))
+        mailing = start_mailing(self.site, None, 'Новости', 'Здравствуйте, {{ user.first_name }}!', {})
+        # Emulate a worker, which crashed after the first recipient
+        Mailing.objects.filter(pk=mailing.pk).update(status='failed', sent=1, last_user_id=users[0].id)
+
+        send_mailing(mailing.pk)
+        self.assertEqual(len(mail.outbox), 0)
+
+        send_mailing(mailing.pk, resume=True)
+        mailing.refresh_from_db()
+        self.assertEqual(mailing.status, 'done')
+        self.assertEqual(mailing.sent, len(users))
+        self.assertEqual([message.to[0] for message in mail.outbox], [user.email for user in users[1:]])
+        self.assertIn('Здравствуйте, {}!'.format(users[1].first_name), mail.outbox[0].body)
+        self.assertIn(str(users[1].unsubscribe_code), mail.outbox[0].extra_headers['List-Unsubscribe'])
+        self.assertEqual(json.loads(mailing.segment), {})
+
+    def test_template_context(self):
+        """
+        Ensure the body gets only whitelisted fields of the user
+        """
+        mailing = start_mailing(self.site, None, 'Новости',
+                                '{{ user.full_name }}|{{ user.password }}|{{ user.site.domain }}', {})
+        send_mailing(mailing.pk)
+        user = User.objects.filter(site=self.site, is_active=True).order_by('id').first()
+        self.assertEqual(mail.outbox[0].body, '{}||'.format(user.full_name))
@@ -1,5 +1,9 @@
+from io import StringIO
+
+from django.core.management import call_command
 from django.test import TestCase
 
+from user.custom_fields import custom_field_names, schema_version
 from user.models import User, Group
 
 
@@ -13,6 +17,15 @@ class UserModelTest(TestCase):
         user = User.objects.first()
         self.assertEqual(str(user), '({}) - {} - {}'.format(user.site.domain, user.email, user.full_name))
 
+    def test_normalize_emails(self):
+        """
+        Ensure normalize_emails fills email_normalized like normalize_email
+        """
+        User.objects.filter(email='student@grandclass.net').update(email=' Student@GrandClass.net ',
+                                                                   email_normalized=None)
+        call_command('normalize_emails', stdout=StringIO())
+        self.assertTrue(User.objects.filter(email_normalized='student@grandclass.net').exists())
+
     def test_short_name(self):
         """
         Ensure we can get_short_name
@@ -44,3 +57,25 @@ class GroupModelTest(TestCase):
         """
         group = Group.objects.create(site_id=1, title='title')
         self.assertEqual(str(group), group.title)
+
+
+class CustomFieldsSchemaTest(TestCase):
+    fixtures = ['test']
+
+    def test_custom_field_names_invalidation(self):
+        """
+        Ensure cached custom field names change with the schema, but not with values
+        """
+        organization = User.objects.first().organization
+        names = custom_field_names(organization)
+        version = schema_version(organization.id)
+
+        field = organization.custom_fields.first()
+        field.values.update({'new@example.com': 'value'})
+        field.save(update_fields=['values'])
+        self.assertEqual(schema_version(organization.id), version)
+
+        field.name = 'renamed'
+        field.save()
+        self.assertNotEqual(custom_field_names(organization), names)
+        self.assertIn('renamed', custom_field_names(organization))
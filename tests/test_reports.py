@@ -0,0 +1,158 @@
+import io
+import json
+from datetime import timedelta
+from decimal import Decimal
+from unittest import mock
+
+from django.contrib.sites.models import Site
+from django.core.files.storage import default_storage
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test import override_settings
+from django.urls import reverse
+from django.utils import timezone
+from PIL import Image
+from rest_framework import status
+from rest_framework.test import APITestCase
+
+from user.conf import app_settings
+from user.diplomas import render_diplomas
+from user.models import User, Group, Diploma, ReportJob
+from user.reports import REPORTS, start_report, run_report, purge_reports, fail_stale_reports
+
+
+class ReportJobTest(APITestCase):
+    fixtures = ['test']
+
+    def setUp(self):
+        self.client.login(username='admin@grandclass.net', password='123qwe')
+        self.site = Site.objects.get(pk=1)
+        self.params = {'users': list(User.objects.values_list('id', flat=True))}
+
+    def tearDown(self):
+        purge_reports(timezone.now())
+
+    def test_start_report(self):
+        """
+        Ensure the export is built in the background and identical requests share the job
+        """
+        response = self.client.post(reverse('api:user-export'), self.params, format='json')
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+        job = ReportJob.objects.get(pk=response.data['id'])
+        self.assertEqual(job.status, 'pending')
+
+        response = self.client.post(reverse('api:user-export'), self.params, format='json')
+        self.assertEqual(response.data['id'], str(job.id))
+
+        run_report(job.id)
+        response = self.client.get(reverse('api:reportjob-detail', kwargs={'pk': job.id}))
+        self.assertEqual(response.data['status']['value'], 'done')
+        self.assertEqual(response.data['progress'], 100)
+
+        response = self.client.get(reverse('api:reportjob-download', kwargs={'pk': job.id}))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(b''.join(response.streaming_content).startswith(b'PK'))
+
+        # Done report is reused until the users change
+        self.assertEqual(start_report(self.site, None, 'export', self.params), job)
+        User.objects.first().save()
+        self.assertNotEqual(start_report(self.site, None, 'export', self.params), job)
+
+    def test_stale_report(self):
+        """
+        Ensure a job orphaned by a restart is not reused and is marked failed
+        """
+        job = start_report(self.site, None, 'export', self.params)
+        ReportJob.objects.filter(pk=job.pk).update(status='running', updated_at=timezone.now() - timedelta(hours=1))
+        self.assertNotEqual(start_report(self.site, None, 'export', self.params), job)
+
+        self.assertEqual(fail_stale_reports(), 1)
+        self.assertEqual(ReportJob.objects.get(pk=job.pk).status, 'failed')
+
+    def test_sales_decimal(self):
+        """
+        Ensure sales with Decimal amounts are built
+        """
+        report = REPORTS['sales']
+        with mock.patch.object(report, 'get_data', return_value=[{'id': 1, 'courses': Decimal('1.50')}]):
+            content = report.build(self.site, {})
+        self.assertEqual(json.loads(content.decode()), [{'id': 1, 'courses': '1.50'}])
+
+    def test_invalid_params(self):
+        """
+        Ensure a report with bad parameters is not started
+        """
+        response = self.client.post(reverse('api:user-sales'), {'date_start': 'yesterday'}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_batch_diplomas(self):
+        """
+        Ensure diplomas are created for every user of the group
+        """
+        group = Group.objects.first()
+        content = io.BytesIO()
+        Image.new('RGB', (400, 300), 'white').save(content, 'PNG')
+        template = SimpleUploadedFile('template.png', content.getvalue(), content_type='image/png')
+
+        response = self.client.post(reverse('api:diploma-batch'),
+                                    {'template': template, 'group': group.id, 'description': 'Выпуск'})
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+        job_id = response.data['id']
+        upload = ReportJob.objects.get(pk=job_id).upload.name
+        self.assertTrue(default_storage.exists(upload))
+
+        # The same template under another name shares the job
+        template = SimpleUploadedFile('copy.png', content.getvalue(), content_type='image/png')
+        response = self.client.post(reverse('api:diploma-batch'),
+                                    {'template': template, 'group': group.id, 'description': 'Выпуск'})
+        self.assertEqual(response.data['id'], job_id)
+
+        run_report(job_id)
+        self.assertFalse(ReportJob.objects.get(pk=job_id).upload)
+        self.assertFalse(default_storage.exists(upload))
+
+        diplomas = Diploma.objects.filter(description='Выпуск')
+        self.assertEqual(sorted(diplomas.values_list('user', flat=True)),
+                         sorted(group.users.filter(is_active=True).values_list('id', flat=True)))
+        for diploma in diplomas:
+            self.assertEqual(Image.open(diploma.image).size, (400, 300))
+            diploma.image.delete(save=False)
+
+    def start_diplomas(self):
+        content = io.BytesIO()
+        Image.new('RGB', (400, 300), 'white').save(content, 'PNG')
+        template = SimpleUploadedFile('template.png', content.getvalue(), content_type='image/png')
+        users = list(User.objects.values_list('id', flat=True))
+        response = self.client.post(reverse('api:diploma-batch'),
+                                    {'template': template, 'users': users, 'description': 'Выпуск'})
+        return response.data['id']
+
+    @override_settings(USER_DIPLOMA_FONT='missing.ttf')
+    def test_missing_font(self):
+        """
+        Ensure diplomas are not drawn with a font without cyrillic letters
+        """
+        job_id = self.start_diplomas()
+        run_report(job_id)
+        job = ReportJob.objects.get(pk=job_id)
+        self.assertEqual(job.status, 'failed')
+        self.assertIn('USER_DIPLOMA_FONT', job.error)
+
+    @override_settings(USER_DIPLOMA_PROCESSES=0, USER_DIPLOMA_CHUNK_SIZE=1)
+    def test_failed_diplomas(self):
+        """
+        Ensure diplomas and images of a batch failed partway are deleted
+        """
+        def render(template, names, options):
+            yield render_diplomas(template, names[:1], dict(options, font=app_settings.DIPLOMA_FONT))
+            raise ValueError('Rendering failed')
+
+        job_id = self.start_diplomas()
+        with mock.patch('user.reports.render_in_processes', render), \
+                mock.patch('user.reports.default_storage.delete', wraps=default_storage.delete) as delete:
+            run_report(job_id)
+        self.assertEqual(ReportJob.objects.get(pk=job_id).status, 'failed')
+        self.assertFalse(Diploma.objects.filter(description='Выпуск').exists())
+        # The image of the first chunk and the template
+        names = [call[0][0] for call in delete.call_args_list]
+        self.assertEqual(len(names), 2)
+        self.assertFalse(any(default_storage.exists(name) for name in names))
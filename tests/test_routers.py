@@ -0,0 +1,65 @@
+from unittest import mock, skipUnless
+
+from django.conf import settings
+from django.db import connections
+from django.test import TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+
+from rest_framework.test import APIClient
+
+from user.versions import touch_site
+
+
+@skipUnless('replica' in settings.DATABASES, 'Needs "replica" database, see user.routers')
+@override_settings(DATABASE_ROUTERS=['user.routers.ReplicaRouter'], USER_READ_REPLICAS=['replica'])
+class ReplicaRoutingTest(TransactionTestCase):
+    multi_db = True
+    fixtures = ['test']
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.login(username='admin@grandclass.net', password='123qwe')
+
+    def request(self, method, url, data=None):
+        """
+        :return: number of queries executed on each database
+        """
+        with CaptureQueriesContext(connections['default']) as default, \
+                CaptureQueriesContext(connections['replica']) as replica:
+            getattr(self.client, method)(url, data, format='json')
+        return {'default': len(default), 'replica': len(replica)}
+
+    def test_list_reads_replica(self):
+        """
+        Ensure safe requests to list read from the replica
+        """
+        with mock.patch('user.routers.site_version', return_value=0):
+            queries = self.request('get', reverse('api:user-list'))
+        self.assertGreater(queries['replica'], 0)
+
+    def test_recent_change_reads_primary(self):
+        """
+        Ensure the site is read from the primary right after its data changed
+        """
+        touch_site(1)
+        queries = self.request('get', reverse('api:user-list'))
+        self.assertEqual(queries['replica'], 0)
+
+    def test_write_uses_primary(self):
+        """
+        Ensure writing requests do not touch the replica
+        """
+        queries = self.request('post', reverse('api:user-register'),
+                               {'email': 'new@example.com', 'password': '123qwe', 'role': 'student'})
+        self.assertEqual(queries['replica'], 0)
+        self.assertGreater(queries['default'], 0)
+
+    def test_lagging_replica(self):
+        """
+        Ensure reads fall back to the primary when the replica is lagging
+        """
+        with mock.patch('user.routers.replica_lag', return_value=float('inf')), \
+                mock.patch('user.routers.site_version', return_value=0):
+            queries = self.request('get', reverse('api:group-list'))
+        self.assertEqual(queries['replica'], 0)
@@ -0,0 +1,143 @@
+import json
+from io import StringIO
+from unittest import mock, skipUnless
+
+from django.conf import settings
+from django.contrib.sites.models import Site
+from django.core.cache import cache
+from django.core.management import call_command, CommandError
+from django.test import TestCase, TransactionTestCase, override_settings
+
+from organization.models import AccessRequest
+
+from user.models import User, Group, SiteShard, ChangeEvent
+from user.routers import SiteShardRouter, set_current_site, shard_for_site
+from user.streaming import stream_users
+
+
+@override_settings(DATABASE_ROUTERS=['user.routers.SiteShardRouter'])
+class SiteShardRouterTest(TestCase):
+    fixtures = ['test']
+
+    def setUp(self):
+        cache.clear()
+
+    def test_default_shard(self):
+        """
+        Ensure sites without SiteShard stay in default database
+        """
+        self.assertEqual(SiteShardRouter().db_for_read(User), 'default')
+
+    def test_site_shard(self):
+        """
+        Ensure queries and new objects of the site go to its shard
+        """
+        SiteShard.objects.create(site_id=1, alias='shard')
+        router = SiteShardRouter()
+        with override_settings(SITE_ID=1):
+            self.assertEqual(router.db_for_read(User), 'shard')
+        self.assertEqual(router.db_for_write(Group, instance=Group(site_id=1)), 'shard')
+        self.assertIsNone(router.db_for_read(Site))
+
+    def test_request_site(self):
+        """
+        Ensure queries go to the shard of the site of the current request
+        """
+        site = Site.objects.create(domain='sharded', name='sharded')
+        SiteShard.objects.create(site=site, alias='shard')
+        router = SiteShardRouter()
+        set_current_site(site.id)
+        try:
+            self.assertEqual(router.db_for_read(User), 'shard')
+        finally:
+            set_current_site(None)
+        self.assertEqual(router.db_for_read(User), 'default')
+        self.assertEqual(router.db_for_read(User, instance=site), 'shard')
+
+
+@skipUnless('shard' in settings.DATABASES, 'Needs "shard" database, see user.routers')
+# The shard map is read from the database in every process
+@override_settings(DATABASE_ROUTERS=['user.routers.SiteShardRouter'], USER_SHARDS=['default', 'shard'],
+                   CACHES={'default': {'BACKEND': 'django.core.cache.backends.dummy.DummyCache'}})
+class MoveSiteShardTest(TransactionTestCase):
+    multi_db = True
+
+    def setUp(self):
+        cache.clear()
+
+    def test_move_site(self):
+        """
+        Ensure site data is moved to the new shard and the queries follow it
+        """
+        site = Site.objects.create(domain='moved', name='moved')
+        user = User(site=site, email='moved@example.com', first_name='Moved', last_name='User')
+        user.save()
+        group = Group.objects.create(site=site, title='group')
+        user.groups.add(group)
+
+        # Events of other sites stay in the source, after the ones of the site
+        Group.objects.create(site=Site.objects.create(domain='other', name='other'), title='other')
+        last_event = ChangeEvent.objects.using('default').order_by('id').last().id
+
+        call_command('move_site_shard', str(site.id), 'shard', chunk_size=1, stdout=StringIO())
+
+        self.assertFalse(User.objects.using('default').filter(site=site).exists())
+        with override_settings(SITE_ID=site.id):
+            moved = User.objects.get(email='moved@example.com')
+            self.assertEqual(moved._state.db, 'shard')
+            self.assertEqual(list(moved.groups.values_list('title', flat=True)), ['group'])
+            # Cursors of the changes feed stay valid
+            moved.save()
+            self.assertGreater(ChangeEvent.objects.using('shard').order_by('id').last().id, last_event)
+
+    def test_local_cache(self):
+        """
+        Ensure a site is not moved, when other processes would not see the new shard
+        """
+        site = Site.objects.create(domain='local', name='local')
+        with override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}):
+            with self.assertRaisesMessage(CommandError, 'local to the process'):
+                call_command('move_site_shard', str(site.id), 'shard', stdout=StringIO())
+
+    def test_referenced_site(self):
+        """
+        Ensure a site, whose users are referenced by other apps, is not moved
+        """
+        site = Site.objects.create(domain='referenced', name='referenced')
+        user = User(site=site, email='referenced@example.com', first_name='Referenced', last_name='User')
+        user.save()
+        AccessRequest.objects.create(user=user)
+
+        with self.assertRaisesMessage(CommandError, 'organization.AccessRequest.user'):
+            call_command('move_site_shard', str(site.id), 'shard', stdout=StringIO())
+        self.assertEqual(shard_for_site(site.id), 'default')
+        self.assertFalse(User.objects.using('shard').filter(site=site).exists())
+
+
+@skipUnless('shard' in settings.DATABASES, 'Needs "shard" database, see user.routers')
+@override_settings(DATABASE_ROUTERS=['user.routers.SiteShardRouter'], USER_SHARDS=['default', 'shard'])
+class StreamShardTest(TransactionTestCase):
+    multi_db = True
+
+    def setUp(self):
+        cache.clear()
+
+    def test_stream_site_shard(self):
+        """
+        Ensure the streamed list reads the shard of the request site, also after the routing is reset
+        """
+        site = Site.objects.create(domain='streamed', name='streamed')
+        site.save(using='shard')
+        SiteShard.objects.create(site=site, alias='shard')
+        User(site=site, email='streamed@example.com', first_name='Streamed', last_name='User').save()
+
+        set_current_site(site.id)
+        try:
+            response = stream_users(User.objects.filter(site=site))
+        finally:
+            # As SiteShardMiddleware.process_response does before the response is consumed
+            set_current_site(None)
+        # The new site has no organization with custom fields
+        with mock.patch('user.fast_serializers._custom_fields', return_value={site.id: []}):
+            users = json.loads(b''.join(response.streaming_content).decode())
+        self.assertEqual([user['email'] for user in users], ['streamed@example.com'])
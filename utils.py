@@ -5,3 +5,20 @@ def get_choices(field, dropdown=False):
     if dropdown and choices:
         choices.insert(0, ('', '---'))
     return choices
+
+
+def custom_field_value(field, value):
+    """
+    Converts value sent from frontend to the form
+    it is stored in CustomField values
+    """
+    if field.field_type in [6, 7]:  # 6 is DateField, 7 is DateTimeField
+        import dateutil.parser
+        from pytz import timezone
+
+        # Currently we get time in UTC from frontend, so we need to represent it in local TZ
+        # To store time in each user's local timezone, change timezone() below
+        value = dateutil.parser.parse(value).astimezone(timezone('Europe/Moscow'))
+        if field.field_type == 6:
+            value = value.date()
+    return str(value)
@@ -0,0 +1,31 @@
+"""
+Per-site change version of the user app data.
+It is the time of the last change of users, groups, notes, diplomas
+(and data shown with them) on the site, bumped from user.signals.
+
+The version is kept in the default cache, which must be shared by all
+the processes, which change the data (web workers, management commands,
+report workers): with a per-process LocMemCache a change made in another
+process does not change the ETag, and clients get 304 with stale data.
+"""
+import time
+
+from django.core.cache import cache
+
+SITE_VERSION_KEY = 'user:site_version:{}'
+
+
+def site_version(site_id):
+    key = SITE_VERSION_KEY.format(site_id)
+    version = cache.get(key)
+    if version is None:
+        # Unknown version (e.g. after cache restart) must not match old validators
+        cache.add(key, time.time(), None)
+        version = cache.get(key)
+    # A cache, which keeps nothing (DummyCache), gives a new version every time
+    return time.time() if version is None else version
+
+
+def touch_site(*site_ids):
+    now = time.time()
+    cache.set_many({SITE_VERSION_KEY.format(site_id): now for site_id in set(site_ids) if site_id}, None)
@@ -1,35 +1,78 @@
-import dateutil.parser
 import random
 import string
 import json
+import uuid
+from collections import OrderedDict
 
 from django.contrib.auth.models import AnonymousUser
-from openpyxl import Workbook, load_workbook
-from datetime import datetime, timedelta
-from pytz import timezone
 from django.conf import settings
-from django.contrib.auth import authenticate, login
-from django.db.models import Q
-from django.http import HttpResponse
-from django.template.loader import render_to_string
+from django.core.exceptions import ValidationError
+from django.contrib.auth import authenticate, login, password_validation
+from django.contrib.auth.hashers import make_password
+from django.db import transaction, IntegrityError
+from django.db.models import Count, Q
+from django.http import HttpResponse, FileResponse, Http404
+from django.utils import timezone
 
 from rest_framework import views, status
 from rest_framework.decorators import list_route, detail_route
 from rest_framework.parsers import MultiPartParser
+from rest_framework.renderers import JSONRenderer
 from rest_framework.response import Response
+from rest_framework.settings import api_settings
 
 from core import viewsets
-from payment.models import Payment
 from organization.models import AccessRequest
-from .models import User, Group, Note, Diploma
+from . import tasks
+from .archive import restore_user
+from .authentication import authored_course_ids, forget_users
+from .changes import changes_since, record_changes, record_memberships
+from .conditional import ConditionalGetMixin
+from .conf import app_settings
+from .facets import cached_facets
+from .hashers import bulk_hasher
+from .fast_serializers import serialize_users
+from .models import User, Group, Note, Diploma, ArchivedUser, ReportJob, Mailing, normalize_email
 from .serializers import UserSerializer, UserWriteSerializer, GroupSerializer, NoteWriteSerializer, NoteSerializer, \
-    DiplomaSerializer, DiplomaWriteSerializer
-
-
-class UserViewSet(viewsets.ModelViewSet):
+    DiplomaSerializer, DiplomaWriteSerializer, ArchivedUserSerializer, ReportJobSerializer, \
+    MailingSerializer, GroupMemberSerializer, GROUP_MEMBER_FIELDS
+from .invitations import create_invitations, accept_invitation, invitation_url
+from .mailing import clean_segment, start_mailing
+from .notifications import send_registration_emails, send_password_reset_emails, new_user_email, \
+    admin_notification_email
+from .paginators import MembersCursorPagination
+from .renderers import FastJSONRenderer, NDJSONRenderer
+from .reports import REPORTS, start_report
+from .routers import ReplicaReadMixin
+from .streaming import stream_users
+from .utils import custom_field_value
+from .versions import touch_site
+
+
+def report_job_response(request, kind):
+    """
+    Starts building the report with parameters from request data in the background
+    :return: Response with the ReportJob to poll
+    """
+    report = REPORTS[kind]
+    try:
+        params = report.clean(request.data)
+    except (TypeError, ValueError):
+        return Response(status=status.HTTP_400_BAD_REQUEST)
+    upload_field = getattr(report, 'upload_field', None)
+    job = start_report(request.site, request.user, kind, params,
+                       upload=request.data.get(upload_field) if upload_field else None)
+    return Response(ReportJobSerializer(job).data, status=status.HTTP_202_ACCEPTED)
+
+
+class UserViewSet(ConditionalGetMixin, ReplicaReadMixin, viewsets.ModelViewSet):
     queryset = User.objects.all()
     serializer_class = UserSerializer
     permission_classes = []
+    replica_actions = ['list', 'retrieve', 'export', 'sales', 'facets']
+    conditional_actions = ['list', 'retrieve', 'facets']
+    renderer_classes = [FastJSONRenderer] + [renderer for renderer in api_settings.DEFAULT_RENDERER_CLASSES
+                                             if renderer is not JSONRenderer] + [NDJSONRenderer]
 
     def get_serializer_class(self):
         if self.action in ['list', 'retrieve']:
@@ -37,12 +80,30 @@ class UserViewSet(viewsets.ModelViewSet):
         else:
             return UserWriteSerializer
 
-    def get_queryset(self):
-        qs = User.on_site.filter(is_active=True)
+    def list(self, request, *args, **kwargs):
+        """
+        ?stream=1 streams the list as a JSON array, ?format=ndjson
+        or Accept: application/x-ndjson streams one user per line
+        """
+        if self.paginator is not None:
+            return super(UserViewSet, self).list(request, *args, **kwargs)
+        queryset = self.filter_queryset(self.get_queryset())
+        ndjson = isinstance(request.accepted_renderer, NDJSONRenderer)
+        if ndjson or request.query_params.get('stream'):
+            return stream_users(queryset, ndjson=ndjson)
+        # Same data as UserSerializer, built from .values() rows
+        return Response(serialize_users(queryset))
+
+    def get_visibility_q(self):
         q = Q()
         # Преподаватель видит только своих учеников
         if self.request.user and self.request.user.__class__ != AnonymousUser and self.request.user.role == 'teacher':
             q &= Q(role='teacher') | Q(role='admin') | (Q(role='student') & Q(groups__author=self.request.user))
+        return q
+
+    def get_queryset(self):
+        qs = User.on_site.filter(is_active=True)
+        q = self.get_visibility_q()
         data = self.request.query_params
 
         if data.get('role'):
@@ -69,6 +130,7 @@ class UserViewSet(viewsets.ModelViewSet):
     def destroy(self, request, *args, **kwargs):
         user = self.get_object()
         user.is_active = False
+        user.deactivated_at = timezone.now()
         user.save()
         return Response(status=status.HTTP_204_NO_CONTENT)
 
@@ -87,7 +149,8 @@ class UserViewSet(viewsets.ModelViewSet):
         if (request.user.__class__ is AnonymousUser) or (request.user.role == 'admin'):
             result = {'result': True}
         else:
-            result = {'result': AccessRequest.objects.filter(user__id=int(pk), course__authors=request.user).exists()}
+            result = {'result': AccessRequest.objects.filter(user__id=int(pk),
+                                                             course__in=authored_course_ids(request.user)).exists()}
         return Response(result)
 
     @list_route(methods=['GET', 'POST'])
@@ -96,11 +159,33 @@ class UserViewSet(viewsets.ModelViewSet):
             code = request._request.environ.get('QUERY_STRING', None).split('=')[1]
             user = User.objects.get(unsubscribe_code=code)
             user.is_active = True
+            user.deactivated_at = None
             user.save()
             return Response(status=status.HTTP_200_OK)
         except:
             return Response(status=status.HTTP_404_NOT_FOUND)
 
+    @list_route(methods=['GET'])
+    def facets(self, request):
+        """
+        Counts of visible users by role, group, tag and active state, for the list filters
+        """
+        q = self.get_visibility_q()
+        scope_key = request.user.id if q else 'all'
+        return Response(cached_facets(request.site.id, scope_key, User.on_site.filter(q)))
+
+    @list_route(methods=['GET', 'POST'])
+    def unsubscribe(self, request):
+        """
+        Unsubscribes the user from mailings by unsubscribe_code in 'code' param
+        """
+        try:
+            code = uuid.UUID(request.query_params.get('code'))
+        except (TypeError, ValueError):
+            return Response(status=status.HTTP_404_NOT_FOUND)
+        updated = User.objects.filter(unsubscribe_code=code).update(is_unsubscribed=True)
+        return Response(status=status.HTTP_200_OK if updated else status.HTTP_404_NOT_FOUND)
+
     @list_route(methods=['GET'])
     def profile(self, request):
         if request.user.is_authenticated():
@@ -111,106 +196,197 @@ class UserViewSet(viewsets.ModelViewSet):
             return Response(
                 {"role": {"value": "anonymous", "title": "anonymous"}, "avatar": "/static/images/default-profile.jpg"})
 
-    @list_route(methods=['GET'])
+    @list_route(methods=['GET', 'POST'])
     def export(self, request, pk=None):
-        ids = list(map(int, request.query_params.getlist('users')))
-        response = HttpResponse(content_type='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
-        response['Content-Disposition'] = 'attachment; filename="export.xlsx"'
-
-        wb = Workbook()
-        ws = wb.active
-        ws.title = 'Пользователи'
-        ws.column_dimensions['A'].width = 50.0
-        ws.column_dimensions['B'].width = 50.0
-        ws.column_dimensions['C'].width = 50.0
-        ws.column_dimensions['D'].width = 50.0
-
-        header = ['ФИО', 'Роль', 'Дата регистрации', 'Email']
-        ws.append(header)
-
-        for user in User.objects.filter(site=request.site, is_active=True, id__in=ids):
-            ws.append([user.full_name,
-                       user.get_role_display(),
-                       user.registered_at.strftime('%d.%m.%Y'),
-                       user.email])
-
-        wb.save(response)
+        report = REPORTS['export']
+        if request.method == 'POST':
+            return report_job_response(request, 'export')
+
+        response = HttpResponse(content_type=report.content_type)
+        response['Content-Disposition'] = 'attachment; filename="{}"'.format(report.filename)
+        response.write(report.build(request.site, report.clean(request.query_params)))
         return response
 
     @list_route(methods=['POST'])
     def register(self, request, format='json'):
-        email = request.data.get('email').lower()
-
-        if not User.objects.filter(site=request.site, email__iexact=email).exists():
-            password = request.data.get('password')
-            if password is None:
-                password = ''.join(random.choice(string.ascii_letters + string.digits) for _ in range(8))
-
-            user = User.objects.create_user(site=request.site,
-                                            is_active=True,
-                                            role=request.data.get('role'),
-                                            email=email,
-                                            password=password,
-                                            first_name=request.data.get('first_name', ''),
-                                            middle_name=request.data.get('middle_name', ''),
-                                            last_name=request.data.get('last_name', ''),
-                                            city=request.data.get('city', ''),
-                                            grade=request.data.get('grade', ''),
-                                            speciality=request.data.get('speciality', ''),
-                                            gender=request.data.get('gender', ''),
-                                            examination=request.data.get('examination', ''),
-                                            phone=request.data.get('phone', ''))
-
-            # Values for custom fields are stored in CustomField model in 'values' field, so
-            # we need to save it in another way:
-            for field in request.data.get('custom_fields', []):
-                # [] is for AddUserModal (multiple users)
-                # request.custom_fields is a list of [name, value] for each field
-                custom_field = user.site.organization.custom_fields.get(name=field[0])
-                value = field[1]
-                if custom_field.field_type == 6:  # 6 is DateField
-                    # Currently we get time in UTC from frontend, so we need to represent it in local TZ
-                    # To store time in each user's local timezone, change timezone() below
-                    value = dateutil.parser.parse(value).astimezone(timezone('Europe/Moscow')).date()
-                elif custom_field.field_type == 7:  # 7 is DateTimeField
-                    value = dateutil.parser.parse(value).astimezone(timezone('Europe/Moscow'))
-                custom_field.values.update({user.email: str(value)})
-                custom_field.save()
-
-            if request.data.get('groups'):
-                user.groups.add(*request.data.get('groups'))
-
-            if request.data.get('tags'):
-                user.tags.add(request.data.get('tags'))
-
-            # Email for new user
-            params = {
-                'address': request.site.domain + '.grandclass.net',
-                'user': user,
-                'password': password
-            }
-
-            if user.role == 'student':
-                email_body = render_to_string('mail/new_student_registered.txt', params)
-            else:
-                email_body = render_to_string('mail/new_teacher_registered.txt', params)
+        email = normalize_email(request.data.get('email'))
+        if not email:
+            return Response(status=status.HTTP_400_BAD_REQUEST)
+        # Users added by admin or teacher get an invitation instead of a generated password
+        password = request.data.get('password')
+
+        # No existence check: the unique (site, email_normalized) rejects registered emails,
+        # also when the same email is registered by concurrent requests
+        try:
+            with transaction.atomic():
+                user = User.objects.create_user(site=request.site,
+                                                is_active=True,
+                                                role=request.data.get('role'),
+                                                email=email,
+                                                password=password,
+                                                first_name=request.data.get('first_name', ''),
+                                                middle_name=request.data.get('middle_name', ''),
+                                                last_name=request.data.get('last_name', ''),
+                                                city=request.data.get('city', ''),
+                                                grade=request.data.get('grade', ''),
+                                                speciality=request.data.get('speciality', ''),
+                                                gender=request.data.get('gender', ''),
+                                                examination=request.data.get('examination', ''),
+                                                phone=request.data.get('phone', ''))
+        except IntegrityError:
+            # Only the registered email is the client's error
+            if not User.objects.filter(Q(email_normalized=email) | Q(email__iexact=email), site=request.site).exists():
+                raise
+            return Response({'status': 209})
 
-            user.email_user(request.site.organization.title, email_body, settings.DEFAULT_FROM_EMAIL)
+        # Values for custom fields are stored in CustomField model in 'values' field, so
+        # we need to save it in another way:
+        for field in request.data.get('custom_fields', []):
+            # [] is for AddUserModal (multiple users)
+            # request.custom_fields is a list of [name, value] for each field
+            custom_field = user.site.organization.custom_fields.get(name=field[0])
+            custom_field.values.update({user.email: custom_field_value(custom_field, field[1])})
+            custom_field.save(update_fields=['values'])
 
-            # Email for admin
-            params = {'user': user}
-            admin = request.site.organization.admin
-            if admin and request.site.organization.notify_about_clients:
-                if user.role == 'student':
-                    email_body = render_to_string('mail/new_user_notification_for_platform_admin.txt', params)
-                    admin.email_user('Новый ученик', email_body, settings.DEFAULT_FROM_EMAIL)
-                else:
-                    email_body = render_to_string('mail/new_teacher_notification_for_platform_admin.txt', params)
-                    admin.email_user('Новый преподаватель', email_body, settings.DEFAULT_FROM_EMAIL)
+        if request.data.get('groups'):
+            user.groups.add(*request.data.get('groups'))
 
-            return Response(status=status.HTTP_201_CREATED, data={'id': user.id})
-        else:
-            return Response({'status': 209})
+        if request.data.get('tags'):
+            user.tags.add(request.data.get('tags'))
+
+        # Email for new user
+        url = None
+        if password is None:
+            url = invitation_url(request.site, create_invitations([user])[user.id])
+        subject, email_body = new_user_email(request.site, user, password, url)
+        user.email_user(subject, email_body, settings.DEFAULT_FROM_EMAIL)
+
+        # Email for admin
+        notification = admin_notification_email(request.site, user)
+        if notification:
+            admin, subject, email_body = notification
+            admin.email_user(subject, email_body, settings.DEFAULT_FROM_EMAIL)
+
+        return Response(status=status.HTTP_201_CREATED, data={'id': user.id})
+
+    @list_route(methods=['POST'])
+    def register_bulk(self, request):
+        """
+        Registers many users at once (AddUserModal).
+        Takes a list of users with the same keys as 'register'.
+        :return: list of {'email', 'status', 'id'} in the order of request,
+        where status is one of 'created', 'exists', 'duplicate', 'invalid'
+        """
+        from email_validator import validate_email, EmailNotValidError
+
+        items = request.data if isinstance(request.data, list) else request.data.get('users', [])
+        site = request.site
+        now = timezone.now()
+
+        result = [None] * len(items)
+        new_items = OrderedDict()  # email -> index in items
+        for i, item in enumerate(items):
+            email = normalize_email(item.get('email') or '')
+            try:
+                validate_email(email, check_deliverability=False)
+            except EmailNotValidError:
+                result[i] = {'email': email, 'status': 'invalid', 'id': None}
+                continue
+            if email in new_items:
+                result[i] = {'email': email, 'status': 'duplicate', 'id': None}
+            else:
+                new_items[email] = i
+
+        # Accounts created in bulk get the cheaper cost, rehashed on their first login
+        hasher = bulk_hasher()
+
+        def new_user(email, item):
+            # Users without password (or with an empty one) get an unusable password
+            # and an invitation, so they cost no hashing here
+            return User(site=site,
+                        is_active=True,
+                        role=item.get('role') or User.ROLE_TYPES[0][0],
+                        email=email,
+                        password=make_password(item.get('password') or None, hasher=hasher),
+                        first_name=item.get('first_name', ''),
+                        middle_name=item.get('middle_name', ''),
+                        last_name=item.get('last_name', ''),
+                        city=item.get('city', ''),
+                        grade=item.get('grade', ''),
+                        speciality=item.get('speciality', ''),
+                        gender=item.get('gender', ''),
+                        examination=item.get('examination', ''),
+                        phone=item.get('phone', ''),
+                        last_login=now,
+                        registered_at=now)
+
+        with transaction.atomic():
+            # Users registered by a concurrent request after the check make
+            # bulk_create fail on the unique email, then they are checked again
+            for attempt in range(2):
+                existing = dict(User.objects.filter(site=site, email_normalized__in=list(new_items))
+                                .values_list('email_normalized', 'id'))
+                for email in existing:
+                    result[new_items.pop(email)] = {'email': email, 'status': 'exists', 'id': existing[email]}
+                users = [new_user(email, items[i]) for email, i in new_items.items()]
+                try:
+                    with transaction.atomic():
+                        User.objects.bulk_create(users)
+                    break
+                except IntegrityError:
+                    if attempt:
+                        raise
+
+            # bulk_create does not set ids on every backend
+            ids = dict(User.objects.filter(site=site, email_normalized__in=list(new_items))
+                       .values_list('email_normalized', 'id'))
+
+            # Every CustomField is saved once for all new users
+            custom_fields = {field.name: field for field in site.organization.custom_fields.all()}
+            changed_fields = set()
+            item_groups, item_tags = dict(), dict()
+            for email, i in new_items.items():
+                item_groups[email] = set(items[i].get('groups') or [])
+                tags = items[i].get('tags') or []
+                item_tags[email] = set(tags if isinstance(tags, list) else [tags])
+            groups = set(Group.objects.filter(site=site, id__in=set().union(*item_groups.values()))
+                         .values_list('id', flat=True))
+            tags = set(User._meta.get_field('tags').related_model.objects
+                       .filter(id__in=set().union(*item_tags.values())).values_list('id', flat=True))
+
+            user_groups, user_tags = list(), list()
+            for email, i in new_items.items():
+                user_id = ids[email]
+                for name, value in items[i].get('custom_fields', []):
+                    if name in custom_fields:
+                        custom_fields[name].values.update({email: custom_field_value(custom_fields[name], value)})
+                        changed_fields.add(name)
+
+                user_groups.extend(User.groups.through(user_id=user_id, group_id=group_id)
+                                   for group_id in item_groups[email] & groups)
+                user_tags.extend(User.tags.through(user_id=user_id, tag_id=tag_id)
+                                 for tag_id in item_tags[email] & tags)
+                result[i] = {'email': email, 'status': 'created', 'id': user_id}
+
+            for name in changed_fields:
+                custom_fields[name].save(update_fields=['values'])
+            User.groups.through.objects.bulk_create(user_groups)
+            User.tags.through.objects.bulk_create(user_tags)
+            # bulk_create does not send signals
+            touch_site(site.id)
+            for user in users:
+                user.id = ids[user.email]
+            record_changes(users, 'created')
+            record_memberships(site.id, [(row.user_id, row.group_id) for row in user_groups], 'added')
+
+            credentials = {ids[email]: {'password': items[i]['password']}
+                           for email, i in new_items.items() if items[i].get('password')}
+            invited = [user for user in users if user.id not in credentials]
+            for user_id, token in create_invitations(invited).items():
+                credentials[user_id] = {'invitation_url': invitation_url(site, token)}
+            tasks.submit(send_registration_emails, site.id, credentials)
+
+        return Response(status=status.HTTP_201_CREATED, data=result)
 
     @list_route(methods=['POST'])
     def login(self, request, format=None):
@@ -237,8 +413,12 @@ class UserViewSet(viewsets.ModelViewSet):
         if email is None:
             return Response({'status': status.HTTP_404_NOT_FOUND})
 
-        if User.objects.filter(site=request.site, email__iexact=email).exists():
-            user = User.objects.get(site=request.site, email__iexact=email)
+        user = User.objects.filter(site=request.site, email_normalized=normalize_email(email)).first()
+        if user is None:
+            # email_normalized is empty for users not processed by normalize_emails
+            user = User.objects.filter(site=request.site, email_normalized__isnull=True,
+                                       email__iexact=normalize_email(email)).first()
+        if user:
             random_password = ''.join(random.choice(string.ascii_letters + string.digits) for _ in range(8))
             user.set_password(random_password)
             user.save()
@@ -259,59 +439,118 @@ class UserViewSet(viewsets.ModelViewSet):
         for each in query:
             ids.append(each.split('=')[1])
 
-        for user in User.objects.filter(id__in=ids):
-            random_password = ''.join(random.choice(string.ascii_letters + string.digits) for _ in range(8))
-            user.set_password(random_password)
-            user.save()
-
-            user.email_user(subject='Новые данные для входа',
-                            message='Ваш пароль был сброшен, новый пароль: {}\nСсылка для входа http://sdo.gppc.ru/login \nПароль можно сменить в настройках профиля.'.format(random_password),
-                            from_email=settings.DEFAULT_FROM_EMAIL)
+        # Old passwords stop working, users set new ones by invitation link
+        users = list(User.objects.filter(id__in=ids).only('id', 'site'))
+        User.objects.filter(id__in=[user.id for user in users]).update(password=make_password(None))
+        forget_users(*[user.id for user in users])
+        tokens = create_invitations(users)
+        tasks.submit(send_password_reset_emails,
+                     {user.id: invitation_url(request.site, tokens[user.id]) for user in users})
         return Response(status=status.HTTP_200_OK)
 
+    @list_route(methods=['POST'])
+    def accept_invitation(self, request):
+        """
+        Sets password of the invited user and logs him in
+        """
+        password = request.data.get('password')
+        if not password:
+            return Response({'status': status.HTTP_400_BAD_REQUEST})
+        # Before the token is used up, so the user can retry with a better password
+        try:
+            password_validation.validate_password(password)
+        except ValidationError as e:
+            return Response({'status': status.HTTP_400_BAD_REQUEST, 'errors': e.messages})
+
+        user = accept_invitation(request.data.get('token', ''))
+        if user is None:
+            return Response({'status': status.HTTP_404_NOT_FOUND})
+
+        user.set_password(password)
+        user.save()
+        login(request, user, backend='django.contrib.auth.backends.ModelBackend')
+        return Response({'status': status.HTTP_200_OK})
+
     @list_route(methods=['POST'])
     def batch_delete(self, request):
         queryset = self.get_queryset()
         data = self.request.data
-        queryset.filter(id__in=data['ids']).update(is_active=False)
+        now = timezone.now()
+        with transaction.atomic():
+            queryset.filter(id__in=data['ids']).update(is_active=False, deactivated_at=now, updated_at=now)
+            # update() does not send signals
+            record_changes(User.objects.filter(id__in=data['ids'], deactivated_at=now), 'updated')
+        forget_users(*data['ids'])
+        touch_site(request.site.id)
         return Response(status=status.HTTP_204_NO_CONTENT)
 
     @list_route(methods=['GET'])
+    def changes(self, request):
+        """
+        Feed of changes of users, groups, memberships, notes and diplomas, see user.changes.
+        ?since= is the cursor of the last received event, ?limit= the batch size
+        :return: {'results': [events], 'next': cursor for the next request}
+        """
+        if request.user.__class__ is AnonymousUser or request.user.role != 'admin':
+            return Response(status=status.HTTP_403_FORBIDDEN)
+
+        try:
+            since = int(request.query_params.get('since', 0))
+            limit = min(int(request.query_params.get('limit', app_settings.CHANGES_BATCH_SIZE)),
+                        app_settings.CHANGES_BATCH_SIZE)
+        except ValueError:
+            return Response(status=status.HTTP_400_BAD_REQUEST)
+        events = changes_since(request.site.id, since, max(limit, 1))
+        return Response({'results': events, 'next': events[-1]['cursor'] if events else since})
+
+    @list_route(methods=['GET'])
+    def archived(self, request):
+        if request.user.__class__ is AnonymousUser or request.user.role != 'admin':
+            return Response(status=status.HTTP_403_FORBIDDEN)
+
+        qs = ArchivedUser.on_site.all().order_by('-archived_at')
+        if request.query_params.get('email'):
+            qs = qs.filter(email__icontains=request.query_params.get('email'))
+        return Response(ArchivedUserSerializer(qs, many=True).data)
+
+    @list_route(methods=['POST'])
+    def restore(self, request):
+        """
+        Restores archived users by ArchivedUser ids.
+        :return: {archived_id: {'id': restored user id} or {'error': message}}
+        """
+        if request.user.__class__ is AnonymousUser or request.user.role != 'admin':
+            return Response(status=status.HTTP_403_FORBIDDEN)
+
+        result = {}
+        for archived in ArchivedUser.on_site.filter(id__in=request.data.get('ids', [])):
+            archived_id = archived.id
+            try:
+                result[archived_id] = {'id': restore_user(archived).id}
+            except ValueError as e:
+                result[archived_id] = {'error': str(e)}
+        return Response(result)
+
+    @list_route(methods=['GET', 'POST'])
     def sales(self, request):
+        if request.method == 'POST':
+            return report_job_response(request, 'sales')
+
         try:
             query = request._request.environ.get('QUERY_STRING', None).split('&')
             params = [param.split('=')[1] for param in query]
-            date_end = datetime.combine(datetime.strptime(params[0], '%d.%m.%Y').date(),
-                                        datetime.min.time()) + timedelta(days=1)
-            date_start = datetime.combine(datetime.strptime(params[1], '%d.%m.%Y').date(), datetime.min.time())
+            params = REPORTS['sales'].clean({'date_end': params[0], 'date_start': params[1]})
         except:
             return Response()
-
-        result = []
-        for teacher in User.objects.filter(role='teacher'):
-            data = {
-                'id': teacher.id,
-                'full_name': teacher.full_name,
-                'courses': 0,
-                'webinars': 0
-            }
-
-            for payment in Payment.objects.filter(is_paid=True, paid_at__gte=date_start, paid_at__lte=date_end):
-                if teacher in payment.access_requests.last().target.authors.all():
-                    if payment.access_requests.last().target.__class__.__name__ == 'Course':
-                        data['courses'] += payment.amount
-                    if payment.access_requests.last().target.__class__.__name__ == 'Webinar':
-                        data['webinars'] += payment.amount
-
-            if data['courses'] or data['webinars']:
-                result.append(data)
-        return Response(result)
+        return Response(REPORTS['sales'].get_data(params))
 
 
 class UsersImportView(views.APIView):
     parser_classes = [MultiPartParser]
 
     def post(self, request, filename, format=None):
+        from openpyxl import load_workbook
+
         try:
             file_obj = request.FILES.get('file')
             workbook = load_workbook(file_obj)
@@ -324,7 +563,8 @@ class UsersImportView(views.APIView):
             if not (row[0].value and row[2].value and row[3].value):
                 return Response(status=status.HTTP_201_CREATED, data={'error': 'Поля имя, фамилия и email являются обязательными', 'counts': {}})
 
-        count_created = 0
+        created = list()
+        count_exists = 0
         count_failed = 0
 
         for row in list(worksheet.rows)[1:]:
@@ -335,48 +575,45 @@ class UsersImportView(views.APIView):
                 email = row[3].value
                 phone = row[4].value
 
-                if not User.objects.filter(email__iexact=email, site=request.user.site).exists():
-                    random_password = ''.join(random.choice(string.ascii_letters + string.digits) for _ in range(8))
-
+                # Imported users set their password by invitation link.
+                # Existing emails are rejected by the unique (site, email_normalized)
+                with transaction.atomic():
                     user = User.objects.create_user(site=request.user.site,
                                                     email=email,
-                                                    password=random_password,
+                                                    password=None,
                                                     first_name=first_name,
                                                     middle_name=middle_name if middle_name else '',
                                                     last_name=last_name,
                                                     phone=phone if phone else '',
                                                     role='student')
-                    count_created += 1
-
-                    try:
-                        # Email for new user
-                        params = {
-                            'address': request.site.domain + '.grandclass.net',
-                            'user': user,
-                            'password': random_password
-                        }
-
-                        email_body = render_to_string('mail/new_student_registered.txt', params)
-                        user.email_user(request.site.organization.title, email_body, settings.DEFAULT_FROM_EMAIL)
-
-                        # Email for admin
-                        admin = request.site.organization.admin
-                        if admin and request.site.organization.notify_about_clients:
-                            email_body = render_to_string('mail/new_user_notification_for_platform_admin.txt', {'user': user})
-                            admin.email_user('Новый ученик', email_body, settings.DEFAULT_FROM_EMAIL)
-                    except:
-                        pass
+                created.append(user)
+
+            except IntegrityError:
+                # Only the registered email is skipped, other integrity errors are failures
+                email = normalize_email(email)
+                if User.objects.filter(Q(email_normalized=email) | Q(email__iexact=email),
+                                       site=request.user.site).exists():
+                    count_exists += 1
+                else:
+                    count_failed += 1
 
             except:
                 count_failed += 1
 
-        return Response(status=status.HTTP_201_CREATED, data={'error': '', 'counts': {'created': count_created, 'failed': count_failed}})
+        tokens = create_invitations(created)
+        tasks.submit(send_registration_emails, request.site.id,
+                     {user.id: {'invitation_url': invitation_url(request.site, tokens[user.id])} for user in created})
+
+        return Response(status=status.HTTP_201_CREATED, data={'error': '', 'counts': {'created': len(created), 'exists': count_exists,
+                                                                        'failed': count_failed}})
 
 
-class GroupViewSet(viewsets.ModelViewSet):
+class GroupViewSet(ConditionalGetMixin, ReplicaReadMixin, viewsets.ModelViewSet):
     queryset = Group.objects.all()
     serializer_class = GroupSerializer
     permission_classes = []
+    replica_actions = ['list', 'retrieve', 'members']
+    conditional_actions = ['list', 'retrieve', 'members']
 
     def get_queryset(self):
         qs = Group.on_site.all()
@@ -389,6 +626,8 @@ class GroupViewSet(viewsets.ModelViewSet):
             except ValueError:
                 pass
         qs = qs.filter(q)
+        if self.action in ['list', 'retrieve']:
+            qs = qs.annotate(users_count=Count('users'))
         return qs
 
     def perform_create(self, serializer):
@@ -407,6 +646,23 @@ class GroupViewSet(viewsets.ModelViewSet):
         instance.users.add(*new_users - old_users)
         instance.users.remove(*old_users - new_users)
 
+    @detail_route(methods=['GET'])
+    def members(self, request, pk=None):
+        """
+        Members of the group by pages, ?search= filters by name and email
+        """
+        group = self.get_object()
+        # The membership table joined to users, by its group_id index
+        qs = User.objects.filter(groups=group).only(*GROUP_MEMBER_FIELDS)
+        search = request.query_params.get('search')
+        if search:
+            qs = qs.filter(Q(last_name__icontains=search) | Q(first_name__icontains=search) |
+                           Q(middle_name__icontains=search) | Q(email__icontains=search))
+
+        paginator = MembersCursorPagination()
+        page = paginator.paginate_queryset(qs, request, view=self)
+        return paginator.get_paginated_response(GroupMemberSerializer(page, many=True).data)
+
     @list_route(methods=['POST'])
     def batch_delete(self, request):
         queryset = self.get_queryset()
@@ -415,7 +671,7 @@ class GroupViewSet(viewsets.ModelViewSet):
         return Response(status=status.HTTP_204_NO_CONTENT)
 
 
-class NoteViewSet(viewsets.ModelViewSet):
+class NoteViewSet(ConditionalGetMixin, ReplicaReadMixin, viewsets.ModelViewSet):
     queryset = Note.objects.all()
     serializer_class = NoteSerializer
     permission_classes = []
@@ -446,16 +702,10 @@ class NoteViewSet(viewsets.ModelViewSet):
 
         if role == 'teacher':
             if data.get('user'):
-                check = False
                 student = User.objects.get(id=data.get('user'))
-                for request in student.access_requests.filter(course__isnull=False):
-                    if user in request.course.authors.all():
-                        check = True
-
-                for group in student.groups.all():
-                    for request in group.access_requests.filter(course__isnull=False):
-                        if user in request.course.authors.all():
-                            check = True
+                # Access requests of the student or of the student's groups to the teacher's courses
+                check = AccessRequest.objects.filter(Q(user=student) | Q(group__users=student),
+                                                     course__in=authored_course_ids(user)).exists()
 
                 if not check:
                     qs = Note.on_site.none()
@@ -463,7 +713,7 @@ class NoteViewSet(viewsets.ModelViewSet):
         return qs
 
 
-class DiplomaViewSet(viewsets.ModelViewSet):
+class DiplomaViewSet(ConditionalGetMixin, ReplicaReadMixin, viewsets.ModelViewSet):
     queryset = Diploma.objects.all()
     serializer_class = DiplomaSerializer
     permission_classes = []
@@ -490,3 +740,79 @@ class DiplomaViewSet(viewsets.ModelViewSet):
 
         qs = qs.filter(q).order_by('id')
         return qs
+
+    @list_route(methods=['POST'])
+    def batch(self, request):
+        """
+        Creates diplomas for users of the group or the list from the template image in the background.
+        Data: template, group or users, description, and x, y, font_size, color of the name (see user.diplomas)
+        :return: ReportJob to poll
+        """
+        if not request.user.is_authenticated() or request.user.role not in ['admin', 'teacher']:
+            return Response(status=status.HTTP_403_FORBIDDEN)
+        return report_job_response(request, 'diplomas')
+
+
+class ReportJobViewSet(viewsets.ModelViewSet):
+    """
+    Status and results of background reports, see user.reports.
+    Jobs are started by POST to users/export/, users/sales/ and diplomas/batch/.
+    Registered in the project API router as 'reports', like the other viewsets of the app
+    """
+    queryset = ReportJob.objects.all()
+    serializer_class = ReportJobSerializer
+    permission_classes = []
+    http_method_names = ['get', 'head', 'options']
+
+    def get_queryset(self):
+        qs = ReportJob.on_site.all()
+        # Job ids are not guessable, but the list shows only own jobs
+        if self.action == 'list':
+            if not self.request.user.is_authenticated():
+                return qs.none()
+            qs = qs.filter(created_by=self.request.user)
+        return qs.order_by('-created_at')
+
+    @detail_route(methods=['GET'])
+    def download(self, request, pk=None):
+        job = self.get_object()
+        if job.status != 'done' or not job.file:
+            raise Http404
+        report = REPORTS[job.kind]
+        response = FileResponse(job.file.storage.open(job.file.name, 'rb'), content_type=report.content_type)
+        response['Content-Disposition'] = 'attachment; filename="{}"'.format(report.filename)
+        return response
+
+
+class MailingViewSet(viewsets.ModelViewSet):
+    """
+    Bulk mailings to segments of users, see user.mailing. Only for admins.
+    Registered in the project API router as 'mailings', like the other viewsets of the app
+    """
+    queryset = Mailing.objects.all()
+    serializer_class = MailingSerializer
+    permission_classes = []
+    http_method_names = ['get', 'post', 'head', 'options']
+
+    def initial(self, request, *args, **kwargs):
+        super(MailingViewSet, self).initial(request, *args, **kwargs)
+        if request.user.__class__ is AnonymousUser or request.user.role != 'admin':
+            self.permission_denied(request)
+
+    def get_queryset(self):
+        return Mailing.on_site.all().order_by('-created_at')
+
+    def create(self, request, *args, **kwargs):
+        """
+        Data: subject, body (template with {{ user.full_name }}, {{ unsubscribe_url }} etc.)
+        and segment: {role, group, tag, custom_field: [name, value]}
+        """
+        if not request.data.get('subject') or not request.data.get('body'):
+            return Response(status=status.HTTP_400_BAD_REQUEST)
+        try:
+            segment = clean_segment(request.site, request.data.get('segment') or {})
+            mailing = start_mailing(request.site, request.user, request.data['subject'], request.data['body'],
+                                    segment)
+        except (TypeError, ValueError):
+            return Response(status=status.HTTP_400_BAD_REQUEST)
+        return Response(MailingSerializer(mailing).data, status=status.HTTP_201_CREATED)